@@ -208,8 +208,9 @@ def _link(files, d_max, tolerance):
                 linked_n = []
                 linked_photonrate = []
 
+                index = _lib.group_index(linked_locs)
                 for group in _tqdm(_np.unique(clusters["groups"])):
-                    temp = linked_locs[linked_locs["group"] == group]
+                    temp = _lib.group_locs(linked_locs, index, group)
                     if len(temp) > 0:
                         n_after_link.append(len(temp))
                         linked_len.append(_np.mean(temp["len"]))
@@ -279,14 +280,18 @@ def _cluster_combine_dist(files):
             io.save_locs(base + "_cdist.hdf5", combinedist_locs, info)
 
 
-def _clusterfilter(files, clusterfile, parameter, minval, maxval):
+def _clusterfilter(
+    files, clusterfile, parameter, minval, maxval, more_ranges=None
+):
     from glob import glob
-    from tqdm import tqdm
     import numpy as np
 
+    ranges = [(parameter, minval, maxval)]
+    if more_ranges is not None:
+        ranges += [(_[0], float(_[1]), float(_[2])) for _ in more_ranges]
     paths = glob(files)
     if paths:
-        from . import io
+        from . import io, postprocess
 
         for path in paths:
             try:
@@ -295,73 +300,37 @@ def _clusterfilter(files, clusterfile, parameter, minval, maxval):
                 continue
 
             clusters = io.load_clusters(clusterfile)
-            try:
-                selector = (clusters[parameter] > minval) & (
-                    clusters[parameter] < maxval
-                )
-                if np.sum(selector) == 0:
-                    print(
-                        "Error: No localizations in range. Filtering aborted."
-                    )
-                elif np.sum(selector) == len(selector):
-                    print(
-                        "Error: All localizations in range. Filtering aborted."
-                    )
-                else:
-                    print("Isolating locs.. Step 1: in range")
-                    groups = clusters["groups"][selector]
-                    first = True
-                    for group in tqdm(groups):
-                        if first:
-                            all_locs = locs[locs["group"] == group]
-                            first = False
-                        else:
-                            all_locs = np.append(
-                                all_locs, locs[locs["group"] == group]
-                            )
-
-                    base, ext = os.path.splitext(path)
-                    clusterfilter_info = {
-                        "Generated by": "Picasso Clusterfilter - in",
-                        "Paramter": parameter,
-                        "Minval": minval,
-                        "Maxval": maxval,
-                    }
-                    info.append(clusterfilter_info)
-                    all_locs.sort(kind="mergesort", order="frame")
-                    all_locs = all_locs.view(np.recarray)
-                    out_path = base + "_filter_in.hdf5"
-                    io.save_locs(out_path, all_locs, info)
-                    print("Complete. Saved to: {}".format(out_path))
-
-                    print("Isolating locs.. Step 2: out of range")
-                    groups = clusters["groups"][~selector]
-                    first = True
-                    for group in tqdm(groups):
-                        if first:
-                            all_locs = locs[locs["group"] == group]
-                            first = False
-                        else:
-                            all_locs = np.append(
-                                all_locs, locs[locs["group"] == group]
-                            )
-
-                    base, ext = os.path.splitext(path)
-                    clusterfilter_info = {
-                        "Generated by": "Picasso Clusterfilter - out",
-                        "Paramter": parameter,
-                        "Minval": minval,
-                        "Maxval": maxval,
-                    }
-                    info.append(clusterfilter_info)
-                    all_locs.sort(kind="mergesort", order="frame")
-                    all_locs = all_locs.view(np.recarray)
-                    out_path = base + "_filter_out.hdf5"
-                    io.save_locs(out_path, all_locs, info)
-                    print("Complete. Saved to: {}".format(out_path))
-
-            except ValueError:
-                print("Error: Field {} not found.".format(parameter))
+            names = clusters.dtype.names
+            missing = [_[0] for _ in ranges if _[0] not in names]
+            if missing:
+                print("Error: Field {} not found.".format(", ".join(missing)))
+                continue
+            locs_in, locs_out, selector = postprocess.cluster_filter(
+                locs, clusters, ranges
+            )
+            if np.sum(selector) == 0:
+                print("Error: No localizations in range. Filtering aborted.")
+                continue
+            elif np.sum(selector) == len(selector):
+                print("Error: All localizations in range. Filtering aborted.")
+                continue
+            base, ext = os.path.splitext(path)
+            outputs = [(locs_in, "in"), (locs_out, "out")]
+            for filtered_locs, direction in outputs:
+                clusterfilter_info = {
+                    "Generated by": "Picasso Clusterfilter - " + direction,
+                    "Paramter": parameter,
+                    "Minval": minval,
+                    "Maxval": maxval,
+                }
+                if len(ranges) > 1:
+                    clusterfilter_info["Ranges"] = [list(_) for _ in ranges]
+                filtered_locs.sort(kind="mergesort", order="frame")
+                filtered_locs = filtered_locs.view(np.recarray)
+                out_path = base + "_filter_{}.hdf5".format(direction)
+                filtered_info = info + [clusterfilter_info]
+                io.save_locs(out_path, filtered_locs, filtered_info)
+                print("Complete. Saved to: {}".format(out_path))
 
 
 def _undrift(files, segmentation, display=True, fromfile=None):
@@ -418,7 +387,7 @@ def _undrift(files, segmentation, display=True, fromfile=None):
         savetxt(base + "_drift.txt", drift, header="dx\tdy", newline="\r\n")
 
 
-def _density(files, radius):
+def _density(files, radius, z_radius=None):
     import glob
 
     paths = glob.glob(files)
@@ -427,16 +396,73 @@ def _density(files, radius):
 
         for path in paths:
             locs, info = io.load_locs(path)
-            locs = postprocess.compute_local_density(locs, info, radius)
+            locs = postprocess.compute_local_density(
+                locs, info, radius, z_radius
+            )
             base, ext = os.path.splitext(path)
             density_info = {
                 "Generated by": "Picasso Density",
                 "Radius": radius,
             }
+            if z_radius is not None:
+                density_info["Z Radius"] = z_radius
             info.append(density_info)
             io.save_locs(base + "_density.hdf5", locs, info)
 
 
+def _timelapse(
+    files,
+    step,
+    window=None,
+    oversampling=1.0,
+    blur_method=None,
+    min_blur_width=0.0,
+):
+    import glob
+
+    paths = glob.glob(files)
+    if paths:
+        from . import io, render
+
+        if blur_method == "none":
+            blur_method = None
+        for path in paths:
+            locs, info = io.load_locs(path)
+            base, ext = os.path.splitext(path)
+            render.save_time_series(
+                base + "_timelapse.tif",
+                locs,
+                info,
+                step,
+                window,
+                oversampling=oversampling,
+                blur_method=blur_method,
+                min_blur_width=min_blur_width,
+            )
+
+
+def _spatialsort(files, cell_size):
+    import glob
+
+    paths = glob.glob(files)
+    if paths:
+        from . import io, lib
+
+        for path in paths:
+            locs, info = io.load_locs(path)
+            locs = lib.ensure_sanity(locs, info)
+            locs, frame_order = lib.sort_spatially(locs, cell_size)
+            base, ext = os.path.splitext(path)
+            info.append(
+                {
+                    "Generated by": "Picasso Spatialsort",
+                    "Order": "Morton",
+                    "Cell Size": cell_size,
+                }
+            )
+            io.save_locs(base + "_morton.hdf5", locs, info, frame_order)
+
+
 def _dbscan(files, radius, min_density):
     import glob
     paths = glob.glob(files)
@@ -486,26 +512,27 @@ def _hdbscan(files, min_cluster, min_samples):
                   "\n" + base + "_hdbclusters.hdf5")
 
 
-def _nneighbor(files):
+def _nneighbor(files, k=1, pixelsize=None):
     import glob
     import h5py as _h5py
-    import numpy as np
-    from scipy.spatial import distance
+    from . import neighbors
 
     paths = glob.glob(files)
     if paths:
         for path in paths:
             print("Loading {} ...".format(path))
             with _h5py.File(path, "r") as locs_file:
-                locs = locs_file["clusters"][...]
-            clusters = np.rec.array(locs, dtype=locs.dtype)
-            points = np.array(clusters[["com_x", "com_y"]].tolist())
-            alldist = distance.cdist(points, points)
-            alldist[alldist == 0] = float("inf")
-            minvals = np.amin(alldist, axis=0)
+                # Cluster centers of dbscan or hdbscan, or raw locs
+                if "clusters" in locs_file:
+                    locs = locs_file["clusters"][...]
+                    prefix = "com_"
+                else:
+                    locs = locs_file["locs"][...]
+                    prefix = ""
+            points = neighbors.points(locs, pixelsize, prefix)
             base, ext = os.path.splitext(path)
             out_path = base + "_minval.txt"
-            np.savetxt(out_path, minvals, newline="\r\n")
+            neighbors.save_knn_distances(out_path, points, k)
             print("Saved filest o: {}".format(out_path))
 
 
@@ -589,7 +616,9 @@ def _groupprops(files):
             )
 
 
-def _pair_correlation(files, bin_size, r_max):
+def _pair_correlation(
+    files, bin_size, r_max, cross=None, pixelsize=None, edge_correction=False
+):
     from glob import glob
 
     paths = glob(files)
@@ -599,20 +628,40 @@ def _pair_correlation(files, bin_size, r_max):
         from matplotlib.pyplot import plot, style, show, xlabel, ylabel, title
 
         style.use("ggplot")
+        # Auto-correlation of each file, or cross-correlation with each
+        # file of the second channel
+        paths_b = [None] if cross is None else glob(cross)
+        unit = "pixel^-2" if pixelsize is None else "pixel^-3"
         for path in paths:
             print("Loading {}...".format(path))
             locs, info = load_locs(path)
-            print("Calculating pair-correlation...")
-            bins_lower, pc = pair_correlation(locs, info, bin_size, r_max)
-            plot(bins_lower - bin_size / 2, pc)
-            xlabel("r (pixel)")
-            ylabel("pair-correlation (pixel^-2)")
-            title(
-                "Pair-correlation. Bin size: {}, R max: {}".format(
-                    bin_size, r_max
+            for path_b in paths_b:
+                if path_b is None:
+                    locs_b = None
+                    print("Calculating pair-correlation...")
+                else:
+                    print("Loading {}...".format(path_b))
+                    locs_b, _ = load_locs(path_b)
+                    print("Calculating cross-correlation...")
+                bins_lower, pc = pair_correlation(
+                    locs,
+                    info,
+                    bin_size,
+                    r_max,
+                    locs_b,
+                    pixelsize,
+                    edge_correction,
                 )
-            )
-            show()
+                plot(bins_lower - bin_size / 2, pc)
+                xlabel("r (pixel)")
+                ylabel("pair-correlation ({})".format(unit))
+                title(
+                    "Pair-correlation. Bin size: {}, R max: {}".format(
+                        bin_size, r_max
+                    )
+                )
+                show()
+
 
 def _nanotron(args):
     from glob import glob
@@ -810,7 +859,13 @@ def _localize(args):
                 locs = gausslq.locs_from_fits_gpufit(ids, theta, box, em)
             elif args.fit_method == "mle":
                 current, thetas, CRLBs, likelihoods, iterations = fit_async(
-                    movie, camera_info, ids, box, convergence, max_iterations
+                    movie,
+                    camera_info,
+                    ids,
+                    box,
+                    convergence,
+                    max_iterations,
+                    lut=getattr(args, "psf_table", False),
                 )
                 n_spots = len(ids)
                 while current[0] < n_spots:
@@ -880,7 +935,7 @@ def _localize(args):
 
 def _render(args):
     from .lib import locs_glob_map
-    from .render import render
+    from .render import render, render_to_tiff
     from os.path import splitext
     from matplotlib.pyplot import imsave
     from os import startfile
@@ -901,9 +956,21 @@ def _render(args):
         scaling,
         cmap,
         silent,
+        tiff,
     ):
         if blur_method == "none":
             blur_method = None
+        base, ext = splitext(path)
+        if tiff:
+            render_to_tiff(
+                base + ".tif",
+                locs,
+                info,
+                oversampling,
+                blur_method=blur_method,
+                min_blur_width=min_blur_width,
+            )
+            return
         N, image = render(
             locs,
             info,
@@ -911,7 +978,6 @@ def _render(args):
             blur_method=blur_method,
             min_blur_width=min_blur_width,
         )
-        base, ext = splitext(path)
         out_path = base + ".png"
         im_max = image.max() / 100
         if scaling == "yes":
@@ -955,6 +1021,7 @@ def _render(args):
                         args.scaling,
                         cmap,
                         True,
+                        args.tiff,
                     ),
                 )
 
@@ -971,15 +1038,29 @@ def _render(args):
                 args.scaling,
                 cmap,
                 args.silent,
+                args.tiff,
             ),
         )
 
 
+def _warmup():
+    from .warmup import warmup, print_report
+
+    print("Compiling kernels into the on-disk cache...")
+    report = warmup()
+    print_report(report)
+
+
 def main():
     import argparse
 
     # Main parser
     parser = argparse.ArgumentParser("picasso")
+    parser.add_argument(
+        "--compile-report",
+        action="store_true",
+        help="print the time spent compiling numerical kernels on exit",
+    )
     subparsers = parser.add_subparsers(dest="command")
 
     for command in ["toraw", "localize", "filter", "render"]:
@@ -1062,6 +1143,14 @@ def main():
     clusterfilter_parser.add_argument(
         "maxval", type=float, help="upper boundary"
     )
+    clusterfilter_parser.add_argument(
+        "-r",
+        "--range",
+        nargs=3,
+        action="append",
+        metavar=("PARAMETER", "MINVAL", "MAXVAL"),
+        help="an additional parameter range that clusters must be in",
+    )
 
     # undrift parser
     undrift_parser = subparsers.add_parser(
@@ -1122,6 +1211,16 @@ def main():
             " to be considered local"
         ),
     )
+    density_parser.add_argument(
+        "-z",
+        "--zradius",
+        type=float,
+        default=None,
+        help=(
+            "maximal distance in z (in the unit of z) for 3D localizations,"
+            " which count as local within the ellipsoid of both radii"
+        ),
+    )
 
     # DBSCAN
     dbscan_parser = subparsers.add_parser(
@@ -1243,6 +1342,28 @@ def main():
         default=10,
         help="The maximum distance to calculate the pair-correlation",
     )
+    pc_parser.add_argument(
+        "-c",
+        "--cross",
+        default=None,
+        help=(
+            "hdf5 localization files of a second channel to cross-correlate"
+            " with, specified by a unix style path pattern"
+        ),
+    )
+    pc_parser.add_argument(
+        "-p",
+        "--pixelsize",
+        type=float,
+        default=None,
+        help="pixel size in nm to calculate 3D distances with z",
+    )
+    pc_parser.add_argument(
+        "-e",
+        "--edge",
+        action="store_true",
+        help="correct for pairs missed at the edges of the field of view",
+    )
     pc_parser.add_argument(
         "files",
         help=(
@@ -1272,6 +1393,11 @@ def main():
         choices=["mle", "lq", "lq-gpu", "lq-3d", "lq-gpu-3d", "avg"],
         default="mle",
     )
+    localize_parser.add_argument(
+        "--psf-table",
+        action="store_true",
+        help="interpolate the PSF integrals of mle fits from a lookup table",
+    )
     localize_parser.add_argument(
         "-g", "--gradient", type=int, default=5000, help="minimum net gradient"
     )
@@ -1307,6 +1433,19 @@ def main():
             " specified by a unix style path pattern"
         ),
     )
+    nneighbor_parser.add_argument(
+        "-k",
+        type=int,
+        default=1,
+        help="number of nearest neighbors (one column each)",
+    )
+    nneighbor_parser.add_argument(
+        "-p",
+        "--pixelsize",
+        type=float,
+        default=None,
+        help="pixel size in nm to calculate 3D distances with z",
+    )
 
     # render
     render_parser = subparsers.add_parser(
@@ -1370,6 +1509,80 @@ def main():
         action="store_true",
         help="do not open the image file",
     )
+    render_parser.add_argument(
+        "-t",
+        "--tiff",
+        action="store_true",
+        help=(
+            "render tile by tile to a tiled BigTIFF file with pyramid levels"
+            " (intensities without colormap, for images too large for memory)"
+        ),
+    )
+
+    # timelapse
+    timelapse_parser = subparsers.add_parser(
+        "timelapse",
+        help="render localizations over time to a multi-page TIFF file",
+    )
+    timelapse_parser.add_argument(
+        "files",
+        help=(
+            "one or multiple localization files"
+            " specified by a unix style path pattern"
+        ),
+    )
+    timelapse_parser.add_argument(
+        "step", type=int, help="number of frames per time step"
+    )
+    timelapse_parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        default=None,
+        help=(
+            "render the localizations of the last frames of this number"
+            " instead of all previous frames"
+        ),
+    )
+    timelapse_parser.add_argument(
+        "-o",
+        "--oversampling",
+        type=float,
+        default=1.0,
+        help="the number of super-resolution pixels per camera pixels",
+    )
+    timelapse_parser.add_argument(
+        "-b",
+        "--blur-method",
+        choices=["none", "convolve", "gaussian"],
+        default="convolve",
+    )
+    timelapse_parser.add_argument(
+        "--min-blur-width",
+        type=float,
+        default=0.0,
+        help="minimum blur width if blur is applied",
+    )
+
+    # spatialsort
+    spatialsort_parser = subparsers.add_parser(
+        "spatialsort",
+        help="sort localizations in Morton order for faster rendering",
+    )
+    spatialsort_parser.add_argument(
+        "files",
+        help=(
+            "one or multiple localization files"
+            " specified by a unix style path pattern"
+        ),
+    )
+    spatialsort_parser.add_argument(
+        "-c",
+        "--cell-size",
+        type=float,
+        default=0.5,
+        help="cell size of the Morton order in camera pixels",
+    )
 
     # design
     subparsers.add_parser("design", help="design RRO DNA origami structures")
@@ -1432,8 +1645,17 @@ def main():
     hdf2csv_parser = subparsers.add_parser("hdf2csv")
     hdf2csv_parser.add_argument("files")
 
+    # warmup
+    subparsers.add_parser(
+        "warmup", help="compile all numerical kernels into the on-disk cache"
+    )
+
     # Parse
     args = parser.parse_args()
+    if args.compile_report:
+        from .warmup import report_compile_times
+
+        report_compile_times()
     if args.command:
         if args.command == "toraw":
             from .gui import toraw
@@ -1488,19 +1710,31 @@ def main():
                 args.parameter,
                 args.minval,
                 args.maxval,
+                args.range,
             )
         elif args.command == "undrift":
             _undrift(
                 args.files, args.segmentation, args.nodisplay, args.fromfile
             )
         elif args.command == "density":
-            _density(args.files, args.radius)
+            _density(args.files, args.radius, args.zradius)
+        elif args.command == "timelapse":
+            _timelapse(
+                args.files,
+                args.step,
+                args.window,
+                args.oversampling,
+                args.blur_method,
+                args.min_blur_width,
+            )
+        elif args.command == "spatialsort":
+            _spatialsort(args.files, args.cell_size)
         elif args.command == "dbscan":
             _dbscan(args.files, args.radius, args.density)
         elif args.command == "hdbscan":
             _hdbscan(args.files, args.min_cluster, args.min_samples)
         elif args.command == "nneighbor":
-            _nneighbor(args.files)
+            _nneighbor(args.files, args.k, args.pixelsize)
         elif args.command == "dark":
             _dark(args.files)
         elif args.command == "align":
@@ -1510,7 +1744,14 @@ def main():
         elif args.command == "groupprops":
             _groupprops(args.files)
         elif args.command == "pc":
-            _pair_correlation(args.files, args.binsize, args.rmax)
+            _pair_correlation(
+                args.files,
+                args.binsize,
+                args.rmax,
+                args.cross,
+                args.pixelsize,
+                args.edge,
+            )
         elif args.command == "simulate":
             from .gui import simulate
 
@@ -1525,6 +1766,8 @@ def main():
             _csv2hdf(args.files, args.pixelsize)
         elif args.command == "hdf2csv":
             _hdf2csv(args.files)
+        elif args.command == "warmup":
+            _warmup()
     else:
         parser.print_help()
 
@@ -10,14 +10,12 @@
 
 from scipy import optimize as _optimize
 import numpy as _np
-from tqdm import tqdm as _tqdm
 import numba as _numba
-import multiprocessing as _multiprocessing
 from concurrent import futures as _futures
 from . import postprocess as _postprocess
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum(spot, size):
     _sum_ = 0.0
     for i in range(size):
@@ -35,35 +33,40 @@ def fit_spot(spot):
     return result
 
 
-def fit_spots(spots):
-    theta = _np.empty((len(spots), 6), dtype=_np.float32)
-    theta.fill(_np.nan)
-    for i, spot in enumerate(spots):
-        theta[i] = fit_spot(spot)
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _fit_spots(spots):
+    n_spots, size, _ = spots.shape
+    theta = _np.empty((n_spots, 6), dtype=_np.float32)
+    for i in _numba.prange(n_spots):
+        avg_roi = _sum(spots[i], size)
+        # result is [x, y, photons, bg, sx, sy]
+        theta[i, 0] = 0
+        theta[i, 1] = 0
+        theta[i, 2] = avg_roi
+        theta[i, 3] = avg_roi
+        theta[i, 4] = 1
+        theta[i, 5] = 1
     return theta
 
 
+def fit_spots(spots):
+    if len(spots) == 0:
+        return _np.empty((0, 6), dtype=_np.float32)
+    return _fit_spots(spots)
+
+
 def fit_spots_parallel(spots, asynch=False):
-    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
-    n_spots = len(spots)
-    n_tasks = 100 * n_workers
-    spots_per_task = [
-        int(n_spots / n_tasks + 1)
-        if _ < n_spots % n_tasks
-        else int(n_spots / n_tasks)
-        for _ in range(n_tasks)
-    ]
-    start_indices = _np.cumsum([0] + spots_per_task[:-1])
-    fs = []
-    executor = _futures.ProcessPoolExecutor(n_workers)
-    for i, n_spots_task in zip(start_indices, spots_per_task):
-        fs.append(executor.submit(fit_spots, spots[i: i + n_spots_task]))
+    """
+    The spot sums are computed in a single parallel numba kernel.
+    With asynch=True, the kernel runs in a background thread
+    and a list with its future is returned.
+    """
     if asynch:
-        return fs
-    with _tqdm(total=n_tasks, unit="task") as progress_bar:
-        for f in _futures.as_completed(fs):
-            progress_bar.update()
-    return fits_from_futures(fs)
+        executor = _futures.ThreadPoolExecutor(1)
+        f = executor.submit(fit_spots, spots)
+        executor.shutdown(wait=False)
+        return [f]
+    return fit_spots(spots)
 
 
 def fits_from_futures(futures):
@@ -25,7 +25,7 @@ except ImportError:
     gpufit_installed = False
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _gaussian(mu, sigma, grid):
     norm = 0.3989422804014327 / sigma
     return norm * _np.exp(-0.5 * ((grid - mu) / sigma) ** 2)
@@ -40,7 +40,7 @@ def integrated_gaussian(mu, sigma, grid):
 """
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum_and_center_of_mass(spot, size):
     x = 0.0
     y = 0.0
@@ -55,7 +55,7 @@ def _sum_and_center_of_mass(spot, size):
     return _sum_, y, x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_sigmas(spot, y, x, sum, size):
     sum_deviation_y = 0.0
     sum_deviation_x = 0.0
@@ -68,7 +68,7 @@ def _initial_sigmas(spot, y, x, sum, size):
     return sy, sx
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_parameters(spot, size, size_half):
     theta = _np.zeros(6, dtype=_np.float32)
     theta[3] = _np.min(spot)
@@ -102,14 +102,14 @@ def initial_parameters_gpufit(spots, size):
     return initial_parameters
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _outer(a, b, size, model, n, bg):
     for i in range(size):
         for j in range(size):
             model[i, j] = n * a[i] * b[j] + bg
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _compute_model(theta, grid, size, model_x, model_y, model):
     model_x[:] = _gaussian(
         theta[0], theta[4], grid
@@ -119,7 +119,7 @@ def _compute_model(theta, grid, size, model_x, model_y, model):
     return model
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _compute_residuals(
     theta, spot, grid, size, model_x, model_y, model, residuals
 ):
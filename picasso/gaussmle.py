@@ -13,13 +13,16 @@ import numba as _numba
 import math as _math
 import multiprocessing as _multiprocessing
 import threading as _threading
+import time as _time
 from concurrent import futures as _futures
 
 
 GAMMA = _np.array([1.0, 1.0, 0.5, 1.0, 1.0, 1.0])
+# Number of spots whose Newton iterations are advanced together
+BATCH_SIZE = 64
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum_and_center_of_mass(spot, size):
     x = 0.0
     y = 0.0
@@ -34,7 +37,7 @@ def _sum_and_center_of_mass(spot, size):
     return _sum_, y, x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def mean_filter(spot, size):
     filtered_spot = _np.zeros_like(spot)
     for k in range(size):
@@ -52,7 +55,7 @@ def mean_filter(spot, size):
     return filtered_spot
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_sigmas(spot, y, x, size):
     size_half = int(size / 2)
     sum_deviation_y = 0.0
@@ -78,7 +81,7 @@ def _initial_sigmas(spot, y, x, size):
     return sy, sx
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_parameters(spot, size):
     sum, y, x = _sum_and_center_of_mass(spot, size)
     bg = _np.min(mean_filter(spot, size))
@@ -88,7 +91,7 @@ def _initial_parameters(spot, size):
     return x, y, photons_sane, bg, sx, sy
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_theta_sigma(spot, size):
     theta = _np.zeros(5, dtype=_np.float32)
     theta[0], theta[1], theta[2], theta[3], sx, sy = _initial_parameters(
@@ -98,7 +101,7 @@ def _initial_theta_sigma(spot, size):
     return theta
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_theta_sigmaxy(spot, size):
     theta = _np.zeros(6, dtype=_np.float32)
     theta[0], theta[1], theta[2], theta[3], theta[4], theta[
@@ -107,7 +110,7 @@ def _initial_theta_sigmaxy(spot, size):
     return theta
 
 
-@_numba.vectorize(nopython=True)
+@_numba.vectorize(nopython=True, cache=True)
 def _erf(x):
     """ Currently not needed, but might be useful for a CUDA implementation """
     ax = _np.abs(x)
@@ -203,7 +206,7 @@ def _erf(x):
     return _np.sign(x)
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _gaussian_integral(x, mu, sigma):
     sq_norm = 0.70710678118654757 / sigma  # sq_norm = sqrt(0.5/sigma**2)
     d = x - mu
@@ -212,7 +215,7 @@ def _gaussian_integral(x, mu, sigma):
     )
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral(x, mu, sigma, photons, PSFc):
     d = x - mu
     a = _np.exp(-0.5 * ((d + 0.5) / sigma) ** 2)
@@ -227,7 +230,7 @@ def _derivative_gaussian_integral(x, mu, sigma, photons, PSFc):
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFc):
     ax = _np.exp(-0.5 * ((x + 0.5 - mu) / sigma) ** 2)
     bx = _np.exp(-0.5 * ((x - 0.5 - mu) / sigma) ** 2)
@@ -243,7 +246,7 @@ def _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFc):
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral_2d_sigma(
     x, y, mu, nu, sigma, photons, PSFx, PSFy
 ):
@@ -258,6 +261,274 @@ def _derivative_gaussian_integral_2d_sigma(
     return dudt, d2udt2
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fill_axis_tables(mu, sigma, n_spots, size, tables):
+    """
+    Tabulates for each pixel along one axis and each spot the pixel integral
+    of the Gaussian (row 0) and the exponential terms of its derivatives
+    with respect to the center (rows 1, 2) and the width (rows 3, 4).
+    The terms are computed with the same operations as in
+    _derivative_gaussian_integral and _derivative_gaussian_integral_1d_sigma.
+    """
+    for i in range(size):
+        for s in range(n_spots):
+            mu_ = mu[s]
+            sigma_ = sigma[s]
+            tables[0, i, s] = _gaussian_integral(i, mu_, sigma_)
+            d = i - mu_
+            a = _np.exp(-0.5 * ((d + 0.5) / sigma_) ** 2)
+            b = _np.exp(-0.5 * ((d - 0.5) / sigma_) ** 2)
+            tables[1, i, s] = a - b
+            tables[2, i, s] = (d + 0.5) * a - (d - 0.5) * b
+            ax = _np.exp(-0.5 * ((i + 0.5 - mu_) / sigma_) ** 2)
+            bx = _np.exp(-0.5 * ((i - 0.5 - mu_) / sigma_) ** 2)
+            tables[3, i, s] = ax * (i + 0.5 - mu_) - bx * (i - 0.5 - mu_)
+            tables[4, i, s] = (
+                ax * (i + 0.5 - mu_) ** 3 - bx * (i - 0.5 - mu_) ** 3
+            )
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fill_psf_table(table, t_min, t_step):
+    """
+    Evaluates half the error function (row 0) and the Gaussian (row 1)
+    of the standardized offset t = (pixel edge - center) / sigma.
+    All axis terms are sums of these two functions at the pixel edges.
+    """
+    for k in range(table.shape[1]):
+        t = t_min + k * t_step
+        table[0, k] = 0.5 * _math.erf(0.70710678118654757 * t)
+        table[1, k] = _np.exp(-0.5 * t ** 2)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _psf_table_lookup(t, table, grid):
+    """
+    Interpolates half the error function and the Gaussian at t with cubic
+    Hermite splines, whose slopes are the exact derivatives
+    G / sqrt(2 pi) and -t G. Beyond the table, both are at their limits.
+    """
+    t_min, t_step = grid[0], grid[1]
+    u = (t - t_min) / t_step
+    k = int(_np.floor(u))
+    if k < 0:
+        return -0.5, 0.0
+    if k >= table.shape[1] - 1:
+        return 0.5, 0.0
+    f = u - k
+    h00 = (1 + 2 * f) * (1 - f) ** 2
+    h10 = f * (1 - f) ** 2
+    h01 = f ** 2 * (3 - 2 * f)
+    h11 = f ** 2 * (f - 1)
+    t0 = t_min + k * t_step
+    g0 = table[1, k]
+    g1 = table[1, k + 1]
+    erf = (
+        h00 * table[0, k]
+        + h01 * table[0, k + 1]
+        + t_step * 0.3989422804014327 * (h10 * g0 + h11 * g1)
+    )
+    gauss = h00 * g0 + h01 * g1 - t_step * (
+        h10 * t0 * g0 + h11 * (t0 + t_step) * g1
+    )
+    return erf, gauss
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _interpolate_axis_tables(mu, sigma, n_spots, size, tables, table, grid):
+    """
+    Fills the axis tables from the PSF table, evaluated at the two edges
+    of each pixel. The terms with respect to the center and the width
+    (rows 2 and 3) are identical in exact arithmetic.
+    """
+    for i in range(size):
+        for s in range(n_spots):
+            d = i - mu[s]
+            erf_a, a = _psf_table_lookup((d + 0.5) / sigma[s], table, grid)
+            erf_b, b = _psf_table_lookup((d - 0.5) / sigma[s], table, grid)
+            tables[0, i, s] = erf_a - erf_b
+            tables[1, i, s] = a - b
+            tables[2, i, s] = (d + 0.5) * a - (d - 0.5) * b
+            tables[3, i, s] = tables[2, i, s]
+            tables[4, i, s] = (d + 0.5) ** 3 * a - (d - 0.5) ** 3 * b
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _axis_tables(mu, sigma, n_spots, size, tables, table, grid):
+    if table.shape[1] == 0:
+        _fill_axis_tables(mu, sigma, n_spots, size, tables)
+    else:
+        _interpolate_axis_tables(mu, sigma, n_spots, size, tables, table, grid)
+
+
+# Sampling of the PSF table in the standardized offset (pixel / sigma)
+PSF_TABLE_STEP = 1 / 64
+PSF_TABLE_RANGE = 10.0
+_psf_table = []
+
+
+def psf_table():
+    """
+    Returns the PSF table and its grid (t_min, t_step). The table is
+    computed once and is independent of the box size and sigma.
+    """
+    if not _psf_table:
+        n = int(round(2 * PSF_TABLE_RANGE / PSF_TABLE_STEP)) + 1
+        grid = _np.array([-PSF_TABLE_RANGE, PSF_TABLE_STEP])
+        table = _np.zeros((2, n), dtype=_np.float64)
+        _fill_psf_table(table, *grid)
+        _psf_table.append((table, grid))
+    return _psf_table[0]
+
+
+def _no_psf_table():
+    return _np.zeros((2, 0), dtype=_np.float64), _np.zeros(2)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _pixel_derivatives(ii, jj, s, photons, sx, sy, tx, ty):
+    PSFx = tx[0, ii, s]
+    PSFy = ty[0, jj, s]
+    sqrt_2pi = _np.sqrt(2.0 * _np.pi)
+    dx = -photons * PSFy * tx[1, ii, s] / (sqrt_2pi * sx)
+    d2x = -photons * tx[2, ii, s] * PSFy / (sqrt_2pi * sx ** 3)
+    dy = -photons * PSFx * ty[1, jj, s] / (sqrt_2pi * sy)
+    d2y = -photons * ty[2, jj, s] * PSFx / (sqrt_2pi * sy ** 3)
+    dsx = -photons * tx[3, ii, s] * PSFy / (sqrt_2pi * sx ** 2)
+    d2sx = -2.0 * dsx / sx - photons * tx[4, ii, s] * PSFy / (
+        sqrt_2pi * sx ** 5
+    )
+    dsy = -photons * ty[3, jj, s] * PSFx / (sqrt_2pi * sy ** 2)
+    d2sy = -2.0 * dsy / sy - photons * ty[4, jj, s] * PSFx / (
+        sqrt_2pi * sy ** 5
+    )
+    return PSFx, PSFy, dx, d2x, dy, d2y, dsx, d2sx, dsy, d2sy
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _derivatives_sigma(ii, jj, s, photons, sigma, tx, ty):
+    PSFx, PSFy, dx, d2x, dy, d2y, dsx, d2sx, dsy, d2sy = _pixel_derivatives(
+        ii, jj, s, photons, sigma, sigma, tx, ty
+    )
+    dudt = (
+        _np.float32(dx),
+        _np.float32(dy),
+        _np.float32(PSFx * PSFy),
+        _np.float32(1.0),
+        _np.float32(dsx + dsy),
+    )
+    d2udt2 = (
+        _np.float32(d2x),
+        _np.float32(d2y),
+        _np.float32(0.0),
+        _np.float32(0.0),
+        _np.float32(d2sx + d2sy),
+    )
+    return dudt, d2udt2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _derivatives_sigmaxy(ii, jj, s, photons, sx, sy, tx, ty):
+    PSFx, PSFy, dx, d2x, dy, d2y, dsx, d2sx, dsy, d2sy = _pixel_derivatives(
+        ii, jj, s, photons, sx, sy, tx, ty
+    )
+    dudt = (
+        _np.float32(dx),
+        _np.float32(dy),
+        _np.float32(PSFx * PSFy),
+        _np.float32(1.0),
+        _np.float32(dsx),
+        _np.float32(dsy),
+    )
+    d2udt2 = (
+        _np.float32(d2x),
+        _np.float32(d2y),
+        _np.float32(0.0),
+        _np.float32(0.0),
+        _np.float32(d2sx),
+        _np.float32(d2sy),
+    )
+    return dudt, d2udt2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _newton_terms(data, photons, bg, dudt, d2udt2, numerator, denominator, s):
+    """ Adds the contribution of one pixel to the Newton step of spot s """
+    model = photons * dudt[2] + bg
+    cf = df = 0.0
+    if model > 10e-3:
+        cf = data / model - 1
+        df = data / model ** 2
+    cf = _np.minimum(cf, 10e4)
+    df = _np.minimum(df, 10e4)
+    for ll in range(len(dudt)):
+        numerator[ll, s] += cf * dudt[ll]
+        denominator[ll, s] += cf * d2udt2[ll] - df * dudt[ll] ** 2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fisher_and_likelihood(data, photons, bg, dudt, M, s):
+    """
+    Adds the contribution of one pixel to the Fisher information matrix
+    of spot s and returns its contribution to the log-likelihood
+    """
+    n_params = len(dudt)
+    model = bg + photons * dudt[2]
+    for kk in range(n_params):
+        for ll in range(kk, n_params):
+            M[s, kk, ll] += dudt[ll] * dudt[kk] / model
+            M[s, ll, kk] = M[s, kk, ll]
+    if model > 0:
+        if data > 0:
+            return data * _np.log(model) - model - data * _np.log(data) + data
+        else:
+            return -model
+    return 0.0
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _crlb(M):
+    # Matrix inverse (CRLB=F^-1)
+    n_params = len(M)
+    Minv = _np.linalg.pinv(M)
+    CRLB = _np.zeros(n_params, dtype=_np.float32)
+    for kk in range(n_params):
+        CRLB[kk] = Minv[kk, kk]
+    return CRLB
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _compact(keep, n_active, theta, max_step, old, data, index):
+    """
+    Moves the columns of the spots that keep iterating to the front,
+    so that the loops over spots run over contiguous memory
+    """
+    n = 0
+    for s in range(n_active):
+        if keep[s]:
+            if n != s:
+                theta[:, n] = theta[:, s]
+                max_step[:, n] = max_step[:, s]
+                old[:, n] = old[:, s]
+                data[:, n] = data[:, s]
+                index[n] = index[s]
+            n += 1
+    return n
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _spot_columns(spots, start, stop):
+    """ Returns the pixels of spots start to stop-1, one column per spot """
+    n_spots = stop - start
+    size = spots.shape[1]
+    data = _np.zeros((size * size, n_spots), dtype=_np.float32)
+    for s in range(n_spots):
+        for ii in range(size):
+            for jj in range(size):
+                data[ii * size + jj, s] = spots[start + s, ii, jj]
+    return data
+
+
 def _worker(
     func,
     spots,
@@ -267,37 +538,89 @@ def _worker(
     iterations,
     eps,
     max_it,
+    table,
+    grid,
+    claimed,
     current,
     lock,
 ):
+    """
+    Fits batches of spots until all are claimed. claimed counts the
+    spots handed out to the workers, current the spots that are fitted.
+    """
     N = len(spots)
     while True:
         with lock:
-            index = current[0]
-            if index == N:
+            start = claimed[0]
+            if start == N:
                 return
-            current[0] += 1
-        func(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+            stop = min(start + BATCH_SIZE, N)
+            claimed[0] = stop
+        func(
+            spots,
+            start,
+            stop,
+            thetas,
+            CRLBs,
+            likelihoods,
+            iterations,
+            eps,
+            max_it,
+            table,
+            grid,
+        )
+        with lock:
+            current[0] += stop - start
 
 
-def gaussmle(spots, eps, max_it, method="sigma"):
+def _batch_func(method):
+    if method == "sigma":
+        return _mlefit_sigma_batch
+    elif method == "sigmaxy":
+        return _mlefit_sigmaxy_batch
+    else:
+        raise ValueError("Method not available.")
+
+
+def _table_and_grid(spots, lut):
+    if lut:
+        return psf_table()
+    return _no_psf_table()
+
+
+def gaussmle(spots, eps, max_it, method="sigma", lut=False):
+    """
+    Fits the spots with maximum likelihood estimation.
+    With lut=True, the pixel integrals and derivatives in the iterations
+    are interpolated from a precomputed PSF table (see lut_accuracy),
+    while the final CRLBs and likelihoods are computed exactly.
+    """
     N = len(spots)
     thetas = _np.zeros((N, 6), dtype=_np.float32)
     CRLBs = _np.inf * _np.ones((N, 6), dtype=_np.float32)
     likelihoods = _np.zeros(N, dtype=_np.float32)
     iterations = _np.zeros(N, dtype=_np.int32)
-    if method == "sigma":
-        func = _mlefit_sigma
-    elif method == "sigmaxy":
-        func = _mlefit_sigmaxy
-    else:
-        raise ValueError("Method not available.")
-    for i in range(N):
-        func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    func = _batch_func(method)
+    table, grid = _table_and_grid(spots, lut)
+    for start in range(0, N, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, N)
+        func(
+            spots,
+            start,
+            stop,
+            thetas,
+            CRLBs,
+            likelihoods,
+            iterations,
+            eps,
+            max_it,
+            table,
+            grid,
+        )
     return thetas, CRLBs, likelihoods, iterations
 
 
-def gaussmle_async(spots, eps, max_it, method="sigma"):
+def gaussmle_async(spots, eps, max_it, method="sigma", lut=False):
     N = len(spots)
     thetas = _np.zeros((N, 6), dtype=_np.float32)
     CRLBs = _np.inf * _np.ones((N, 6), dtype=_np.float32)
@@ -305,13 +628,10 @@ def gaussmle_async(spots, eps, max_it, method="sigma"):
     iterations = _np.zeros(N, dtype=_np.int32)
     n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
     lock = _threading.Lock()
+    claimed = [0]
     current = [0]
-    if method == "sigma":
-        func = _mlefit_sigma
-    elif method == "sigmaxy":
-        func = _mlefit_sigmaxy
-    else:
-        raise ValueError("Method not available.")
+    func = _batch_func(method)
+    table, grid = _table_and_grid(spots, lut)
     executor = _futures.ThreadPoolExecutor(n_workers)
     for i in range(n_workers):
         executor.submit(
@@ -324,332 +644,435 @@ def gaussmle_async(spots, eps, max_it, method="sigma"):
             iterations,
             eps,
             max_it,
+            table,
+            grid,
+            claimed,
             current,
             lock,
         )
     executor.shutdown(wait=False)
     # A synchronous single-threaded version for debugging:
-    # for i in range(N):
-    #     print('Spot', i)
-    #     func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    # for start in range(0, N, BATCH_SIZE):
+    #     print('Spots', start)
+    #     func(spots, start, min(start + BATCH_SIZE, N), thetas, CRLBs,
+    #          likelihoods, iterations, eps, max_it, table, grid)
     return current, thetas, CRLBs, likelihoods, iterations
 
 
-@_numba.jit(nopython=True, nogil=True)
+def lut_accuracy(spots, eps, max_it, method="sigma"):
+    """
+    Fits the spots with the exact and the PSF table path and returns a dict
+    with the maximum and median absolute deviations of the parameters,
+    the maximum relative deviation of the localization precisions,
+    the number of spots with a different iteration count
+    and the run times of both paths. The deviations are taken over the
+    spots that converged with finite CRLBs in both paths, the number
+    of the other spots is reported as "unconverged".
+    """
+    t0 = _time.perf_counter()
+    exact = gaussmle(spots, eps, max_it, method=method)
+    t1 = _time.perf_counter()
+    fast = gaussmle(spots, eps, max_it, method=method, lut=True)
+    t2 = _time.perf_counter()
+    converged = _np.ones(len(spots), dtype=bool)
+    for fit in (exact, fast):
+        converged &= fit[3] < max_it
+        converged &= _np.all(_np.isfinite(fit[1]) & (fit[1] > 0), axis=1)
+    report = {}
+    for i, name in enumerate(["x", "y", "photons", "bg", "sx", "sy"]):
+        deviation = _np.abs(exact[0][converged, i] - fast[0][converged, i])
+        report[name] = (
+            float(deviation.max(initial=0)),
+            float(_np.median(deviation)) if len(deviation) else 0.0,
+        )
+    lp_ratio = _np.sqrt(fast[1][converged, 0:2] / exact[1][converged, 0:2])
+    report["lp"] = float(_np.abs(lp_ratio - 1).max(initial=0))
+    report["iterations"] = int(_np.sum(exact[3] != fast[3]))
+    report["unconverged"] = int(_np.sum(~converged))
+    report["time exact"] = t1 - t0
+    report["time lut"] = t2 - t1
+    return report
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _mlefit_sigma(
     spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
 ):
-    n_params = 5
+    table = _np.zeros((2, 0), dtype=_np.float64)
+    _mlefit_sigma_batch(
+        spots,
+        index,
+        index + 1,
+        thetas,
+        CRLBs,
+        likelihoods,
+        iterations,
+        eps,
+        max_it,
+        table,
+        _np.zeros(2),
+    )
+
 
-    spot = spots[index]
-    size, _ = spot.shape
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _mlefit_sigma_batch(
+    spots,
+    start,
+    stop,
+    thetas,
+    CRLBs,
+    likelihoods,
+    iterations,
+    eps,
+    max_it,
+    table,
+    grid,
+):
+    """
+    Fits the spots start to stop-1 with a common sigma in x and y.
+    The Newton iterations of all spots advance together. Parameters are
+    stored with one row per parameter and one column per spot, and
+    converged spots are compacted out of the active columns.
+    Each spot goes through exactly the operations of a single spot fit.
+    """
+    n_params = 5
+    n_spots = stop - start
+    size = spots.shape[1]
 
     # theta is [x, y, N, bg, S]
-    theta = _initial_theta_sigma(spot, size)
-    max_step = _np.zeros(n_params, dtype=_np.float32)
-    max_step[0:2] = theta[4]
-    max_step[2:4] = 0.1 * theta[2:4]
-    max_step[4] = 0.2 * theta[4]
+    theta = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    max_step = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    for s in range(n_spots):
+        theta_s = _initial_theta_sigma(spots[start + s], size)
+        max_step_s = _np.zeros(n_params, dtype=_np.float32)
+        max_step_s[0:2] = theta_s[4]
+        max_step_s[2:4] = 0.1 * theta_s[2:4]
+        max_step_s[4] = 0.2 * theta_s[4]
+        theta[:, s] = theta_s
+        max_step[:, s] = max_step_s
 
     # Memory allocation
     # (we do that outside of the loops to avoid huge delays in threaded code):
-    dudt = _np.zeros(n_params, dtype=_np.float32)
-    d2udt2 = _np.zeros(n_params, dtype=_np.float32)
-    numerator = _np.zeros(n_params, dtype=_np.float32)
-    denominator = _np.zeros(n_params, dtype=_np.float32)
-
-    old_x = theta[0]
-    old_y = theta[1]
-
+    data = _spot_columns(spots, start, stop)
+    active_data = data.copy()
+    index = _np.arange(n_spots)
+    keep = _np.zeros(n_spots, dtype=_np.bool_)
+    tx = _np.zeros((5, size, n_spots), dtype=_np.float64)
+    ty = _np.zeros((5, size, n_spots), dtype=_np.float64)
+    numerator = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    denominator = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    final_theta = _np.zeros((n_params, n_spots), dtype=_np.float32)
+
+    # old x and y
+    old = _np.zeros((2, n_spots), dtype=_np.float32)
+    old[0] = theta[0]
+    old[1] = theta[1]
+
+    n_active = n_spots
     kk = 0
     while (
-        kk < max_it
+        kk < max_it and n_active > 0
     ):  # we do this instead of a for loop for the special case of max_it=0
         kk += 1
 
-        numerator[:] = 0.0
-        denominator[:] = 0.0
+        numerator[:, :n_active] = 0.0
+        denominator[:, :n_active] = 0.0
+        _axis_tables(
+            theta[0], theta[4], n_active, size, tx, table, grid
+        )
+        _axis_tables(
+            theta[1], theta[4], n_active, size, ty, table, grid
+        )
 
         for ii in range(size):
             for jj in range(size):
-                PSFx = _gaussian_integral(ii, theta[0], theta[4])
-                PSFy = _gaussian_integral(jj, theta[1], theta[4])
-
-                # Derivatives
-                dudt[0], d2udt2[0] = _derivative_gaussian_integral(
-                    ii, theta[0], theta[4], theta[2], PSFy
-                )
-                dudt[1], d2udt2[1] = _derivative_gaussian_integral(
-                    jj, theta[1], theta[4], theta[2], PSFx
-                )
-                dudt[2] = PSFx * PSFy
-                d2udt2[2] = 0.0
-                dudt[3] = 1.0
-                d2udt2[3] = 0.0
-                dudt[4], d2udt2[4] = _derivative_gaussian_integral_2d_sigma(
-                    ii, jj, theta[0], theta[1], theta[4], theta[2], PSFx, PSFy
-                )
+                pixel = ii * size + jj
+                for s in range(n_active):
+                    dudt, d2udt2 = _derivatives_sigma(
+                        ii, jj, s, theta[2, s], theta[4, s], tx, ty
+                    )
+                    _newton_terms(
+                        active_data[pixel, s],
+                        theta[2, s],
+                        theta[3, s],
+                        dudt,
+                        d2udt2,
+                        numerator,
+                        denominator,
+                        s,
+                    )
 
-                model = theta[2] * dudt[2] + theta[3]
-                cf = df = 0.0
-                data = spot[ii, jj]
-                if model > 10e-3:
-                    cf = data / model - 1
-                    df = data / model ** 2
-                cf = _np.minimum(cf, 10e4)
-                df = _np.minimum(df, 10e4)
-
-                for ll in range(n_params):
-                    numerator[ll] += cf * dudt[ll]
-                    denominator[ll] += cf * d2udt2[ll] - df * dudt[ll] ** 2
-
-        # The update
-        for ll in range(n_params):
-            if denominator[ll] == 0.0:
-                update = _np.sign(numerator[ll] * max_step[ll])
+        for s in range(n_active):
+            # The update
+            for ll in range(n_params):
+                if denominator[ll, s] == 0.0:
+                    update = _np.sign(numerator[ll, s] * max_step[ll, s])
+                else:
+                    update = _np.minimum(
+                        _np.maximum(
+                            numerator[ll, s] / denominator[ll, s],
+                            -max_step[ll, s],
+                        ),
+                        max_step[ll, s],
+                    )
+                if kk < 5:
+                    update *= GAMMA[ll]
+                theta[ll, s] -= update
+
+            # Other constraints
+            theta[2, s] = _np.maximum(theta[2, s], 1.0)
+            theta[3, s] = _np.maximum(theta[3, s], 0.01)
+            theta[4, s] = _np.maximum(theta[4, s], 0.01)
+            theta[4, s] = _np.minimum(theta[4, s], size)
+
+            # Check for convergence
+            if (_np.abs(old[0, s] - theta[0, s]) < eps) and (
+                _np.abs(old[1, s] - theta[1, s]) < eps
+            ):
+                keep[s] = False
+                iterations[start + index[s]] = kk
+                final_theta[:, index[s]] = theta[:, s]
             else:
-                update = _np.minimum(
-                    _np.maximum(
-                        numerator[ll] / denominator[ll], -max_step[ll]
-                    ),
-                    max_step[ll],
-                )
-            if kk < 5:
-                update *= GAMMA[ll]
-            theta[ll] -= update
-
-        # Other constraints
-        theta[2] = _np.maximum(theta[2], 1.0)
-        theta[3] = _np.maximum(theta[3], 0.01)
-        theta[4] = _np.maximum(theta[4], 0.01)
-        theta[4] = _np.minimum(theta[4], size)
-
-        # Check for convergence
-        if (_np.abs(old_x - theta[0]) < eps) and (
-            _np.abs(old_y - theta[1]) < eps
-        ):
-            break
-        else:
-            old_x = theta[0]
-            old_y = theta[1]
+                keep[s] = True
+                old[0, s] = theta[0, s]
+                old[1, s] = theta[1, s]
 
-    thetas[index, 0:5] = theta
-    thetas[index, 5] = theta[4]
-    iterations[index] = kk
+        n_active = _compact(
+            keep, n_active, theta, max_step, old, active_data, index
+        )
+
+    for s in range(n_active):
+        iterations[start + index[s]] = kk
+        final_theta[:, index[s]] = theta[:, s]
+
+    for s in range(n_spots):
+        thetas[start + s, 0:5] = final_theta[:, s]
+        thetas[start + s, 5] = final_theta[4, s]
 
     # Calculating the CRLB and LogLikelihood
-    Div = 0.0
-    M = _np.zeros((n_params, n_params), dtype=_np.float32)
+    _fill_axis_tables(final_theta[0], final_theta[4], n_spots, size, tx)
+    _fill_axis_tables(final_theta[1], final_theta[4], n_spots, size, ty)
+    Div = _np.zeros(n_spots, dtype=_np.float64)
+    M = _np.zeros((n_spots, n_params, n_params), dtype=_np.float32)
     for ii in range(size):
         for jj in range(size):
-            PSFx = _gaussian_integral(ii, theta[0], theta[4])
-            PSFy = _gaussian_integral(jj, theta[1], theta[4])
-            model = theta[3] + theta[2] * PSFx * PSFy
-
-            # Calculating derivatives
-            dudt[0], d2udt2[0] = _derivative_gaussian_integral(
-                ii, theta[0], theta[4], theta[2], PSFy
-            )
-            dudt[1], d2udt2[1] = _derivative_gaussian_integral(
-                jj, theta[1], theta[4], theta[2], PSFx
-            )
-            dudt[4], d2udt2[4] = _derivative_gaussian_integral_2d_sigma(
-                ii, jj, theta[0], theta[1], theta[4], theta[2], PSFx, PSFy
-            )
-            dudt[2] = PSFx * PSFy
-            dudt[3] = 1.0
-
-            # Building the Fisher Information Matrix
-            model = theta[3] + theta[2] * dudt[2]
-            for kk in range(n_params):
-                for ll in range(kk, n_params):
-                    M[kk, ll] += dudt[ll] * dudt[kk] / model
-                    M[ll, kk] = M[kk, ll]
-
-            # LogLikelihood
-            if model > 0:
-                data = spot[ii, jj]
-                if data > 0:
-                    Div += (
-                        data * _np.log(model)
-                        - model
-                        - data * _np.log(data)
-                        + data
-                    )
-                else:
-                    Div += -model
-
-    likelihoods[index] = Div
-
-    # Matrix inverse (CRLB=F^-1)
-    Minv = _np.linalg.pinv(M)
-    CRLB = _np.zeros(n_params, dtype=_np.float32)
-    for kk in range(n_params):
-        CRLB[kk] = Minv[kk, kk]
-    CRLBs[index, 0:5] = CRLB
-    CRLBs[index, 5] = CRLB[4]
+            pixel = ii * size + jj
+            for s in range(n_spots):
+                dudt, d2udt2 = _derivatives_sigma(
+                    ii, jj, s, final_theta[2, s], final_theta[4, s], tx, ty
+                )
+                Div[s] += _fisher_and_likelihood(
+                    data[pixel, s],
+                    final_theta[2, s],
+                    final_theta[3, s],
+                    dudt,
+                    M,
+                    s,
+                )
+    for s in range(n_spots):
+        likelihoods[start + s] = Div[s]
+        CRLB = _crlb(M[s])
+        CRLBs[start + s, 0:5] = CRLB
+        CRLBs[start + s, 5] = CRLB[4]
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _mlefit_sigmaxy(
     spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
 ):
-    n_params = 6
+    table = _np.zeros((2, 0), dtype=_np.float64)
+    _mlefit_sigmaxy_batch(
+        spots,
+        index,
+        index + 1,
+        thetas,
+        CRLBs,
+        likelihoods,
+        iterations,
+        eps,
+        max_it,
+        table,
+        _np.zeros(2),
+    )
+
 
-    spot = spots[index]
-    size, _ = spot.shape
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _mlefit_sigmaxy_batch(
+    spots,
+    start,
+    stop,
+    thetas,
+    CRLBs,
+    likelihoods,
+    iterations,
+    eps,
+    max_it,
+    table,
+    grid,
+):
+    """ As _mlefit_sigma_batch, with independent sigmas in x and y """
+    n_params = 6
+    n_spots = stop - start
+    size = spots.shape[1]
 
     # Initial values
     # theta is [x, y, N, bg, Sx, Sy]
-    theta = _initial_theta_sigmaxy(spot, size)
-    max_step = _np.zeros(n_params, dtype=_np.float32)
-    max_step[0:2] = theta[4]
-    max_step[2:4] = 0.1 * theta[2:4]
-    max_step[4:6] = 0.2 * theta[4:6]
+    theta = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    max_step = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    for s in range(n_spots):
+        theta_s = _initial_theta_sigmaxy(spots[start + s], size)
+        max_step_s = _np.zeros(n_params, dtype=_np.float32)
+        max_step_s[0:2] = theta_s[4]
+        max_step_s[2:4] = 0.1 * theta_s[2:4]
+        max_step_s[4:6] = 0.2 * theta_s[4:6]
+        theta[:, s] = theta_s
+        max_step[:, s] = max_step_s
 
     # Memory allocation
     # (we do that outside of the loops to avoid huge delays in threaded code):
-    dudt = _np.zeros(n_params, dtype=_np.float32)
-    d2udt2 = _np.zeros(n_params, dtype=_np.float32)
-    numerator = _np.zeros(n_params, dtype=_np.float32)
-    denominator = _np.zeros(n_params, dtype=_np.float32)
-
-    old_x = theta[0]
-    old_y = theta[1]
-    old_sx = theta[4]
-    old_sy = theta[5]
-
+    data = _spot_columns(spots, start, stop)
+    active_data = data.copy()
+    index = _np.arange(n_spots)
+    keep = _np.zeros(n_spots, dtype=_np.bool_)
+    tx = _np.zeros((5, size, n_spots), dtype=_np.float64)
+    ty = _np.zeros((5, size, n_spots), dtype=_np.float64)
+    numerator = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    denominator = _np.zeros((n_params, n_spots), dtype=_np.float32)
+    final_theta = _np.zeros((n_params, n_spots), dtype=_np.float32)
+
+    # old x, y, sx and sy
+    old = _np.zeros((4, n_spots), dtype=_np.float32)
+    old[0] = theta[0]
+    old[1] = theta[1]
+    old[2] = theta[4]
+    old[3] = theta[5]
+
+    n_active = n_spots
     kk = 0
     while (
-        kk < max_it
+        kk < max_it and n_active > 0
     ):  # we do this instead of a for loop for the special case of max_it=0
         kk += 1
 
-        numerator[:] = 0.0
-        denominator[:] = 0.0
+        numerator[:, :n_active] = 0.0
+        denominator[:, :n_active] = 0.0
+        _axis_tables(
+            theta[0], theta[4], n_active, size, tx, table, grid
+        )
+        _axis_tables(
+            theta[1], theta[5], n_active, size, ty, table, grid
+        )
 
         for ii in range(size):
             for jj in range(size):
-                PSFx = _gaussian_integral(ii, theta[0], theta[4])
-                PSFy = _gaussian_integral(jj, theta[1], theta[5])
-                # Derivatives
-                dudt[0], d2udt2[0] = _derivative_gaussian_integral(
-                    ii, theta[0], theta[4], theta[2], PSFy
-                )
-                dudt[1], d2udt2[1] = _derivative_gaussian_integral(
-                    jj, theta[1], theta[5], theta[2], PSFx
-                )
-                dudt[2] = PSFx * PSFy
-                d2udt2[2] = 0.0
-                dudt[3] = 1.0
-                d2udt2[3] = 0.0
-                dudt[4], d2udt2[4] = _derivative_gaussian_integral_1d_sigma(
-                    ii, theta[0], theta[4], theta[2], PSFy
-                )
-                dudt[5], d2udt2[5] = _derivative_gaussian_integral_1d_sigma(
-                    jj, theta[1], theta[5], theta[2], PSFx
-                )
+                pixel = ii * size + jj
+                for s in range(n_active):
+                    dudt, d2udt2 = _derivatives_sigmaxy(
+                        ii,
+                        jj,
+                        s,
+                        theta[2, s],
+                        theta[4, s],
+                        theta[5, s],
+                        tx,
+                        ty,
+                    )
+                    _newton_terms(
+                        active_data[pixel, s],
+                        theta[2, s],
+                        theta[3, s],
+                        dudt,
+                        d2udt2,
+                        numerator,
+                        denominator,
+                        s,
+                    )
+
+        for s in range(n_active):
+            # The update
+            for ll in range(n_params):
+                if denominator[ll, s] == 0.0:
+                    # This is case is not handled in Lidke's code
+                    # but it seems to be a problem here
+                    # (maybe due to many iterations)
+                    theta[ll, s] -= (
+                        GAMMA[ll]
+                        * _np.sign(numerator[ll, s])
+                        * max_step[ll, s]
+                    )
+                else:
+                    theta[ll, s] -= GAMMA[ll] * _np.minimum(
+                        _np.maximum(
+                            numerator[ll, s] / denominator[ll, s],
+                            -max_step[ll, s],
+                        ),
+                        max_step[ll, s],
+                    )
 
-                model = theta[2] * dudt[2] + theta[3]
-                cf = df = 0.0
-                data = spot[ii, jj]
-                if model > 10e-3:
-                    cf = data / model - 1
-                    df = data / model ** 2
-                cf = _np.minimum(cf, 10e4)
-                df = _np.minimum(df, 10e4)
-
-                for ll in range(n_params):
-                    numerator[ll] += cf * dudt[ll]
-                    denominator[ll] += cf * d2udt2[ll] - df * dudt[ll] ** 2
-
-        # The update
-        for ll in range(n_params):
-            if denominator[ll] == 0.0:
-                # This is case is not handled in Lidke's code
-                # but it seems to be a problem here
-                # (maybe due to many iterations)
-                theta[ll] -= GAMMA[ll] * _np.sign(numerator[ll]) * max_step[ll]
+            # Other constraints
+            theta[2, s] = _np.maximum(theta[2, s], 1.0)
+            theta[3, s] = _np.maximum(theta[3, s], 0.01)
+            theta[4, s] = _np.maximum(theta[4, s], 0.01)
+            theta[5, s] = _np.maximum(theta[5, s], 0.01)
+
+            # Check for convergence
+            if (
+                (_np.abs(old[0, s] - theta[0, s]) < eps)
+                and (_np.abs(old[1, s] - theta[1, s]) < eps)
+                and (_np.abs(old[2, s] - theta[4, s]) < eps)
+                and (_np.abs(old[3, s] - theta[5, s]) < eps)
+            ):
+                keep[s] = False
+                iterations[start + index[s]] = kk
+                final_theta[:, index[s]] = theta[:, s]
             else:
-                theta[ll] -= GAMMA[ll] * _np.minimum(
-                    _np.maximum(
-                        numerator[ll] / denominator[ll], -max_step[ll]
-                    ),
-                    max_step[ll],
-                )
+                keep[s] = True
+                old[0, s] = theta[0, s]
+                old[1, s] = theta[1, s]
+                old[2, s] = theta[4, s]
+                old[3, s] = theta[5, s]
+
+        n_active = _compact(
+            keep, n_active, theta, max_step, old, active_data, index
+        )
+
+    for s in range(n_active):
+        iterations[start + index[s]] = kk
+        final_theta[:, index[s]] = theta[:, s]
 
-        # Other constraints
-        theta[2] = _np.maximum(theta[2], 1.0)
-        theta[3] = _np.maximum(theta[3], 0.01)
-        theta[4] = _np.maximum(theta[4], 0.01)
-        theta[5] = _np.maximum(theta[5], 0.01)
-
-        # Check for convergence
-        if _np.abs(old_x - theta[0]) < eps:
-            if _np.abs(old_y - theta[1]) < eps:
-                if _np.abs(old_sx - theta[4]) < eps:
-                    if _np.abs(old_sy - theta[5]) < eps:
-                        break
-        old_x = theta[0]
-        old_y = theta[1]
-        old_sx = theta[4]
-        old_sy = theta[5]
-    thetas[index] = theta
-    iterations[index] = kk
+    for s in range(n_spots):
+        thetas[start + s] = final_theta[:, s]
 
     # Calculating the CRLB and LogLikelihood
-    Div = 0.0
-    M = _np.zeros((n_params, n_params), dtype=_np.float32)
+    _fill_axis_tables(final_theta[0], final_theta[4], n_spots, size, tx)
+    _fill_axis_tables(final_theta[1], final_theta[5], n_spots, size, ty)
+    Div = _np.zeros(n_spots, dtype=_np.float64)
+    M = _np.zeros((n_spots, n_params, n_params), dtype=_np.float32)
     for ii in range(size):
         for jj in range(size):
-            PSFx = _gaussian_integral(ii, theta[0], theta[4])
-            PSFy = _gaussian_integral(jj, theta[1], theta[5])
-            model = theta[3] + theta[2] * PSFx * PSFy
-
-            # Calculating derivatives
-            dudt[0], d2udt2[0] = _derivative_gaussian_integral(
-                ii, theta[0], theta[4], theta[2], PSFy
-            )
-            dudt[1], d2udt2[1] = _derivative_gaussian_integral(
-                jj, theta[1], theta[5], theta[2], PSFx
-            )
-            dudt[4], d2udt2[4] = _derivative_gaussian_integral_1d_sigma(
-                ii, theta[0], theta[4], theta[2], PSFy
-            )
-            dudt[5], d2udt2[5] = _derivative_gaussian_integral_1d_sigma(
-                jj, theta[1], theta[5], theta[2], PSFx
-            )
-            dudt[2] = PSFx * PSFy
-            dudt[3] = 1.0
-
-            # Building the Fisher Information Matrix
-            model = theta[3] + theta[2] * dudt[2]
-            for kk in range(n_params):
-                for ll in range(kk, n_params):
-                    M[kk, ll] += dudt[ll] * dudt[kk] / model
-                    M[ll, kk] = M[kk, ll]
-
-            # LogLikelihood
-            if model > 0:
-                data = spot[ii, jj]
-                if data > 0:
-                    Div += (
-                        data * _np.log(model)
-                        - model
-                        - data * _np.log(data)
-                        + data
-                    )
-                else:
-                    Div += -model
-
-    likelihoods[index] = Div
-
-    # Matrix inverse (CRLB=F^-1)
-    Minv = _np.linalg.pinv(M)
-    CRLB = _np.zeros(n_params, dtype=_np.float32)
-    for kk in range(n_params):
-        CRLB[kk] = Minv[kk, kk]
-    CRLBs[index] = CRLB
+            pixel = ii * size + jj
+            for s in range(n_spots):
+                dudt, d2udt2 = _derivatives_sigmaxy(
+                    ii,
+                    jj,
+                    s,
+                    final_theta[2, s],
+                    final_theta[4, s],
+                    final_theta[5, s],
+                    tx,
+                    ty,
+                )
+                Div[s] += _fisher_and_likelihood(
+                    data[pixel, s],
+                    final_theta[2, s],
+                    final_theta[3, s],
+                    dudt,
+                    M,
+                    s,
+                )
+    for s in range(n_spots):
+        likelihoods[start + s] = Div[s]
+        CRLBs[start + s] = _crlb(M[s])
 
 
 def locs_from_fits(
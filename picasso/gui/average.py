@@ -21,6 +21,8 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 
 from .. import io, lib, render
 
+plt.style.use("ggplot")
+
 
 @numba.jit(nopython=True, nogil=True)
 def render_hist(x, y, oversampling, t_min, t_max):
@@ -30,6 +30,8 @@ from tqdm import tqdm
 
 import scipy.ndimage.filters
 
+plt.style.use("ggplot")
+
 DEFAULT_OVERSAMPLING = 1.0
 INITIAL_REL_MAXIMUM = 2.0
 ZOOM = 10 / 7
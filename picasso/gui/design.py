@@ -26,6 +26,8 @@ from .. import io as _io
 from .. import design
 from .. import lib
 
+plt.style.use("ggplot")
+
 _this_file = os.path.abspath(__file__)
 _this_directory = os.path.dirname(_this_file)
 BaseSequencesFile = os.path.join(_this_directory, "..", "base_sequences.csv")
@@ -0,0 +1,67 @@
+"""
+    gui/dialogs
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Progress and status dialogs shared by the graphical user interfaces
+
+    :author: Joerg Schnitzbauer, 2016
+    :copyright: Copyright (c) 2016 Jungmann Lab, MPI of Biochemistry
+"""
+
+
+from PyQt5 import QtCore, QtWidgets
+
+
+# A global variable where we store all open progress and status dialogs.
+# In case of an exception, we close them all,
+# so that the GUI remains responsive.
+_dialogs = []
+
+
+class ProgressDialog(QtWidgets.QProgressDialog):
+    def __init__(self, description, minimum, maximum, parent):
+        super().__init__(
+            description,
+            None,
+            minimum,
+            maximum,
+            parent,
+            QtCore.Qt.CustomizeWindowHint,
+        )
+        _dialogs.append(self)
+        self.setMinimumDuration(500)
+        self.setModal(True)
+        self.app = QtCore.QCoreApplication.instance()
+
+    def set_value(self, value):
+        self.setValue(value)
+        self.app.processEvents()
+
+    def closeEvent(self, event):
+        _dialogs.remove(self)
+
+
+class StatusDialog(QtWidgets.QDialog):
+    def __init__(self, description, parent):
+        super(StatusDialog, self).__init__(
+            parent, QtCore.Qt.CustomizeWindowHint
+        )
+        _dialogs.append(self)
+        vbox = QtWidgets.QVBoxLayout(self)
+        label = QtWidgets.QLabel(description)
+        vbox.addWidget(label)
+        self.show()
+        QtCore.QCoreApplication.instance().processEvents()
+
+    def closeEvent(self, event):
+        _dialogs.remove(self)
+
+
+def cancel_dialogs():
+    dialogs = [_ for _ in _dialogs]
+    for dialog in dialogs:
+        if isinstance(dialog, ProgressDialog):
+            dialog.cancel()
+        else:
+            dialog.close()
+    QtCore.QCoreApplication.instance().processEvents()  # just in case...
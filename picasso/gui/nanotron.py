@@ -36,6 +36,8 @@ from PyQt5.QtGui import QIcon
 
 from .. import io, lib, render, nanotron
 
+plt.style.use("ggplot")
+
 DEFAULT_MODEL_PATH = _ospath.join(os.sep, 'picasso', 'model', 'default_model.sav')
 default_model = False
 
@@ -82,14 +84,16 @@ class Generator(QtCore.QThread):
             n_locs = locs.group.max()
 
             export_path = _ospath.dirname(self.export_paths[id]) + "/"
+            index = lib.group_index(locs)
 
-            for c, pick in enumerate(tqdm(np.unique(locs.group),
+            for c, pick in enumerate(tqdm(index.groups,
                                      desc="Prepare class " + str(label))):
 
                 pick_img = nanotron.roi_to_img(locs=locs,
                                                pick=pick,
                                                radius=self.pick_radius,
-                                               oversampling=self.oversampling)
+                                               oversampling=self.oversampling,
+                                               index=index)
 
                 if self.export is True and pick < 10:
                     filename = str(label).replace(" ", "_").lower() + "-" + str(pick)
@@ -216,7 +220,7 @@ class Predictor(QtCore.QThread):
         n = len(l) - 1
         return (sum(np.diff(sorted(l)) == 1) >= n)
 
-    def _worker(self, mlp, locs, picks, pick_radius,
+    def _worker(self, mlp, locs, group_index, picks, pick_radius,
                 oversampling, current, lock, n_picks,
                 predicitions, probabilities, finished):
 
@@ -228,11 +232,14 @@ class Predictor(QtCore.QThread):
                 current[0] += 1
 
             pick = picks[index]
-            pred, pred_proba = nanotron.predict_structure(mlp=mlp,
-                                                 locs=locs,
-                                                 pick=pick,
-                                                 pick_radius=pick_radius,
-                                                 oversampling=oversampling)
+            pred, pred_proba = nanotron.predict_structure(
+                mlp=mlp,
+                locs=locs,
+                pick=pick,
+                pick_radius=pick_radius,
+                oversampling=oversampling,
+                index=group_index,
+            )
             predicitions[index] = pred[0]
             probabilities[index] = pred_proba.max()
 
@@ -248,6 +255,9 @@ class Predictor(QtCore.QThread):
 
         lock = threading.Lock()
 
+        # Look up the locs of each pick without scanning all locs
+        group_index = lib.group_index(locs)
+
         n_workers = multiprocessing.cpu_count()
 
         current = [0]
@@ -258,6 +268,7 @@ class Predictor(QtCore.QThread):
                 self._worker,
                 model,
                 locs,
+                group_index,
                 picks,
                 pick_radius,
                 oversampling,
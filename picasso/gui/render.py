@@ -14,6 +14,7 @@ import traceback
 from math import ceil
 import copy
 import time
+import weakref
 
 import lmfit
 import matplotlib
@@ -34,7 +35,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.cluster import KMeans
 from mpl_toolkits.mplot3d import axes3d
-from collections import Counter
+from collections import Counter, OrderedDict
 from h5py import File
 from tqdm import tqdm
 
@@ -42,11 +43,26 @@ import colorsys
 
 from .. import imageprocess, io, lib, postprocess, render
 
+plt.style.use("ggplot")
+
 DEFAULT_OVERSAMPLING = 1.0
 INITIAL_REL_MAXIMUM = 0.5
 ZOOM = 10 / 7
 N_GROUP_COLORS = 8
 N_Z_COLORS = 32
+# Memory (bytes) of the rendered volumes of the slicer that are kept
+SLICER_VOLUME_BYTES = 512 * 1024 ** 2
+# Memory (bytes) of the renderings of channels that are kept for reuse
+RENDER_CACHE_BYTES = 512 * 1024 ** 2
+CHANNEL_COLORS = {
+    "red": (1, 0, 0),
+    "green": (0, 1, 0),
+    "blue": (0, 0, 1),
+    "gray": (1, 1, 1),
+    "cyan": (0, 1, 1),
+    "magenta": (1, 0, 1),
+    "yellow": (1, 1, 0),
+}
 
 matplotlib.rcParams.update({"axes.titlesize": "large"})
 
@@ -2226,6 +2242,8 @@ class SlicerDialog(QtWidgets.QDialog):
         self.slicerRadioButton.stateChanged.connect(self.toggle_slicer)
 
         self.zcoord = []
+        self.slicer_cache = {}
+        self.slicer_volumes = OrderedDict()
         self.seperateCheck = QtWidgets.QCheckBox("Export channels separate")
         self.fullCheck = QtWidgets.QCheckBox("Export full image")
         self.exportButton = QtWidgets.QPushButton("Export Slices")
@@ -2277,9 +2295,11 @@ class SlicerDialog(QtWidgets.QDialog):
         self.sl.setValue(len(self.bins) / 2)
 
         self.slicer_cache = {}
+        self.slicer_volumes = OrderedDict()
 
     def on_pick_slice_changed(self):
         self.slicer_cache = {}
+        self.slicer_volumes = OrderedDict()
         if len(self.bins) < 3:  # in case there should be only 1 bin
             self.calculate_histogram()
         else:
@@ -2424,6 +2444,13 @@ class View(QtWidgets.QLabel):
         self._picks = []
         self._points = []
         self.index_blocks = []
+        self.pyramids = {}
+        self.spatial_indices = {}
+        self.compact_locs = {}
+        self._bgra = None
+        self._luts = {}
+        self.locs_versions = {}
+        self.render_cache = OrderedDict()
         self._drift = []
         self._driftfiles = []
         self.currentdrift = []
@@ -2453,6 +2480,19 @@ class View(QtWidgets.QLabel):
         self.infos.append(info)
         self.locs_paths.append(path)
         self.index_blocks.append(None)
+        self.compact(len(self.locs) - 1)
+        if io.load_frame_order(path) is not None:
+            # Locs in Morton order (e.g. from picasso spatialsort)
+            cell_size = lib.MORTON_CELL_SIZE
+            for element in info:
+                if element.get("Order") == "Morton":
+                    cell_size = element.get("Cell Size", cell_size)
+            index = lib.spatial_index(locs, cell_size)
+            if index is not None:
+                self.spatial_indices[len(self.locs) - 1] = (
+                    weakref.ref(locs),
+                    index,
+                )
 
         drift = None
         # Try to load a driftfile:
@@ -2620,6 +2660,7 @@ class View(QtWidgets.QLabel):
                     locs_.z -= shift[2][i]
                 # Cleanup
                 self.index_blocks[i] = None
+                self.locs_changed(i)
                 sp.set_value(i + 1)
 
             self.update_scene()
@@ -2664,6 +2705,7 @@ class View(QtWidgets.QLabel):
                     if len(shift) == 3:
                         locs_.z -= shift[2][i]
                         temp_shift_z.append(shift[2][i])
+                    self.locs_changed(i)
                     sp.set_value(i + 1)
                 shift_x.append(np.mean(temp_shift_x))
                 shift_y.append(np.mean(temp_shift_y))
@@ -3772,7 +3814,6 @@ class View(QtWidgets.QLabel):
         if self._pick_shape == "Rectangle":
             raise NotImplementedError("Not implemented for rectangle picks")
         print("Calculating FRET")
-        fret_events = []
 
         channel_acceptor = self.get_channel(title="Select acceptor channel")
         channel_donor = self.get_channel(title="Select donor channel")
@@ -3780,34 +3821,27 @@ class View(QtWidgets.QLabel):
         acc_picks = self.picked_locs(channel_acceptor)
         don_picks = self.picked_locs(channel_donor)
 
-        K = len(self._picks)
-        progress = lib.ProgressDialog(
-            "Calculating fret in Picks...", 0, K, self
+        no_fret_events = (
+            "No FRET events detected. "
+            "Inspect picks with Show FRET Traces "
+            "and make sure to have FRET events."
         )
-        progress.show()
+        if not acc_picks or not don_picks:
+            raise ValueError(no_fret_events)
 
-        all_fret_locs = []
-
-        for i in range(K):
-            fret_dict, fret_locs = postprocess.calculate_fret(
-                acc_picks[i], don_picks[i]
-            )
-            if fret_dict["fret_events"] != []:
-                fret_events.append(fret_dict["fret_events"])
-            if fret_locs != []:
-                all_fret_locs.append(fret_locs)
-            progress.set_value(i + 1)
-
-        progress.close()
+        # All picks at once, with the pick index in the group field
+        acc_locs = stack_arrays(acc_picks, asrecarray=True, usemask=False)
+        don_locs = stack_arrays(don_picks, asrecarray=True, usemask=False)
+        events, fret_locs = postprocess.calculate_fret_batch(
+            acc_locs, don_locs
+        )
+        fret_events = events.fret
 
-        if fret_events == []:
-            raise ValueError(
-                "No FRET events detected. "
-                "Inspect picks with Show FRET Traces "
-                "and make sure to have FRET events.")
+        if len(fret_events) == 0:
+            raise ValueError(no_fret_events)
 
         fig1 = plt.figure()
-        plt.hist(np.hstack(fret_events), bins=np.arange(0, 1, 0.02))
+        plt.hist(fret_events, bins=np.arange(0, 1, 0.02))
         plt.title(r"Distribution of $\frac{I_A}{I_D+I_A}$")
         plt.xlabel("Ratio")
         plt.ylabel("Counts")
@@ -3826,20 +3860,18 @@ class View(QtWidgets.QLabel):
         if path:
             np.savetxt(
                 path,
-                np.hstack(fret_events),
+                fret_events,
                 fmt="%1.5f",
                 newline="\r\n",
                 delimiter="   ",
             )
 
-            locs = stack_arrays(all_fret_locs, asrecarray=True, usemask=False)
-            if locs is not None:
-                base, ext = os.path.splitext(path)
-                out_path = base + ".hdf5"
-                pick_info = {"Generated by:": "Picasso Render FRET"}
-                io.save_locs(
-                    out_path, locs, self.infos[channel_acceptor] + [pick_info]
-                )
+            base, ext = os.path.splitext(path)
+            out_path = base + ".hdf5"
+            pick_info = {"Generated by:": "Picasso Render FRET"}
+            io.save_locs(
+                out_path, fret_locs, self.infos[channel_acceptor] + [pick_info]
+            )
 
     def select_traces(self):
         print("Showing  traces")
@@ -4397,7 +4429,6 @@ class View(QtWidgets.QLabel):
             std_range = (
                 self.window.tools_settings_dialog.pick_similar_range.value()
             )
-            index_blocks = self.get_index_blocks(channel)
             n_locs = []
             rmsd = []
 
@@ -4411,10 +4442,7 @@ class View(QtWidgets.QLabel):
                 progress.show()
                 for i, pick in enumerate(self._picks):
                     x, y = pick
-                    block_locs = postprocess.get_block_locs_at(
-                        x, y, index_blocks
-                    )
-                    pick_locs = lib.locs_at(x, y, block_locs, r)
+                    pick_locs = self.locs_at(channel, x, y, r)
                     locs = stack_arrays(
                         pick_locs, asrecarray=True, usemask=False
                     )
@@ -4505,6 +4533,30 @@ class View(QtWidgets.QLabel):
             self.index_locs(channel)
         return self.index_blocks[channel]
 
+    def spatial_index(self, channel):
+        """
+        The index of the locs of a channel if they are in Morton order
+        (see lib.spatial_index), else None
+        """
+        if channel in self.spatial_indices:
+            locs_ref, index = self.spatial_indices[channel]
+            if locs_ref() is self.locs[channel]:
+                return index
+        return None
+
+    def locs_at(self, channel, x, y, r):
+        """
+        The locs of a channel within the distance r of (x, y), looked up
+        with the spatial index of the channel if it has one, else in its
+        index blocks
+        """
+        index = self.spatial_index(channel)
+        if index is not None:
+            return lib.locs_at(x, y, self.locs[channel], r, index=index)
+        index_blocks = self.get_index_blocks(channel)
+        block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
+        return lib.locs_at(x, y, block_locs, r)
+
     @check_picks
     def pick_similar(self):
         if self._pick_shape == "Rectangle":
@@ -4525,8 +4577,7 @@ class View(QtWidgets.QLabel):
             rmsd = []
             for i, pick in enumerate(self._picks):
                 x, y = pick
-                block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
-                pick_locs = lib.locs_at(x, y, block_locs, r)
+                pick_locs = self.locs_at(channel, x, y, r)
                 n_locs.append(len(pick_locs))
                 rmsd.append(self.rmsd_at_com(pick_locs))
             mean_n_locs = np.mean(n_locs)
@@ -4562,12 +4613,7 @@ class View(QtWidgets.QLabel):
                         x_grid, y_grid, size, K, L, block_starts, block_ends
                     )
                     if n_block_locs > min_n_locs:
-                        block_locs = postprocess.get_block_locs_at(
-                            x_grid, y_grid, index_blocks
-                        )
-                        picked_locs = lib.locs_at(
-                            x_grid, y_grid, block_locs, r
-                        )
+                        picked_locs = self.locs_at(channel, x_grid, y_grid, r)
                         if len(picked_locs) > 1:
                             # Move to COM peak
                             x_test_old = x_grid
@@ -4580,8 +4626,8 @@ class View(QtWidgets.QLabel):
                             ):
                                 x_test_old = x_test
                                 y_test_old = y_test
-                                picked_locs = lib.locs_at(
-                                    x_test, y_test, block_locs, r
+                                picked_locs = self.locs_at(
+                                    channel, x_test, y_test, r
                                 )
                                 x_test = picked_locs.x.mean()
                                 y_test = picked_locs.y.mean()
@@ -4619,13 +4665,9 @@ class View(QtWidgets.QLabel):
             if self._pick_shape == "Circle":
                 d = self.window.tools_settings_dialog.pick_diameter.value()
                 r = d / 2
-                index_blocks = self.get_index_blocks(channel)
                 for i, pick in enumerate(self._picks):
                     x, y = pick
-                    block_locs = postprocess.get_block_locs_at(
-                        x, y, index_blocks
-                    )
-                    group_locs = lib.locs_at(x, y, block_locs, r)
+                    group_locs = self.locs_at(channel, x, y, r)
                     if add_group:
                         group = i * np.ones(len(group_locs), dtype=np.int32)
                         group_locs = lib.append_to_rec(
@@ -4728,7 +4770,6 @@ class View(QtWidgets.QLabel):
                 cache=cache,
                 plot_channels=True,
             )
-        self._bgra[:, :, 3].fill(255)
         Y, X = self._bgra.shape[:2]
         qimage = QtGui.QImage(self._bgra.data, X, Y, QtGui.QImage.Format_RGB32)
         return qimage
@@ -4747,9 +4788,177 @@ class View(QtWidgets.QLabel):
             self.render_multi_channel(
                 kwargs, autoscale=autoscale, use_cache=use_cache, cache=cache
             )
-        self._bgra[:, :, 3].fill(255)
         return self._bgra.data
 
+    def locs_changed(self, channel):
+        """
+        Drops the renderings, the tile pyramid, the spatial index and
+        the render view of a channel after its locs were changed in place
+        """
+        self.locs_versions[channel] = self.locs_versions.get(channel, 0) + 1
+        self.pyramids.pop(channel, None)
+        self.spatial_indices.pop(channel, None)
+        self.compact_locs.pop(channel, None)
+
+    def compact(self, channel):
+        """
+        The compact render view (render.RenderLocs) of the locs of a
+        channel, which all rendering uses instead of the full locs.
+        It is built once for the locs of the channel.
+        """
+        locs = self.locs[channel]
+        if channel in self.compact_locs:
+            locs_ref, compact = self.compact_locs[channel]
+            if locs_ref() is locs:
+                return compact
+        compact = render.RenderLocs(locs)
+        self.compact_locs[channel] = (weakref.ref(locs), compact)
+        return compact
+
+    def render_channel(self, channel, kwargs, export=False):
+        """
+        Renders the locs of a channel, sliced in z if the slicer is active.
+        Renderings are cached by channel, viewport, render settings and
+        slice, and reused while the locs of the channel are the same.
+        The least recently used renderings beyond RENDER_CACHE_BYTES
+        are dropped. Exports (export=True) are not composed from the tile
+        pyramid (see render_locs).
+        """
+        locs = self.locs[channel]
+        slicer_dialog = self.window.slicer_dialog
+        z_range = None
+        if hasattr(locs, "z") and slicer_dialog.slicerRadioButton.isChecked():
+            z_range = (slicer_dialog.slicermin, slicer_dialog.slicermax)
+        (y_min, x_min), (y_max, x_max) = kwargs["viewport"]
+        key = (
+            channel,
+            (y_min, x_min, y_max, x_max),
+            kwargs["oversampling"],
+            kwargs["blur_method"],
+            kwargs["min_blur_width"],
+            z_range,
+        )
+        version = self.locs_versions.get(channel, 0)
+        if key in self.render_cache:
+            locs_ref, locs_version, rendering = self.render_cache[key]
+            if locs_ref() is locs and locs_version == version:
+                self.render_cache.move_to_end(key)
+                return rendering
+        compact = self.compact(channel)
+        if z_range is not None and not self.slice_from_volume(kwargs):
+            z_min, z_max = z_range
+            in_view = (compact.z > z_min) & (compact.z <= z_max)
+            rendering = render.render(compact[in_view], **kwargs)
+        else:
+            rendering = self.render_locs(channel, compact, kwargs, export)
+        self.render_cache[key] = (weakref.ref(locs), version, rendering)
+        n_bytes = sum(_[2][1].nbytes for _ in self.render_cache.values())
+        while n_bytes > RENDER_CACHE_BYTES and len(self.render_cache) > 1:
+            _, (_, _, dropped) = self.render_cache.popitem(last=False)
+            n_bytes -= dropped[1].nbytes
+        return rendering
+
+    def slice_from_volume(self, kwargs):
+        """
+        Whether slices of 3D locs are rendered from a Gaussian-blurred
+        volume instead of from the locs in the slice
+        """
+        return kwargs["blur_method"] in ("gaussian", "gaussian_iso")
+
+    def render_slice(self, channel, locs, kwargs):
+        """
+        Renders the current slice of the slicer from a volume of all slices
+        of the channel, which is rendered once per viewport and settings,
+        so that moving through the slices or exporting them renders once.
+        The least recently used volumes beyond SLICER_VOLUME_BYTES are
+        dropped. Slices of larger volumes (e.g. exports of the full image)
+        are rendered one at a time.
+        """
+        slicer_dialog = self.window.slicer_dialog
+        (y_min, x_min), (y_max, x_max) = kwargs["viewport"]
+        oversampling = kwargs["oversampling"]
+        pixelsize = self.window.display_settings_dlg.pixelsize.value()
+        position = slicer_dialog.slicerposition
+        z_edges = slicer_dialog.bins
+        n_pixel_y = int(np.ceil(oversampling * (y_max - y_min)))
+        n_pixel_x = int(np.ceil(oversampling * (x_max - x_min)))
+        n_bytes = 4 * (len(z_edges) - 1) * n_pixel_y * n_pixel_x
+
+        def render_volume(z_edges):
+            return render.render_gaussian3d(
+                locs,
+                oversampling,
+                y_min,
+                x_min,
+                y_max,
+                x_max,
+                z_edges,
+                pixelsize,
+                min_blur_width=kwargs["min_blur_width"],
+                iso=kwargs["blur_method"] == "gaussian_iso",
+            )
+
+        if n_bytes > SLICER_VOLUME_BYTES:
+            n_locs, volume = render_volume(z_edges[position: position + 2])
+            return n_locs[0], volume[0]
+        key = (
+            channel,
+            (y_min, x_min, y_max, x_max),
+            oversampling,
+            kwargs["blur_method"],
+            kwargs["min_blur_width"],
+        )
+        volumes = slicer_dialog.slicer_volumes
+        if key in volumes:
+            volumes.move_to_end(key)
+        else:
+            volumes[key] = render_volume(z_edges)
+            n_bytes = sum(_[1].nbytes for _ in volumes.values())
+            while n_bytes > SLICER_VOLUME_BYTES:
+                _, (_, dropped) = volumes.popitem(last=False)
+                n_bytes -= dropped.nbytes
+        n_locs, volume = volumes[key]
+        return n_locs[position], volume[position]
+
+    def render_locs(self, channel, locs, kwargs, export=False):
+        """
+        Renders the locs (render view) of a channel with the render kwargs.
+        Displayed histograms up to the oversampling of the finest pyramid
+        level are composed from the tile pyramid of the channel (see
+        render.TilePyramid.render). Deeper zooms, blurred renderings and
+        exports render the locs in view exactly, which are looked up with
+        the spatial index of the channel if it is in Morton order.
+        All locs are rendered while the pyramid is built in the background,
+        and locs that are not the channel's (e.g. sliced in z).
+        """
+        if locs is not self.compact(channel):
+            return render.render(locs, **kwargs)
+        if (
+            hasattr(locs, "z")
+            and self.window.slicer_dialog.slicerRadioButton.isChecked()
+            and self.slice_from_volume(kwargs)
+        ):
+            return self.render_slice(channel, locs, kwargs)
+        pyramid = self.pyramids.get(channel)
+        if pyramid is None or pyramid.locs is not locs:
+            pyramid = render.TilePyramid(locs)
+            pyramid.start()
+            self.pyramids[channel] = pyramid
+        index = self.spatial_index(channel)
+        if not pyramid.is_built():
+            return render.render(locs, index=index, **kwargs)
+        if kwargs["blur_method"] is None and not export:
+            rendering = pyramid.render(
+                kwargs["oversampling"], kwargs["viewport"]
+            )
+            if rendering is not None:
+                return rendering
+        if index is not None:
+            # The locs in view are a contiguous range of the Morton order
+            return render.render(locs, index=index, **kwargs)
+        locs = pyramid.locs_in_view(kwargs["viewport"])
+        return render.render(locs, **kwargs)
+
     def render_multi_channel(
         self,
         kwargs,
@@ -4763,28 +4972,18 @@ class View(QtWidgets.QLabel):
             locs = self.locs
         # Plot each channel
         if plot_channels:
-            locsall = locs.copy()
-            for i in range(len(locs)):
-                if hasattr(locs[i], "z"):
-                    if self.window.slicer_dialog.slicerRadioButton.isChecked():
-                        z_min = self.window.slicer_dialog.slicermin
-                        z_max = self.window.slicer_dialog.slicermax
-                        in_view = (locsall[i].z > z_min) & (
-                            locsall[i].z <= z_max
-                        )
-                        locsall[i] = locsall[i][in_view]
             n_channels = len(locs)
             colors = get_colors(n_channels)
             if use_cache:
                 n_locs = self.n_locs
                 image = self.image
             else:
-                renderings = []
-                for i in range(len(self.locs)):
-                    # We render all images first
-                    # and later decide to keep them or not
-                    renderings.append(render.render(locsall[i], **kwargs))
-                renderings = [render.render(_, **kwargs) for _ in locsall]
+                # We render all images first (or take them from the
+                # render cache) and later decide to keep them or not
+                renderings = [
+                    self.render_channel(i, kwargs, export=not cache)
+                    for i in range(n_channels)
+                ]
                 n_locs = sum([_[0] for _ in renderings])
                 image = np.array([_[1] for _ in renderings])
         else:
@@ -4811,80 +5010,46 @@ class View(QtWidgets.QLabel):
             self.n_locs = n_locs
             self.image = image
 
-        image = self.scale_contrast(image)
+        lower, upper = self.contrast_limits(image)
+        colors = self.channel_colors(colors)
         Y, X = image.shape[1:]
-        bgra = np.zeros((Y, X, 4), dtype=np.float32)
+        invert = self.window.dataset_dialog.wbackground.isChecked()
+        render.composite_bgra(
+            self.bgra_buffer(Y, X), image, colors, lower, upper, invert
+        )
+        return self._bgra
 
-        # Color images
+    def channel_colors(self, colors):
+        """
+        The RGB colors of the channels (n_channels x 3) as selected in the
+        dataset dialog (or the given colors if "auto"), inverted for white
+        backgrounds and scaled by the channel intensities (0 if hidden)
+        """
+        colors = np.array(colors, dtype=np.float64)
+        dataset_dialog = self.window.dataset_dialog
         for i in range(len(self.locs)):
-            if (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "red"
-            ):
-                colors[i] = (1, 0, 0)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "green"
-            ):
-                colors[i] = (0, 1, 0)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "blue"
-            ):
-                colors[i] = (0, 0, 1)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "gray"
-            ):
-                colors[i] = (1, 1, 1)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "cyan"
-            ):
-                colors[i] = (0, 1, 1)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "magenta"
-            ):
-                colors[i] = (1, 0, 1)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                == "yellow"
-            ):
-                colors[i] = (1, 1, 0)
-            elif (
-                self.window.dataset_dialog.colorselection[i].currentText()
-                != "auto"
-            ):
-                colorstring = (
-                    self.window.dataset_dialog.colorselection[i]
-                    .currentText()
-                    .lstrip("#")
-                )
-                rgbval = tuple(
-                    int(colorstring[i: i + 2], 16) / 255 for i in (0, 2, 4)
-                )
-                colors[i] = rgbval
-
-            if self.window.dataset_dialog.wbackground.isChecked():
-                tempcolor = colors[i]
-                inverted = tuple([1 - _ for _ in tempcolor])
-                colors[i] = inverted
-
-            iscale = self.window.dataset_dialog.intensitysettings[i].value()
-            image[i] = iscale * image[i]
-            if not self.window.dataset_dialog.checks[i].isChecked():
-                image[i] = 0 * image[i]
-
-        for color, image in zip(colors, image):
-            bgra[:, :, 0] += color[2] * image
-            bgra[:, :, 1] += color[1] * image
-            bgra[:, :, 2] += color[0] * image
-
-        bgra = np.minimum(bgra, 1)
-        if self.window.dataset_dialog.wbackground.isChecked():
-            bgra = -(bgra - 1)
-        self._bgra = self.to_8bit(bgra)
+            color = dataset_dialog.colorselection[i].currentText()
+            if color in CHANNEL_COLORS:
+                colors[i] = CHANNEL_COLORS[color]
+            elif color != "auto":
+                colorstring = color.lstrip("#")
+                colors[i] = [
+                    int(colorstring[_: _ + 2], 16) / 255 for _ in (0, 2, 4)
+                ]
+            if dataset_dialog.wbackground.isChecked():
+                colors[i] = 1 - colors[i]
+            colors[i] *= dataset_dialog.intensitysettings[i].value()
+            if not dataset_dialog.checks[i].isChecked():
+                colors[i] = 0
+        return colors
+
+    def bgra_buffer(self, Y, X):
+        """
+        The BGRA pixels of the displayed image, which are reused for
+        the next image if it has the same size
+        """
+        if self._bgra is None or self._bgra.shape[:2] != (Y, X):
+            self._bgra = np.zeros((Y, X, 4), dtype=np.uint8, order="C")
         return self._bgra
 
     def render_single_channel(
@@ -4899,35 +5064,31 @@ class View(QtWidgets.QLabel):
             )
 
         if hasattr(locs, "group"):
-            locs = [locs[self.group_color == _] for _ in range(N_GROUP_COLORS)]
+            compact = self.compact(0)
+            locs = [
+                compact[self.group_color == _] for _ in range(N_GROUP_COLORS)
+            ]
             return self.render_multi_channel(
                 kwargs, autoscale=autoscale, locs=locs, use_cache=use_cache
             )
 
-        if hasattr(locs, "z"):
-            if self.window.slicer_dialog.slicerRadioButton.isChecked():
-                z_min = self.window.slicer_dialog.slicermin
-                z_max = self.window.slicer_dialog.slicermax
-                in_view = (locs.z > z_min) & (locs.z <= z_max)
-                locs = locs[in_view]
-
         if use_cache:
             n_locs = self.n_locs
             image = self.image
         else:
-            n_locs, image = render.render(locs, **kwargs)
+            n_locs, image = self.render_channel(0, kwargs, export=not cache)
         if cache:
             self.n_locs = n_locs
             self.image = image
-        image = self.scale_contrast(image, autoscale=autoscale)
-        image = self.to_8bit(image)
+        lower, upper = self.contrast_limits(image, autoscale=autoscale)
         Y, X = image.shape
         cmap = self.window.display_settings_dlg.colormap.currentText()
-        cmap = np.uint8(np.round(255 * plt.get_cmap(cmap)(np.arange(256))))
-        self._bgra = np.zeros((Y, X, 4), dtype=np.uint8, order="C")
-        self._bgra[..., 0] = cmap[:, 2][image]
-        self._bgra[..., 1] = cmap[:, 1][image]
-        self._bgra[..., 2] = cmap[:, 0][image]
+        if cmap not in self._luts:
+            lut = plt.get_cmap(cmap)(np.arange(256))
+            self._luts[cmap] = np.uint8(np.round(255 * lut))
+        render.colormap_bgra(
+            self.bgra_buffer(Y, X), image, self._luts[cmap], lower, upper
+        )
         return self._bgra
 
     def resizeEvent(self, event):
@@ -5038,7 +5199,11 @@ class View(QtWidgets.QLabel):
         with open(path, "w") as f:
             yaml.dump(picks, f)
 
-    def scale_contrast(self, image, autoscale=False):
+    def contrast_limits(self, image, autoscale=False):
+        """
+        The lower and upper contrast limits of the display settings,
+        set from the image if autoscale
+        """
         if autoscale:
             if image.ndim == 2:
                 max_ = image.max()
@@ -5054,7 +5219,10 @@ class View(QtWidgets.QLabel):
         if upper == lower:
             upper = lower + 1 / (10 ** 6)
             self.window.display_settings_dlg.silent_maximum_update(upper)
+        return lower, upper
 
+    def scale_contrast(self, image, autoscale=False):
+        lower, upper = self.contrast_limits(image, autoscale=autoscale)
         image = (image - lower) / (upper - lower)
         image[~np.isfinite(image)] = 0
         image = np.minimum(image, 1.0)
@@ -5470,6 +5638,7 @@ class View(QtWidgets.QLabel):
 
         # Cleanup
         self.index_blocks[channel] = None
+        self.locs_changed(channel)
         self.add_drift(channel, drift)
         status.close()
         self.update_scene()
@@ -5495,6 +5664,7 @@ class View(QtWidgets.QLabel):
 
         # Cleanup
         self.index_blocks[channel] = None
+        self.locs_changed(channel)
         self.add_drift(channel, drift)
         status.close()
         self.update_scene()
@@ -5517,6 +5687,7 @@ class View(QtWidgets.QLabel):
             drift.z = -drift.z
             self.locs[channel].z -= drift.z[self.locs[channel].frame]
 
+        self.locs_changed(channel)
         self.add_drift(channel, drift)
         self.update_scene()
 
@@ -5565,6 +5736,7 @@ class View(QtWidgets.QLabel):
         if self.unfold_status == "folded":
             if hasattr(self.locs[0], "group"):
                 self.locs[0].x += self.locs[0].group * 2
+                self.locs_changed(0)
             groups = np.unique(self.locs[0].group)
 
             if self._picks:
@@ -5618,6 +5790,7 @@ class View(QtWidgets.QLabel):
 
             self.locs[0].x += offset_x
             self.locs[0].y += offset_y
+            self.locs_changed(0)
 
             if self._picks:
                 if self._pick_shape == "Rectangle":
@@ -5648,6 +5821,7 @@ class View(QtWidgets.QLabel):
     def refold_groups(self):
         if hasattr(self.locs[0], "group"):
             self.locs[0].x -= self.locs[0].group * 2
+            self.locs_changed(0)
         self.fit_in_view()
         self.infos[0][0]["Width"] = self.oldwidth
         self.unfold_status == "folded"
@@ -5780,6 +5954,7 @@ class View(QtWidgets.QLabel):
     ):
         # Clear slicer cache
         self.window.slicer_dialog.slicer_cache = {}
+        self.window.slicer_dialog.slicer_volumes = OrderedDict()
         n_channels = len(self.locs)
         if n_channels:
             viewport = viewport or self.viewport
@@ -6812,6 +6987,7 @@ class Window(QtWidgets.QMainWindow):
                 self.view.locs[channel], self.view.infos[channel]
             )
             self.view.index_blocks[channel] = None
+            self.view.locs_changed(channel)
             self.view.update_scene()
 
     def open_file_dialog(self):
@@ -17,7 +17,6 @@ import struct as _struct
 import json as _json
 import os as _os
 import threading as _threading
-from PyQt5.QtWidgets import QMessageBox as _QMessageBox
 from . import lib as _lib
 
 
@@ -103,6 +102,8 @@ def load_info(path, qt_parent=None):
             )
         )
         if qt_parent is not None:
+            from PyQt5.QtWidgets import QMessageBox as _QMessageBox
+
             _QMessageBox.critical(
                 qt_parent,
                 "An error occured",
@@ -480,6 +481,227 @@ class TiffMultiMap:
             map.tofile(file_handle, byte_order)
 
 
+# TIFF field types
+_TIFF_SHORT, _TIFF_LONG, _TIFF_LONG8 = 3, 4, 16
+
+# IFD entries of single channel float32 images
+_FLOAT32_ENTRIES = [
+    (258, _TIFF_SHORT, [32]),
+    (259, _TIFF_SHORT, [1]),  # No compression
+    (262, _TIFF_SHORT, [1]),  # Black is zero
+    (277, _TIFF_SHORT, [1]),
+    (284, _TIFF_SHORT, [1]),
+    (339, _TIFF_SHORT, [3]),  # IEEE floating point
+]
+
+
+def _ifd_entry(tag, type, values):
+    """
+    A BigTIFF IFD entry and the data of values that do not fit
+    into its 8 byte value field
+    """
+    format = {_TIFF_SHORT: "H", _TIFF_LONG: "L", _TIFF_LONG8: "Q"}[type]
+    data = _struct.pack("<{}{}".format(len(values), format), *values)
+    entry = _struct.pack("<HHQ", tag, type, len(values))
+    if len(data) <= 8:
+        return entry + data.ljust(8, b"\x00"), b""
+    return entry, data
+
+
+def _write_ifds(file, pages):
+    """
+    Appends a chain of BigTIFF image file directories, one per page given
+    as a list of (tag, type, values) entries, to the file and writes the
+    header. The image data must be written already.
+    """
+    file.seek(0, 2)
+    ifd_offsets = []
+    next_offset_positions = []
+    for entries in pages:
+        entries = sorted(entries, key=lambda entry: entry[0])
+        ifd_offset = file.tell()
+        ifd_size = 8 + 20 * len(entries) + 8
+        data_offset = ifd_offset + ifd_size
+        ifd = _struct.pack("<Q", len(entries))
+        external = b""
+        for tag, type, values in entries:
+            entry, data = _ifd_entry(tag, type, values)
+            if data:
+                entry += _struct.pack("<Q", data_offset + len(external))
+                external += data
+            ifd += entry
+        # The offset of the next IFD is set below
+        ifd += _struct.pack("<Q", 0)
+        file.write(ifd + external)
+        ifd_offsets.append(ifd_offset)
+        next_offset_positions.append(data_offset - 8)
+    for position, next_offset in zip(next_offset_positions, ifd_offsets[1:]):
+        file.seek(position)
+        file.write(_struct.pack("<Q", next_offset))
+    # Header of a little endian BigTIFF
+    first_offset = ifd_offsets[0] if ifd_offsets else 0
+    header = _struct.pack("<HHHQ", 43, 8, 0, first_offset)
+    file.seek(0)
+    file.write(b"II" + header)
+
+
+class TiledTiffWriter:
+    """
+    Writes a float32 image with pyramid levels to a tiled, uncompressed
+    BigTIFF file, tile by tile, so that the image is never in memory.
+    Each level is a page of half the size of the previous one (a reduced
+    resolution image), down to a single tile. Tiles have fixed offsets
+    and can be written from multiple threads and in any order.
+    """
+
+    def __init__(self, path, shape, tile_size=256):
+        self.path = _ospath.abspath(path)
+        self.tile_size = tile_size
+        self.tile_bytes = 4 * tile_size ** 2
+        self.shapes = [tuple(shape)]
+        while max(self.shapes[-1]) > tile_size:
+            height, width = self.shapes[-1]
+            self.shapes.append((-(-height // 2), -(-width // 2)))
+        self.n_levels = len(self.shapes)
+        self.n_tiles = [
+            (-(-height // tile_size), -(-width // tile_size))
+            for height, width in self.shapes
+        ]
+        # Tile data of all levels follows the 16 byte header
+        self.level_offsets = [16]
+        for n_tiles_y, n_tiles_x in self.n_tiles:
+            level_bytes = n_tiles_y * n_tiles_x * self.tile_bytes
+            self.level_offsets.append(self.level_offsets[-1] + level_bytes)
+        self.file = open(self.path, "w+b")
+        self.file.truncate(self.level_offsets[-1])
+        self.lock = _threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def tile_offset(self, level, ty, tx):
+        n_tiles_x = self.n_tiles[level][1]
+        index = ty * n_tiles_x + tx
+        return self.level_offsets[level] + index * self.tile_bytes
+
+    def write_tile(self, level, ty, tx, tile):
+        """ Writes a tile (at most tile_size x tile_size, zero padded) """
+        data = _np.zeros((self.tile_size, self.tile_size), dtype="<f4")
+        data[: tile.shape[0], : tile.shape[1]] = tile
+        with self.lock:
+            self.file.seek(self.tile_offset(level, ty, tx))
+            self.file.write(data.tobytes())
+
+    def read_tile(self, level, ty, tx):
+        with self.lock:
+            self.file.seek(self.tile_offset(level, ty, tx))
+            data = self.file.read(self.tile_bytes)
+        shape = (self.tile_size, self.tile_size)
+        return _np.frombuffer(data, dtype="<f4").reshape(shape)
+
+    def write_levels(self):
+        """
+        Writes the pyramid levels from the written tiles of the full image,
+        averaging 2 x 2 pixels of the previous level
+        """
+        T = self.tile_size
+        for level in range(1, self.n_levels):
+            n_tiles_y, n_tiles_x = self.n_tiles[level - 1]
+            for ty in range(self.n_tiles[level][0]):
+                for tx in range(self.n_tiles[level][1]):
+                    block = _np.zeros((2 * T, 2 * T), dtype=_np.float32)
+                    for dy in range(2):
+                        for dx in range(2):
+                            y, x = 2 * ty + dy, 2 * tx + dx
+                            if y < n_tiles_y and x < n_tiles_x:
+                                block[
+                                    dy * T: (dy + 1) * T, dx * T: (dx + 1) * T
+                                ] = self.read_tile(level - 1, y, x)
+                    tile = block.reshape(T, 2, T, 2).mean(axis=(1, 3))
+                    self.write_tile(level, ty, tx, tile)
+
+    def close(self):
+        """ Writes the image file directories of all levels """
+        pages = []
+        for level, (height, width) in enumerate(self.shapes):
+            n_tiles = self.n_tiles[level][0] * self.n_tiles[level][1]
+            tile_offsets = [
+                self.level_offsets[level] + _ * self.tile_bytes
+                for _ in range(n_tiles)
+            ]
+            pages.append(
+                [
+                    (254, _TIFF_LONG, [0 if level == 0 else 1]),
+                    (256, _TIFF_LONG, [width]),
+                    (257, _TIFF_LONG, [height]),
+                ]
+                + _FLOAT32_ENTRIES
+                + [
+                    (322, _TIFF_LONG, [self.tile_size]),
+                    (323, _TIFF_LONG, [self.tile_size]),
+                    (324, _TIFF_LONG8, tile_offsets),
+                    (325, _TIFF_LONG8, [self.tile_bytes] * n_tiles),
+                ]
+            )
+        with self.lock:
+            _write_ifds(self.file, pages)
+            self.file.close()
+
+
+class TiffStackWriter:
+    """
+    Writes float32 images of the same shape as pages of an uncompressed
+    BigTIFF file, one after the other (e.g., the frames of a video), so
+    that only the current image is in memory.
+    """
+
+    def __init__(self, path):
+        self.path = _ospath.abspath(path)
+        self.file = open(self.path, "w+b")
+        # Image data follows the 16 byte header
+        self.file.write(b"\x00" * 16)
+        self.shape = None
+        self.offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, image):
+        if self.shape is None:
+            self.shape = image.shape
+        elif image.shape != self.shape:
+            raise ValueError("All images need to have the same shape.")
+        self.offsets.append(self.file.tell())
+        self.file.write(_np.ascontiguousarray(image, dtype="<f4").tobytes())
+
+    def close(self):
+        """ Writes the image file directories of all pages """
+        if self.shape is None:
+            self.shape = (0, 0)
+        height, width = self.shape
+        pages = [
+            [
+                (256, _TIFF_LONG, [width]),
+                (257, _TIFF_LONG, [height]),
+            ]
+            + _FLOAT32_ENTRIES
+            + [
+                (273, _TIFF_LONG8, [offset]),
+                (278, _TIFF_LONG, [height]),
+                (279, _TIFF_LONG8, [4 * height * width]),
+            ]
+            for offset in self.offsets
+        ]
+        _write_ifds(self.file, pages)
+        self.file.close()
+
+
 def to_raw_combined(basename, paths):
     raw_file_name = basename + ".ome.raw"
     with open(raw_file_name, "wb") as file_handle:
@@ -556,10 +778,18 @@ def save_datasets(path, info, **kwargs):
     save_info(info_path, info)
 
 
-def save_locs(path, locs, info):
-    locs = _lib.ensure_sanity(locs, info)
+def save_locs(path, locs, info, frame_order=None):
+    """
+    Saves locs and their metadata. Spatially sorted locs (see
+    lib.sort_spatially) are saved with the permutation back to frame order,
+    which requires the locs to be sane already.
+    """
+    if frame_order is None:
+        locs = _lib.ensure_sanity(locs, info)
     with _h5py.File(path, "w") as locs_file:
         locs_file.create_dataset("locs", data=locs)
+        if frame_order is not None:
+            locs_file.create_dataset("frame_order", data=frame_order)
     base, ext = _ospath.splitext(path)
     info_path = base + ".yaml"
     save_info(info_path, info)
@@ -575,6 +805,17 @@ def load_locs(path, qt_parent=None):
     return locs, info
 
 
+def load_frame_order(path):
+    """
+    The permutation from spatially sorted locs back to frame order,
+    or None if the locs of the file are in frame order
+    """
+    with _h5py.File(path, "r") as locs_file:
+        if "frame_order" not in locs_file:
+            return None
+        return locs_file["frame_order"][...]
+
+
 def load_clusters(path, qt_parent=None):
     with _h5py.File(path, "r") as cluster_file:
         clusters = cluster_file["clusters"][...]
@@ -17,53 +17,27 @@ import collections as _collections
 import glob as _glob
 import os.path as _ospath
 from picasso import io as _io
-from PyQt5 import QtGui, QtCore, QtWidgets
-from lmfit import Model as _Model
 
 
-# A global variable where we store all open progress and status dialogs.
-# In case of an exception, we close them all,
-# so that the GUI remains responsive.
-_dialogs = []
+# Qt dialogs and lmfit models are only loaded on first access,
+# so that the numerical modules can be imported without a GUI stack.
+_GUI_NAMES = ("ProgressDialog", "StatusDialog", "cancel_dialogs")
 
 
-class ProgressDialog(QtWidgets.QProgressDialog):
-    def __init__(self, description, minimum, maximum, parent):
-        super().__init__(
-            description,
-            None,
-            minimum,
-            maximum,
-            parent,
-            QtCore.Qt.CustomizeWindowHint,
-        )
-        _dialogs.append(self)
-        self.setMinimumDuration(500)
-        self.setModal(True)
-        self.app = QtCore.QCoreApplication.instance()
-
-    def set_value(self, value):
-        self.setValue(value)
-        self.app.processEvents()
+def __getattr__(name):
+    if name in _GUI_NAMES:
+        from picasso.gui import dialogs as _dialogs
 
-    def closeEvent(self, event):
-        _dialogs.remove(self)
+        return getattr(_dialogs, name)
+    elif name == "CumulativeExponentialModel":
+        from lmfit import Model as _Model
 
-
-class StatusDialog(QtWidgets.QDialog):
-    def __init__(self, description, parent):
-        super(StatusDialog, self).__init__(
-            parent, QtCore.Qt.CustomizeWindowHint
-        )
-        _dialogs.append(self)
-        vbox = QtWidgets.QVBoxLayout(self)
-        label = QtWidgets.QLabel(description)
-        vbox.addWidget(label)
-        self.show()
-        QtCore.QCoreApplication.instance().processEvents()
-
-    def closeEvent(self, event):
-        _dialogs.remove(self)
+        model = _Model(cumulative_exponential)
+        globals()[name] = model
+        return model
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
 
 
 class AutoDict(_collections.defaultdict):
@@ -78,23 +52,10 @@ class AutoDict(_collections.defaultdict):
         super().__init__(AutoDict, *args, **kwargs)
 
 
-def cancel_dialogs():
-    dialogs = [_ for _ in _dialogs]
-    for dialog in dialogs:
-        if isinstance(dialog, ProgressDialog):
-            dialog.cancel()
-        else:
-            dialog.close()
-    QtCore.QCoreApplication.instance().processEvents()  # just in case...
-
-
 def cumulative_exponential(x, a, t, c):
     return a * (1 - _np.exp(-(x / t))) + c
 
 
-CumulativeExponentialModel = _Model(cumulative_exponential)
-
-
 def calculate_optimal_bins(data, max_n_bins=None):
     iqr = _np.subtract(*_np.percentile(data, [75, 25]))
     bin_size = 2 * iqr * len(data) ** (-1 / 3)
@@ -143,6 +104,128 @@ def ensure_sanity(locs, info):
     return locs
 
 
+GroupIndex = _collections.namedtuple(
+    "GroupIndex", ["groups", "order", "offsets"]
+)
+
+
+def group_index(locs):
+    """
+    Index of the locs by group: the sorted group ids, the permutation
+    that sorts the locs by group (None if they are sorted already) and
+    the offsets of the groups in the sorted locs, ending with len(locs).
+    """
+    group = locs["group"]
+    if _np.all(group[1:] >= group[:-1]):
+        order = None
+        sorted_group = group
+    else:
+        order = _np.argsort(group, kind="stable")
+        sorted_group = group[order]
+    is_start = _np.ones(len(group), dtype=bool)
+    is_start[1:] = sorted_group[1:] != sorted_group[:-1]
+    starts = _np.flatnonzero(is_start)
+    offsets = _np.append(starts, len(group))
+    return GroupIndex(sorted_group[starts], order, offsets)
+
+
+def sort_by_group(locs, index):
+    """ The locs in the order of the group index """
+    if index.order is None:
+        return locs
+    return locs[index.order]
+
+
+def group_slices(locs, index=None):
+    """
+    Yields the group ids with their locs, which are slices of the locs
+    sorted by group (views of locs if they are sorted already)
+    """
+    if index is None:
+        index = group_index(locs)
+    sorted_locs = sort_by_group(locs, index)
+    for i, group in enumerate(index.groups):
+        yield group, sorted_locs[index.offsets[i]: index.offsets[i + 1]]
+
+
+def group_locs(locs, index, group):
+    """ The locs of one group, looked up with the group index """
+    i = _np.searchsorted(index.groups, group)
+    if i == len(index.groups) or index.groups[i] != group:
+        return locs[:0]
+    start, end = index.offsets[i], index.offsets[i + 1]
+    if index.order is None:
+        return locs[start:end]
+    return locs[index.order[start:end]]
+
+
+# Cell size (camera pixels) of the Morton order of spatially sorted locs
+MORTON_CELL_SIZE = 0.5
+
+SpatialIndex = _collections.namedtuple("SpatialIndex", ["codes", "cell_size"])
+
+
+def _spread_bits(v):
+    """ Spreads the lower 32 bits of v to the even bits of 64 bits """
+    v = (v | (v << 16)) & _np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << 8)) & _np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << 4)) & _np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << 2)) & _np.uint64(0x3333333333333333)
+    v = (v | (v << 1)) & _np.uint64(0x5555555555555555)
+    return v
+
+
+def morton_codes(x, y, cell_size=MORTON_CELL_SIZE):
+    """
+    Morton (Z-order) codes of the cells of size cell_size at (x, y),
+    interleaving the bits of the cell indices. Codes increase with x and y,
+    so that the codes of all points in a rectangle lie between the codes
+    of its corners.
+    """
+    cx = _np.clip(_np.asarray(x) / cell_size, 0, 2 ** 32 - 1)
+    cy = _np.clip(_np.asarray(y) / cell_size, 0, 2 ** 32 - 1)
+    cx = cx.astype(_np.uint64)
+    cy = cy.astype(_np.uint64)
+    return _spread_bits(cx) | (_spread_bits(cy) << _np.uint64(1))
+
+
+def sort_spatially(locs, cell_size=MORTON_CELL_SIZE):
+    """
+    Sorts the locs in Morton order, so that locs close to each other are
+    close in memory. Returns the sorted locs and the permutation back to
+    the original order (e.g., by frame): sorted_locs[frame_order] are
+    the original locs.
+    """
+    order = _np.argsort(morton_codes(locs.x, locs.y, cell_size), kind="stable")
+    frame_order = _np.empty(len(order), dtype=_np.int64)
+    frame_order[order] = _np.arange(len(order))
+    return locs[order], frame_order
+
+
+def spatial_index(locs, cell_size=MORTON_CELL_SIZE):
+    """
+    Index of locs in Morton order, or None if the locs are not sorted
+    spatially with that cell size
+    """
+    codes = morton_codes(locs.x, locs.y, cell_size)
+    if _np.any(codes[1:] < codes[:-1]):
+        return None
+    return SpatialIndex(codes, cell_size)
+
+
+def spatial_range(index, y_min, x_min, y_max, x_max):
+    """
+    The start and end of the locs in Morton order that may lie within
+    the rectangle: locs outside of start:end are not in the rectangle.
+    """
+    low, high = morton_codes(
+        _np.array([x_min, x_max]), _np.array([y_min, y_max]), index.cell_size
+    )
+    start = _np.searchsorted(index.codes, low, side="left")
+    end = _np.searchsorted(index.codes, high, side="right")
+    return start, end
+
+
 def is_loc_at(x, y, locs, r):
     dx = locs.x - x
     dy = locs.y - y
@@ -150,12 +233,20 @@ def is_loc_at(x, y, locs, r):
     return dx ** 2 + dy ** 2 < r2
 
 
-def locs_at(x, y, locs, r):
+def locs_at(x, y, locs, r, index=None):
+    """
+    The locs within the distance r of (x, y). If a spatial index of
+    the locs is given, only the locs in its range of the circle's
+    bounding box are tested.
+    """
+    if index is not None:
+        start, end = spatial_range(index, y - r, x - r, y + r, x + r)
+        locs = locs[start:end]
     is_picked = is_loc_at(x, y, locs, r)
     return locs[is_picked]
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def check_if_in_rectangle(x, y, X, Y):
     """
     Checks if locs with coordinates (x, y) are in rectangle with corners (X, Y)
@@ -14,7 +14,6 @@ import ctypes as _ctypes
 from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import threading as _threading
 from itertools import chain as _chain
-import matplotlib.pyplot as _plt
 from . import gaussmle as _gaussmle
 from . import io as _io
 
@@ -36,10 +35,7 @@ LOCS_DTYPE = [
 ]
 
 
-_plt.style.use("ggplot")
-
-
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def local_maxima(frame, box):
     """ Finds pixels with maximum value within a region of interest """
     Y, X = frame.shape
@@ -61,14 +57,14 @@ def local_maxima(frame, box):
     return y, x
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def gradient_at(frame, y, x, i):
     gy = frame[y + 1, x] - frame[y - 1, x]
     gx = frame[y, x + 1] - frame[y, x - 1]
     return gy, gx
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def net_gradient(frame, y, x, box, uy, ux):
     box_half = int(box / 2)
     ng = _np.zeros(len(x), dtype=_np.float32)
@@ -85,7 +81,7 @@ def net_gradient(frame, y, x, box, uy, ux):
     return ng
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def identify_in_image(image, minimum_ng, box):
     y, x = local_maxima(image, box)
     box_half = int(box / 2)
@@ -194,7 +190,7 @@ def identify(movie, minimum_ng, box, threaded=True):
     return _np.hstack(identifications).view(_np.recarray)
 
 
-@_numba.jit(nopython=True, cache=False)
+@_numba.jit(nopython=True, cache=True)
 def _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box):
     n_spots = len(ids_x)
     r = int(box / 2)
@@ -204,7 +200,7 @@ def _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box):
     return spots
 
 
-@_numba.jit(nopython=True, cache=False)
+@_numba.jit(nopython=True, cache=True)
 def _cut_spots_frame(
     frame, frame_number, ids_frame, ids_x, ids_y, r, start, N, spots
 ):
@@ -263,10 +259,11 @@ def fit(
     eps=0.001,
     max_it=100,
     method="sigma",
+    lut=False,
 ):
     spots = get_spots(movie, identifications, box, camera_info)
     theta, CRLBs, likelihoods, iterations = _gaussmle.gaussmle(
-        spots, eps, max_it, method=method
+        spots, eps, max_it, method=method, lut=lut
     )
     return locs_from_fits(
         identifications, theta, CRLBs, likelihoods, iterations, box
@@ -281,9 +278,12 @@ def fit_async(
     eps=0.001,
     max_it=100,
     method="sigma",
+    lut=False,
 ):
     spots = get_spots(movie, identifications, box, camera_info)
-    return _gaussmle.gaussmle_async(spots, eps, max_it, method=method)
+    return _gaussmle.gaussmle_async(
+        spots, eps, max_it, method=method, lut=lut
+    )
 
 
 def locs_from_fits(
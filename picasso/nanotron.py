@@ -13,7 +13,7 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm as tqdm
 from scipy import ndimage
 
-from . import render
+from . import lib, render
 
 
 def prepare_img(img, img_shape, alpha=1, bg=0):
@@ -33,11 +33,13 @@ def rotate_img(img, angle):
 
     return rot_img
 
-def roi_to_img(locs, pick, radius, oversampling):
+def roi_to_img(locs, pick, radius, oversampling, index=None):
 
-    # Isolate locs from pick
-    pick_locs = []
-    pick_locs = locs[(locs["group"] == pick)]
+    # Isolate locs from pick, with the group index if given
+    if index is None:
+        pick_locs = locs[(locs["group"] == pick)]
+    else:
+        pick_locs = lib.group_locs(locs, index, pick)
     # dirty method to avoid floating point errors with render
     radius -= 0.001
 
@@ -76,11 +78,14 @@ def prepare_data(locs, label, pick_radius,
     data = []
     labels = []
 
+    index = lib.group_index(locs)
+
     for pick in tqdm(range(locs.group.max()), desc='Prepare '+str(label)):
 
         pick_img = roi_to_img(locs, pick,
                               radius=pick_radius,
-                              oversampling=oversampling)
+                              oversampling=oversampling,
+                              index=index)
 
         if export is True and pick < 10:
             filename = 'label' + str(label) + '-' + str(pick)
@@ -94,10 +99,12 @@ def prepare_data(locs, label, pick_radius,
     return data, label
 
 
-def predict_structure(mlp, locs, pick, pick_radius, oversampling):
+def predict_structure(mlp, locs, pick, pick_radius, oversampling,
+                      index=None):
 
     img_shape = int(2 * pick_radius * oversampling)
-    img = roi_to_img(locs, pick=pick, radius=pick_radius, oversampling=oversampling)
+    img = roi_to_img(locs, pick=pick, radius=pick_radius,
+                     oversampling=oversampling, index=index)
     img = prepare_img(img, img_shape=img_shape, alpha=10, bg=1)
     img = img.reshape(1, img_shape**2)
 
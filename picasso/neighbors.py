@@ -0,0 +1,92 @@
+"""
+    picasso.neighbors
+    ~~~~~~~~~~~~~~~~~
+
+    k-nearest neighbor distances of localizations and clusters
+
+    :authors: Joerg Schnitzbauer, Maximilian Thomas Strauss
+    :copyright: Copyright (c) 2016-2020 Jungmann Lab, MPI of Biochemistry
+"""
+import multiprocessing as _multiprocessing
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+import numpy as _np
+from scipy.spatial import cKDTree as _cKDTree
+
+
+# Number of points per query, which bounds the memory of streamed results
+CHUNK_SIZE = 100000
+
+
+def points(locs, pixelsize=None, prefix=""):
+    """
+    Coordinates (N x 2) of locs or clusters, with the field names
+    prefixed (e.g., "com_" for dbscan cluster centers).
+    If pixelsize (nm/px) is given, z is converted to pixels (N x 3).
+    """
+    names = [prefix + "x", prefix + "y"]
+    X = _np.column_stack([locs[_] for _ in names]).astype(_np.float64)
+    if pixelsize is not None:
+        X = _np.column_stack((X, locs[prefix + "z"] / pixelsize))
+    return X
+
+
+def knn_distance_chunks(X, k=1, chunk_size=CHUNK_SIZE, n_workers=None):
+    """
+    Yields the distances (chunk_size x k) from consecutive chunks of the
+    points X to their k nearest neighbors, excluding the points themselves.
+    Distances are inf if there are fewer than k other points.
+    Chunks are queried in parallel threads and yielded in order,
+    with at most n_workers chunks in memory.
+    """
+    if n_workers is None:
+        n_workers = _multiprocessing.cpu_count()
+    tree = _cKDTree(X)
+    starts = range(0, len(X), chunk_size)
+
+    def query(start):
+        return tree.query(X[start: start + chunk_size], k=k + 1)[0][:, 1:]
+
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for i in range(0, len(starts), n_workers):
+            window = starts[i: i + n_workers]
+            for d in executor.map(query, window):
+                yield d
+
+
+def knn_distances(X, k=1, chunk_size=CHUNK_SIZE, n_workers=None):
+    """
+    Distances (N x k) from the points X (N x 2 or N x 3) to their
+    k nearest neighbors, excluding the points themselves
+    """
+    chunks = list(knn_distance_chunks(X, k, chunk_size, n_workers))
+    if len(chunks) == 0:
+        return _np.zeros((0, k))
+    return _np.concatenate(chunks)
+
+
+def knn_distribution(
+    X, bin_size, r_max, k=1, chunk_size=CHUNK_SIZE, n_workers=None
+):
+    """
+    Histograms of the distances to the 1st to k-th nearest neighbors up
+    to r_max, accumulated chunk by chunk without keeping all distances.
+    Returns the bin edges and the counts (k x n_bins).
+    """
+    bins = _np.arange(0, r_max + bin_size, bin_size)
+    counts = _np.zeros((k, len(bins) - 1), dtype=_np.int64)
+    for d in knn_distance_chunks(X, k, chunk_size, n_workers):
+        for i in range(k):
+            counts[i] += _np.histogram(d[:, i], bins)[0]
+    return bins, counts
+
+
+def save_knn_distances(
+    path, X, k=1, chunk_size=CHUNK_SIZE, n_workers=None, newline="\r\n"
+):
+    """
+    Writes the k nearest neighbor distances of the points X to a text
+    file with one row per point, streaming chunk by chunk
+    """
+    with open(path, "w") as file:
+        for d in knn_distance_chunks(X, k, chunk_size, n_workers):
+            _np.savetxt(file, d, newline=newline)
@@ -11,26 +11,18 @@
 import numpy as _np
 import numba as _numba
 
-from sklearn.cluster import DBSCAN as _DBSCAN
-from hdbscan import HDBSCAN as _HDBSCAN
 from scipy import interpolate as _interpolate
 from scipy.special import iv as _iv
-from scipy.spatial import distance
 from scipy.spatial import ConvexHull
 
-from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
-import multiprocessing as _multiprocessing
-import matplotlib.pyplot as _plt
 import itertools as _itertools
-import lmfit as _lmfit
 from collections import OrderedDict as _OrderedDict
 from . import lib as _lib
+from . import neighbors as _neighbors
 from . import render as _render
 from . import imageprocess as _imageprocess
 from threading import Thread as _Thread
 import time as _time
-from tqdm import tqdm as _tqdm
-from numpy.lib.recfunctions import stack_arrays
 
 
 def get_index_blocks(locs, info, size, callback=None):
@@ -77,7 +69,7 @@ def index_blocks_shape(info, size):
     return n_blocks_y, n_blocks_x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def n_block_locs_at(x, y, size, K, L, block_starts, block_ends):
     x_index = _np.uint32(x / size)
     y_index = _np.uint32(y / size)
@@ -123,7 +115,7 @@ def _fill_index_blocks(
             counter[0] = i + 1
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fill_index_block(block_starts, block_ends, N, x_index, y_index, i, j, k):
     block_starts[i, j] = k
     while k < N and y_index[k] == i and x_index[k] == j:
@@ -132,77 +124,193 @@ def _fill_index_block(block_starts, block_ends, N, x_index, y_index, i, j, k):
     return k
 
 
-@_numba.jit(nopython=True, nogil=True)
-def _distance_histogram(
-    locs,
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _translation_weight(dx, dy, dz, window):
+    """
+    Inverse fraction of the window that contains both points of a pair
+    after translation by its distance. Axes with a window of 0 are not
+    corrected. Returns 0 if the pair cannot be observed in the window.
+    """
+    weight = 1.0
+    for axis, d in enumerate((dx, dy, dz)):
+        if window[axis] > 0:
+            overlap = window[axis] - abs(d)
+            if overlap <= 0:
+                return 0.0
+            weight *= window[axis] / overlap
+    return weight
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _cell_pair_costs(
+    cells_a,
+    cell_starts_a,
+    cell_ends_a,
+    cell_ids_b,
+    cell_starts_b,
+    cell_ends_b,
+    n_cells,
+):
+    """
+    Number of point pairs between each cell of A and the neighboring
+    cells of B on the same grid
+    """
+    costs = _np.zeros(len(cell_starts_a), dtype=_np.int64)
+    for c in _numba.prange(len(cell_starts_a)):
+        k = cell_starts_a[c]
+        neighbors = _cells_around(
+            cells_a[k, 0], cells_a[k, 1], cells_a[k, 2], cell_ids_b, n_cells
+        )
+        n_b = 0
+        for m in neighbors:
+            n_b += cell_ends_b[m] - cell_starts_b[m]
+        costs[c] = n_b * (cell_ends_a[c] - cell_starts_a[c])
+    return costs
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _fill_distance_histogram(
+    XA,
+    cells_a,
+    cell_starts_a,
+    cell_ends_a,
+    XB,
+    cell_ids_b,
+    cell_starts_b,
+    cell_ends_b,
+    n_cells,
+    chunk_starts,
+    auto,
     bin_size,
     r_max,
-    x_index,
-    y_index,
-    block_starts,
-    block_ends,
-    start,
-    chunk,
+    window,
+    dh,
 ):
-    x = locs.x
-    y = locs.y
-    dh_len = _np.uint32(r_max / bin_size)
-    dh = _np.zeros(dh_len, dtype=_np.uint32)
+    """
+    Fills one histogram row per chunk of cells of A with the (weighted)
+    distances to the points of B. For auto-correlations (B is A),
+    each pair is counted once.
+    """
+    n_bins = dh.shape[1]
     r_max_2 = r_max ** 2
-    K, L = block_starts.shape
-    end = min(start + chunk, len(locs))
-    for i in range(start, end):
-        xi = x[i]
-        yi = y[i]
-        ki = y_index[i]
-        li = x_index[i]
-        for k in range(ki, ki + 2):
-            if k < K:
-                for l in range(li, li + 2):
-                    if l < L:
-                        for j in range(block_starts[k, l], block_ends[k, l]):
-                            if j > i:
-                                dx2 = (xi - x[j]) ** 2
-                                if dx2 < r_max_2:
-                                    dy2 = (yi - y[j]) ** 2
-                                    if dy2 < r_max_2:
-                                        d = _np.sqrt(dx2 + dy2)
-                                        if d < r_max:
-                                            bin = _np.uint32(d / bin_size)
-                                            if bin < dh_len:
-                                                dh[bin] += 1
-    return dh
-
-
-def distance_histogram(locs, info, bin_size, r_max):
-    locs, size, x_index, y_index, b_starts, b_ends, K, L = get_index_blocks(
-        locs, info, r_max
-    )
-    N = len(locs)
-    n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [
-        (
-            locs,
+    for chunk in _numba.prange(len(chunk_starts) - 1):
+        for c in range(chunk_starts[chunk], chunk_starts[chunk + 1]):
+            k = cell_starts_a[c]
+            x, y, z = cells_a[k, 0], cells_a[k, 1], cells_a[k, 2]
+            neighbors = _cells_around(x, y, z, cell_ids_b, n_cells)
+            for i in range(cell_starts_a[c], cell_ends_a[c]):
+                for m in neighbors:
+                    j_min = cell_starts_b[m]
+                    if auto:
+                        j_min = max(j_min, i + 1)
+                    for j in range(j_min, cell_ends_b[m]):
+                        dx = XA[i, 0] - XB[j, 0]
+                        dy = XA[i, 1] - XB[j, 1]
+                        dz = XA[i, 2] - XB[j, 2]
+                        d2 = dx ** 2 + dy ** 2 + dz ** 2
+                        if d2 < r_max_2:
+                            bin = int(_np.sqrt(d2) / bin_size)
+                            if bin < n_bins:
+                                dh[chunk, bin] += _translation_weight(
+                                    dx, dy, dz, window
+                                )
+
+
+def _distance_points(locs, pixelsize=None):
+    """ Coordinates in pixels, with z converted if pixelsize is given """
+    X = _np.zeros((len(locs), 3), dtype=_np.float64)
+    X[:, 0] = locs.x
+    X[:, 1] = locs.y
+    if pixelsize is not None:
+        X[:, 2] = locs.z / pixelsize
+    return X
+
+
+def distance_histogram(
+    locs,
+    info,
+    bin_size,
+    r_max,
+    locs_b=None,
+    pixelsize=None,
+    edge_correction=False,
+):
+    """
+    Histogram of the pair distances up to r_max (in pixels) within locs,
+    or between locs and locs_b for a cross-correlation of two channels.
+    If pixelsize (nm/px) is given, distances are 3D with z in nm.
+    With edge correction, pairs are weighted by the inverse fraction of
+    the field of view (and the z range) in which they can be observed.
+    Work is split into chunks of equal numbers of candidate pairs,
+    so clustered data keeps all threads busy.
+    """
+    locs = _lib.ensure_sanity(locs, info)
+    XA = _distance_points(locs, pixelsize)
+    auto = locs_b is None
+    if auto:
+        XB = XA
+    else:
+        XB = _distance_points(_lib.ensure_sanity(locs_b, info), pixelsize)
+    n_bins = int(r_max / bin_size)
+    n_chunks = 16 * _numba.get_num_threads()
+    dh = _np.zeros((n_chunks, n_bins), dtype=_np.float64)
+    if len(XA) > 0 and len(XB) > 0:
+        # Index both channels on the same grid
+        origin = _np.minimum(XA.min(axis=0), XB.min(axis=0))
+        upper = _np.maximum(XA.max(axis=0), XB.max(axis=0))
+        n_cells = _np.int64((upper - origin) / r_max) + 1
+        order, cells_a, cell_ids_a, starts_a, ends_a, _ = _cell_index(
+            XA, r_max, origin, n_cells
+        )
+        XA = XA[order]
+        if auto:
+            XB, cell_ids_b, starts_b, ends_b = XA, cell_ids_a, starts_a, ends_a
+        else:
+            order, _, cell_ids_b, starts_b, ends_b, _ = _cell_index(
+                XB, r_max, origin, n_cells
+            )
+            XB = XB[order]
+        costs = _cell_pair_costs(
+            cells_a, starts_a, ends_a, cell_ids_b, starts_b, ends_b, n_cells
+        )
+        cum_costs = _np.cumsum(costs)
+        chunk_starts = _np.searchsorted(
+            cum_costs, _np.linspace(0, cum_costs[-1], n_chunks + 1)
+        )
+        chunk_starts[0] = 0
+        chunk_starts[-1] = len(cell_ids_a)
+        window = _np.zeros(3, dtype=_np.float64)
+        if edge_correction:
+            window[0] = info[0]["Width"]
+            window[1] = info[0]["Height"]
+            if pixelsize is not None:
+                window[2] = _np.ptp(_np.concatenate((XA[:, 2], XB[:, 2])))
+        _fill_distance_histogram(
+            XA,
+            cells_a,
+            starts_a,
+            ends_a,
+            XB,
+            cell_ids_b,
+            starts_b,
+            ends_b,
+            n_cells,
+            chunk_starts,
+            auto,
             bin_size,
             r_max,
-            x_index,
-            y_index,
-            b_starts,
-            b_ends,
-            start,
-            chunk,
+            window,
+            dh,
         )
-        for start in starts
-    ]
-    with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_distance_histogram, *_) for _ in args]
-    results = [future.result() for future in futures]
-    return _np.sum(results, axis=0)
+    dh = dh.sum(axis=0)
+    if not edge_correction:
+        dh = _np.int64(dh)
+    return dh
 
 
 def nena(locs, info, callback=None):
+    import lmfit as _lmfit
+
     bin_centers, dnfl_ = next_frame_neighbor_distance_histogram(locs, callback)
 
     def func(d, a, s, ac, dc, sc):
@@ -243,73 +351,354 @@ def next_frame_neighbor_distance_histogram(locs, callback=None):
 
 
 def _nfndh(frame, x, y, group, d_max, bin_size, callback=None):
+    """
+    Histogram of the distances from each loc to the locs of the same group
+    in the next frame. Expects the locs sorted by frame.
+    The locs are processed in 100 chunks for progress updates,
+    each chunk in parallel with one histogram per thread.
+    """
     N = len(frame)
     bins = _np.arange(0, d_max, bin_size)
-    dnfl = _np.zeros(len(bins))
-    one_percent = int(N / 100)
-    starts = one_percent * _np.arange(100)
-    for k, start in enumerate(starts):
-        for i in range(start, start + one_percent):
-            _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size)
+    # Index of the first loc of each frame, and the end of the last frame
+    if N > 0:
+        first_frame = int(frame[0])
+        frame_offsets = _np.searchsorted(
+            frame, _np.arange(first_frame, int(frame[-1]) + 3)
+        )
+    else:
+        first_frame = 0
+        frame_offsets = _np.zeros(3, dtype=_np.int64)
+    n_threads = _numba.get_num_threads()
+    dnfl = _np.zeros((n_threads, len(bins)), dtype=_np.int64)
+    chunk_ends = _np.linspace(0, N, 101).astype(_np.int64)
+    for k in range(100):
+        _fill_dnfl(
+            frame,
+            x,
+            y,
+            group,
+            frame_offsets,
+            first_frame,
+            chunk_ends[k],
+            chunk_ends[k + 1],
+            d_max,
+            bin_size,
+            dnfl,
+        )
         if callback is not None:
             callback(k + 1)
     bin_centers = bins + bin_size / 2
-    return bin_centers, dnfl
+    return bin_centers, _np.float64(dnfl.sum(axis=0))
 
 
-@_numba.jit(nopython=True)
-def _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size):
-    frame_i = frame[i]
-    x_i = x[i]
-    y_i = y[i]
-    group_i = group[i]
-    min_frame = frame_i + 1
-    for min_index in range(i + 1, N):
-        if frame[min_index] >= min_frame:
-            break
-    max_frame = frame_i + 1
-    for max_index in range(min_index, N):
-        if frame[max_index] > max_frame:
-            break
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _fill_dnfl(
+    frame,
+    x,
+    y,
+    group,
+    frame_offsets,
+    first_frame,
+    start,
+    end,
+    d_max,
+    bin_size,
+    dnfl,
+):
+    n_threads, n_bins = dnfl.shape
     d_max_2 = d_max ** 2
-    for j in range(min_index, max_index):
-        if group[j] == group_i:
-            dx2 = (x_i - x[j]) ** 2
-            if dx2 <= d_max_2:
-                dy2 = (y_i - y[j]) ** 2
-                if dy2 <= d_max_2:
-                    d = _np.sqrt(dx2 + dy2)
-                    if d <= d_max:
-                        bin = int(d / bin_size)
-                        dnfl[bin] += 1
-
-
-def pair_correlation(locs, info, bin_size, r_max):
-    dh = distance_histogram(locs, info, bin_size, r_max)
+    step = (end - start + n_threads - 1) // n_threads
+    for t in _numba.prange(n_threads):
+        for i in range(start + t * step, min(start + (t + 1) * step, end)):
+            x_i = x[i]
+            y_i = y[i]
+            group_i = group[i]
+            next_frame = frame[i] - first_frame + 1
+            for j in range(
+                frame_offsets[next_frame], frame_offsets[next_frame + 1]
+            ):
+                if group[j] == group_i:
+                    dx2 = (x_i - x[j]) ** 2
+                    if dx2 <= d_max_2:
+                        dy2 = (y_i - y[j]) ** 2
+                        if dy2 <= d_max_2:
+                            d = _np.sqrt(dx2 + dy2)
+                            if d <= d_max:
+                                bin = int(d / bin_size)
+                                if bin < n_bins:
+                                    dnfl[t, bin] += 1
+
+
+def pair_correlation(
+    locs,
+    info,
+    bin_size,
+    r_max,
+    locs_b=None,
+    pixelsize=None,
+    edge_correction=False,
+):
+    """
+    Pair distance histogram divided by the area (or, if pixelsize is
+    given, the volume) of each distance shell. See distance_histogram
+    for the arguments.
+    """
+    dh = distance_histogram(
+        locs, info, bin_size, r_max, locs_b, pixelsize, edge_correction
+    )
     # Start with r-> otherwise area will be 0
     bins_lower = _np.arange(bin_size, r_max + bin_size, bin_size)
 
     if bins_lower.shape[0] > dh.shape[0]:
         bins_lower = bins_lower[:-1]
-    area = _np.pi * bin_size * (2 * bins_lower + bin_size)
+    if pixelsize is None:
+        area = _np.pi * bin_size * (2 * bins_lower + bin_size)
+    else:
+        bins_upper = bins_lower + bin_size
+        area = 4 / 3 * _np.pi * (bins_upper ** 3 - bins_lower ** 3)
     return bins_lower, dh / area
 
 
-def dbscan(locs, radius, min_density):
+def _cell_index(X, size, origin=None, n_cells=None):
+    """
+    Sorts points into cubic cells of the given size. Returns the sort
+    order, the cell coordinates of the sorted points, the sorted linear
+    ids of the occupied cells with their start and end indices
+    and the number of cells along each axis.
+    The grid starts at the minimum of X unless origin and n_cells are
+    given, e.g., to index several point sets on the same grid.
+    Memory is linear in the number of points.
+    """
+    if origin is None:
+        origin = X.min(axis=0)
+    cells = _np.floor((X - origin) / size).astype(_np.int64)
+    if n_cells is None:
+        n_cells = cells.max(axis=0) + 1
+    ids = cells[:, 0] + n_cells[0] * (cells[:, 1] + n_cells[1] * cells[:, 2])
+    order = _np.argsort(ids, kind="stable")
+    cell_ids, cell_starts = _np.unique(ids[order], return_index=True)
+    cell_ends = _np.append(cell_starts[1:], len(X))
+    return order, cells[order], cell_ids, cell_starts, cell_ends, n_cells
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _cells_around(x, y, z, cell_ids, n_cells):
+    """
+    Indices of the occupied cells around (and including) the cell with
+    the coordinates x, y, z
+    """
+    neighbors = _np.empty(27, dtype=_np.int64)
+    n = 0
+    for z_ in range(z - 1, z + 2):
+        if z_ < 0 or z_ >= n_cells[2]:
+            continue
+        for y_ in range(y - 1, y + 2):
+            if y_ < 0 or y_ >= n_cells[1]:
+                continue
+            for x_ in range(x - 1, x + 2):
+                if x_ < 0 or x_ >= n_cells[0]:
+                    continue
+                id = x_ + n_cells[0] * (y_ + n_cells[1] * z_)
+                i = _np.searchsorted(cell_ids, id)
+                if i < len(cell_ids) and cell_ids[i] == id:
+                    neighbors[n] = i
+                    n += 1
+    return neighbors[:n]
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _neighbor_cells(c, cells, cell_starts, cell_ids, n_cells):
+    """ Indices of the occupied cells around (and including) cell c """
+    k = cell_starts[c]
+    return _cells_around(
+        cells[k, 0], cells[k, 1], cells[k, 2], cell_ids, n_cells
+    )
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _dbscan_core(
+    X, cells, cell_ids, cell_starts, cell_ends, n_cells, radius, min_samples
+):
+    """
+    Marks the points with at least min_samples points (including
+    themselves) within the radius
+    """
+    r2 = radius ** 2
+    is_core = _np.zeros(len(X), dtype=_np.bool_)
+    for c in _numba.prange(len(cell_ids)):
+        neighbors = _neighbor_cells(c, cells, cell_starts, cell_ids, n_cells)
+        for i in range(cell_starts[c], cell_ends[c]):
+            n = 0
+            for m in neighbors:
+                for j in range(cell_starts[m], cell_ends[m]):
+                    d2 = (
+                        (X[i, 0] - X[j, 0]) ** 2
+                        + (X[i, 1] - X[j, 1]) ** 2
+                        + (X[i, 2] - X[j, 2]) ** 2
+                    )
+                    if d2 <= r2:
+                        n += 1
+                if n >= min_samples:
+                    is_core[i] = True
+                    break
+    return is_core
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    # Path compression
+    while parent[i] != root:
+        next_ = parent[i]
+        parent[i] = root
+        i = next_
+    return root
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dbscan_merge(
+    X, cells, cell_ids, cell_starts, cell_ends, n_cells, radius, is_core
+):
+    """ Joins core points within the radius with a union-find forest """
+    r2 = radius ** 2
+    parent = _np.arange(len(X))
+    for c in range(len(cell_ids)):
+        neighbors = _neighbor_cells(c, cells, cell_starts, cell_ids, n_cells)
+        for i in range(cell_starts[c], cell_ends[c]):
+            if not is_core[i]:
+                continue
+            for m in neighbors:
+                for j in range(max(i + 1, cell_starts[m]), cell_ends[m]):
+                    if not is_core[j]:
+                        continue
+                    root_i = _find(parent, i)
+                    root_j = _find(parent, j)
+                    # Points already in the same cluster need no distance
+                    if root_i == root_j:
+                        continue
+                    d2 = (
+                        (X[i, 0] - X[j, 0]) ** 2
+                        + (X[i, 1] - X[j, 1]) ** 2
+                        + (X[i, 2] - X[j, 2]) ** 2
+                    )
+                    if d2 <= r2:
+                        if root_i < root_j:
+                            parent[root_j] = root_i
+                        else:
+                            parent[root_i] = root_j
+    return parent
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dbscan_cluster_labels(parent, is_core, order):
+    """
+    Numbers the clusters in the order of their first core point in the
+    original point order, as scikit-learn does. Returns the labels of the
+    core points (-1 for all other points) in sorted order.
+    """
+    N = len(parent)
+    first = _np.full(N, N, dtype=_np.int64)
+    for i in range(N):
+        if is_core[i]:
+            root = _find(parent, i)
+            if order[i] < first[root]:
+                first[root] = order[i]
+    roots = _np.where(first < N)[0]
+    ranks = _np.argsort(first[roots])
+    root_labels = _np.full(N, -1, dtype=_np.int64)
+    for label in range(len(ranks)):
+        root_labels[roots[ranks[label]]] = label
+    labels = _np.full(N, -1, dtype=_np.int64)
+    for i in range(N):
+        if is_core[i]:
+            labels[i] = root_labels[_find(parent, i)]
+    return labels
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _dbscan_border_labels(
+    X,
+    cells,
+    cell_ids,
+    cell_starts,
+    cell_ends,
+    n_cells,
+    radius,
+    labels,
+    is_core,
+):
+    """
+    Assigns non-core points within the radius of a core point to the
+    lowest cluster label among these core points, as scikit-learn does
+    """
+    r2 = radius ** 2
+    border_labels = labels.copy()
+    for c in _numba.prange(len(cell_ids)):
+        neighbors = _neighbor_cells(c, cells, cell_starts, cell_ids, n_cells)
+        for i in range(cell_starts[c], cell_ends[c]):
+            if is_core[i]:
+                continue
+            label = -1
+            for m in neighbors:
+                for j in range(cell_starts[m], cell_ends[m]):
+                    if not is_core[j]:
+                        continue
+                    if label != -1 and labels[j] >= label:
+                        continue
+                    d2 = (
+                        (X[i, 0] - X[j, 0]) ** 2
+                        + (X[i, 1] - X[j, 1]) ** 2
+                        + (X[i, 2] - X[j, 2]) ** 2
+                    )
+                    if d2 <= r2:
+                        label = labels[j]
+            border_labels[i] = label
+    return border_labels
+
+
+def dbscan_labels(X, radius, min_samples):
+    """
+    Density-based clustering of the points X (N x 2 or N x 3) on a grid
+    index with cells of the size of the radius. Labels are the same as
+    those of scikit-learn's DBSCAN with eps=radius, with -1 for noise.
+    """
+    N, D = X.shape
+    if N == 0:
+        return _np.zeros(0, dtype=_np.int32)
+    X_ = _np.zeros((N, 3), dtype=_np.float64)
+    X_[:, :D] = X
+    order, cells, cell_ids, cell_starts, cell_ends, n_cells = _cell_index(
+        X_, radius
+    )
+    X_ = X_[order]
+    index = (cells, cell_ids, cell_starts, cell_ends, n_cells, radius)
+    is_core = _dbscan_core(X_, *index, min_samples)
+    parent = _dbscan_merge(X_, *index, is_core)
+    labels = _dbscan_cluster_labels(parent, is_core, order)
+    labels = _dbscan_border_labels(X_, *index, labels, is_core)
+    group = _np.empty(N, dtype=_np.int32)  # int32 for Origin compatiblity
+    group[order] = labels
+    return group
+
+
+def dbscan(locs, radius, min_density, pixelsize=None):
     print("Identifying clusters...")
     if hasattr(locs, "z"):
         print("z-coordinates detected")
-        pixelsize = int(input("Enter the pixelsize in nm/px:"))
+        if pixelsize is None:
+            pixelsize = int(input("Enter the pixelsize in nm/px:"))
         locs = locs[
             _np.isfinite(locs.x) & _np.isfinite(locs.y) & _np.isfinite(locs.z)
         ]
         X = _np.vstack((locs.x, locs.y, locs.z / pixelsize)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)  # int32 for Origin compatiblity
+        group = dbscan_labels(X, radius, min_density)
         locs = _lib.append_to_rec(locs, group, "group")
         locs = locs[locs.group != -1]
         print("Generating cluster information...")
-        groups = _np.unique(locs.group)
+        index = _lib.group_index(locs)
+        groups = index.groups
         n_groups = len(groups)
         mean_frame = _np.zeros(n_groups)
         std_frame = _np.zeros(n_groups)
@@ -322,8 +711,9 @@ def dbscan(locs, radius, min_density):
         convex_hull = _np.zeros(n_groups)
         volume = _np.zeros(n_groups)
         n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
+        for i, (group, group_locs) in enumerate(
+            _lib.group_slices(locs, index)
+        ):
             mean_frame[i] = _np.mean(group_locs.frame)
             com_x[i] = _np.mean(group_locs.x)
             com_y[i] = _np.mean(group_locs.y)
@@ -383,12 +773,12 @@ def dbscan(locs, radius, min_density):
     else:
         locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
         X = _np.vstack((locs.x, locs.y)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)  # int32 for Origin compatiblity
+        group = dbscan_labels(X, radius, min_density)
         locs = _lib.append_to_rec(locs, group, "group")
         locs = locs[locs.group != -1]
         print("Generating cluster information...")
-        groups = _np.unique(locs.group)
+        index = _lib.group_index(locs)
+        groups = index.groups
         n_groups = len(groups)
         mean_frame = _np.zeros(n_groups)
         std_frame = _np.zeros(n_groups)
@@ -399,8 +789,9 @@ def dbscan(locs, radius, min_density):
         convex_hull = _np.zeros(n_groups)
         area = _np.zeros(n_groups)
         n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
+        for i, (group, group_locs) in enumerate(
+            _lib.group_slices(locs, index)
+        ):
             mean_frame[i] = _np.mean(group_locs.frame)
             com_x[i] = _np.mean(group_locs.x)
             com_y[i] = _np.mean(group_locs.y)
@@ -445,6 +836,8 @@ def dbscan(locs, radius, min_density):
     return clusters, locs
 
 def hdbscan(locs, min_cluster_size, min_samples):
+    from hdbscan import HDBSCAN as _HDBSCAN
+
     print("Identifying clusters...")
     if hasattr(locs, "z"):
         print("z-coordinates detected")
@@ -460,7 +853,8 @@ def hdbscan(locs, min_cluster_size, min_samples):
         locs = _lib.append_to_rec(locs, group, "group")
         locs = locs[locs.group != -1]
         print("Generating cluster information...")
-        groups = _np.unique(locs.group)
+        index = _lib.group_index(locs)
+        groups = index.groups
         n_groups = len(groups)
         mean_frame = _np.zeros(n_groups)
         std_frame = _np.zeros(n_groups)
@@ -473,8 +867,9 @@ def hdbscan(locs, min_cluster_size, min_samples):
         convex_hull = _np.zeros(n_groups)
         volume = _np.zeros(n_groups)
         n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
+        for i, (group, group_locs) in enumerate(
+            _lib.group_slices(locs, index)
+        ):
             mean_frame[i] = _np.mean(group_locs.frame)
             com_x[i] = _np.mean(group_locs.x)
             com_y[i] = _np.mean(group_locs.y)
@@ -541,7 +936,8 @@ def hdbscan(locs, min_cluster_size, min_samples):
         locs = _lib.append_to_rec(locs, group, "group")
         locs = locs[locs.group != -1]
         print("Generating cluster information...")
-        groups = _np.unique(locs.group)
+        index = _lib.group_index(locs)
+        groups = index.groups
         n_groups = len(groups)
         mean_frame = _np.zeros(n_groups)
         std_frame = _np.zeros(n_groups)
@@ -552,8 +948,9 @@ def hdbscan(locs, min_cluster_size, min_samples):
         convex_hull = _np.zeros(n_groups)
         area = _np.zeros(n_groups)
         n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
+        for i, (group, group_locs) in enumerate(
+            _lib.group_slices(locs, index)
+        ):
             mean_frame[i] = _np.mean(group_locs.frame)
             com_x[i] = _np.mean(group_locs.x)
             com_y[i] = _np.mean(group_locs.y)
@@ -597,62 +994,77 @@ def hdbscan(locs, min_cluster_size, min_samples):
         )
     return clusters, locs
 
-@_numba.jit(nopython=True, nogil=True)
-def _local_density(
-    locs, radius, x_index, y_index, block_starts, block_ends, start, chunk
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _fill_neighbor_counts(
+    X, cells, cell_ids, cell_starts, cell_ends, n_cells, radius, counts
 ):
-    x = locs.x
-    y = locs.y
-    N = len(x)
+    """
+    Counts the points (including the point itself) closer than the radius
+    to each point, in parallel over the occupied cells
+    """
     r2 = radius ** 2
-    end = min(start + chunk, N)
-    density = _np.zeros(N, dtype=_np.uint32)
-    for i in range(start, end):
-        yi = y[i]
-        xi = x[i]
-        ki = y_index[i]
-        li = x_index[i]
-        di = 0
-        for k in range(ki - 1, ki + 2):
-            for l in range(li - 1, li + 2):
-                j_min = block_starts[k, l]
-                j_max = block_ends[k, l]
-                for j in range(j_min, j_max):
-                    dx2 = (xi - x[j]) ** 2
-                    if dx2 < r2:
-                        dy2 = (yi - y[j]) ** 2
-                        if dy2 < r2:
-                            d2 = dx2 + dy2
-                            if d2 < r2:
-                                di += 1
-        density[i] = di
-    return density
-
-
-def compute_local_density(locs, info, radius):
-    locs, x_index, y_index, block_starts, block_ends = get_index_blocks(
-        locs, info, radius
+    for c in _numba.prange(len(cell_ids)):
+        neighbors = _neighbor_cells(c, cells, cell_starts, cell_ids, n_cells)
+        for i in range(cell_starts[c], cell_ends[c]):
+            n = 0
+            for m in neighbors:
+                for j in range(cell_starts[m], cell_ends[m]):
+                    d2 = (
+                        (X[i, 0] - X[j, 0]) ** 2
+                        + (X[i, 1] - X[j, 1]) ** 2
+                        + (X[i, 2] - X[j, 2]) ** 2
+                    )
+                    if d2 < r2:
+                        n += 1
+            counts[i] = n
+
+
+def neighbor_counts(X, radius):
+    """
+    Number of points closer than the radius to each of the points X
+    (N x 2 or N x 3), including the point itself, on a grid index
+    with cells of the size of the radius.
+    """
+    N, D = X.shape
+    counts = _np.zeros(N, dtype=_np.uint32)
+    if N == 0:
+        return counts
+    X_ = _np.zeros((N, 3), dtype=_np.float64)
+    X_[:, :D] = X
+    order, cells, cell_ids, cell_starts, cell_ends, n_cells = _cell_index(
+        X_, radius
     )
-    N = len(locs)
-    n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [
-        (
-            locs,
-            radius,
-            x_index,
-            y_index,
-            block_starts,
-            block_ends,
-            start,
-            chunk,
-        )
-        for start in starts
-    ]
-    with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_local_density, *_) for _ in args]
-    density = _np.sum([future.result() for future in futures], axis=0)
+    sorted_counts = _np.zeros(N, dtype=_np.uint32)
+    _fill_neighbor_counts(
+        X_[order],
+        cells,
+        cell_ids,
+        cell_starts,
+        cell_ends,
+        n_cells,
+        radius,
+        sorted_counts,
+    )
+    counts[order] = sorted_counts
+    return counts
+
+
+def compute_local_density(locs, info, radius, z_radius=None):
+    """
+    Appends the number of locs within the radius (in pixels) of each loc
+    as the field density. If z_radius is given, locs count as local
+    within the ellipsoid of the radius in x and y and z_radius
+    (in the unit of z) in z.
+    """
+    if z_radius is not None and not hasattr(locs, "z"):
+        raise ValueError("z_radius requires locs with z coordinates.")
+    locs = _lib.ensure_sanity(locs, info)
+    if z_radius is None:
+        X = _np.stack((locs.x, locs.y), axis=1)
+    else:
+        # Scale z so that the ellipsoid becomes a sphere of the radius
+        X = _np.stack((locs.x, locs.y, locs.z * radius / z_radius), axis=1)
+    density = neighbor_counts(X, radius)
     locs = _lib.remove_from_rec(locs, "density")
     return _lib.append_to_rec(locs, density, "density")
 
@@ -675,7 +1087,7 @@ def dark_times(locs, group=None):
     return dark
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _dark_times(locs, group, last_frame):
     N = len(locs)
     max_frame = locs.frame.max()
@@ -763,285 +1175,152 @@ def weighted_variance(locs):
 
 
 # Combine localizations: calculate the properties of the group
+def _cluster_index(locs):
+    """
+    Returns the locs sorted by group and cluster and the offsets of the
+    (group, cluster) segments, ending with len(locs)
+    """
+    order = _np.lexsort((locs["cluster"], locs["group"]))
+    sorted_locs = locs[order]
+    group = sorted_locs["group"]
+    cluster = sorted_locs["cluster"]
+    is_start = _np.ones(len(locs), dtype=bool)
+    is_start[1:] = (group[1:] != group[:-1]) | (cluster[1:] != cluster[:-1])
+    offsets = _np.append(_np.flatnonzero(is_start), len(locs))
+    return sorted_locs, offsets
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _segment_weighted_mean(values, weights, offsets, mean):
+    """ Fills the weighted mean of the values in each segment """
+    for k in _numba.prange(len(offsets) - 1):
+        sum_ = 0.0
+        sum_weights = 0.0
+        for i in range(offsets[k], offsets[k + 1]):
+            sum_ += weights[i] * values[i]
+            sum_weights += weights[i]
+        mean[k] = sum_ / sum_weights
+
+
 def cluster_combine(locs):
+    """
+    Combines the locs of each cluster within each group to their
+    photon-weighted center with the standard error of the mean
+    """
     print("Combining localizations...")
-    combined_locs = []
+    sorted_locs, offsets = _cluster_index(locs)
+    starts = offsets[:-1]
+    n_clusters = len(starts)
+    n = _np.diff(offsets)
+    mean_frame = _np.zeros(n_clusters)
+    std_frame = _np.zeros(n_clusters)
+    _segment_mean_std(sorted_locs.frame, offsets, mean_frame, std_frame)
     if hasattr(locs[0], "z"):
         print("z-mode")
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            com_z = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            std_z = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(
-                    cluster_locs.x, weights=cluster_locs.photons
-                )
-                com_y[i] = _np.average(
-                    cluster_locs.y, weights=cluster_locs.photons
-                )
-                com_z[i] = _np.average(
-                    cluster_locs.z, weights=cluster_locs.photons
-                )
-                std_frame[i] = _np.std(cluster_locs.frame)
-                std_x[i] = _np.std(cluster_locs.x) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_y[i] = _np.std(cluster_locs.y) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_z[i] = _np.std(cluster_locs.z) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    com_z,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    std_z,
-                    n,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("z", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("lpz", "f4"),
-                    ("n", "i4"),
-                ],
-            )
-            combined_locs.append(clusters)
+        coordinates = ["x", "y", "z"]
     else:
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(
-                    cluster_locs.x, weights=cluster_locs.photons
-                )
-                com_y[i] = _np.average(
-                    cluster_locs.y, weights=cluster_locs.photons
-                )
-                std_frame[i] = _np.std(cluster_locs.frame)
-                std_x[i] = _np.std(cluster_locs.x) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_y[i] = _np.std(cluster_locs.y) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    n,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("n", "i4"),
-                ],
-            )
-            combined_locs.append(clusters)
+        coordinates = ["x", "y"]
+    columns = [sorted_locs.group[starts], sorted_locs.cluster[starts]]
+    columns.append(mean_frame)
+    lps = []
+    for coordinate in coordinates:
+        values = sorted_locs[coordinate]
+        com = _np.zeros(n_clusters)
+        _segment_weighted_mean(values, sorted_locs.photons, offsets, com)
+        columns.append(com)
+        mean = _np.zeros(n_clusters)
+        std = _np.zeros(n_clusters)
+        _segment_mean_std(values, offsets, mean, std)
+        lps.append(std / _np.sqrt(n))
+    columns.append(std_frame)
+    columns.extend(lps)
+    columns.append(n)
+    dtype = [
+        ("group", locs.group.dtype),
+        ("cluster", locs.cluster.dtype),
+        ("mean_frame", "f4"),
+    ]
+    dtype += [(_, "f4") for _ in coordinates]
+    dtype.append(("std_frame", "f4"))
+    dtype += [("lp" + _, "f4") for _ in coordinates]
+    dtype.append(("n", "i4"))
+    return _np.rec.array(tuple(columns), dtype=dtype)
 
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
 
-    return combined_locs
+def _group_nearest_neighbor_distance(X, group):
+    """
+    Distance from each point to its nearest neighbor of the same group,
+    nan for points without neighbors in their group. One KD-tree holds
+    all groups, separated along an extra axis by more than any distance
+    within a group.
+    """
+    if len(X) == 0:
+        return _np.zeros(0)
+    ranks = _np.unique(group, return_inverse=True)[1]
+    spacing = 2 * _np.sum(_np.ptp(X, axis=0)) + 1
+    X = _np.column_stack((X, spacing * ranks))
+    d = _neighbors.knn_distances(X)[:, 0]
+    d[d >= spacing] = _np.nan
+    return d
 
 
 def cluster_combine_dist(locs):
+    """
+    Appends the distance of each combined cluster to the nearest
+    cluster of its group (min_dist). 3D data get the distance in xyz,
+    with z converted to pixels, and in xy (mind_dist_xy).
+    """
     print("Calculating distances...")
-
+    locs = locs[_np.lexsort((locs["cluster"], locs["group"]))]
+    X_xy = _np.column_stack((locs.x, locs.y))
+    min_dist_xy = _group_nearest_neighbor_distance(X_xy, locs.group)
     if hasattr(locs, "z"):
         print("XYZ")
         pixelsize = int(input("Enter the pixelsize in nm/px:"))
-
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = temp["mean_frame"]
-            std_frame = temp["std_frame"]
-            com_x = temp["x"]
-            com_y = temp["y"]
-            com_z = temp["z"]
-            std_x = temp["lpx"]
-            std_y = temp["lpy"]
-            std_z = temp["lpz"]
-            group_id = temp["group"]
-            n = temp["n"]
-            min_dist = _np.zeros(n_cluster)
-            min_dist_xy = _np.zeros(n_cluster)
-            for i, clusterval in enumerate(cluster):
-                # find nearest neighbor in xyz
-                group_locs = temp[temp["cluster"] != clusterval]
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                ref_point = _np.array(
-                    [
-                        cluster_locs.x,
-                        cluster_locs.y,
-                        cluster_locs.z / pixelsize,
-                    ]
-                )
-                all_points = _np.array(
-                    [group_locs.x, group_locs.y, group_locs.z / pixelsize]
-                )
-                distances = distance.cdist(
-                    ref_point.transpose(), all_points.transpose()
-                )
-                min_dist[i] = _np.amin(distances)
-                # find nearest neighbor in xy
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(
-                    ref_point_xy.transpose(), all_points_xy.transpose()
-                )
-                min_dist_xy[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    com_z,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    std_z,
-                    n,
-                    min_dist,
-                    min_dist_xy,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("z", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("lpz", "f4"),
-                    ("n", "i4"),
-                    ("min_dist", "f4"),
-                    ("mind_dist_xy", "f4"),
-                ],
-            )
-            combined_locs.append(clusters)
-
-    else:  # 2D case
+        X = _np.column_stack((X_xy, locs.z / pixelsize))
+        min_dist = _group_nearest_neighbor_distance(X, locs.group)
+        coordinates = ["x", "y", "z"]
+        min_dists = [("min_dist", min_dist), ("mind_dist_xy", min_dist_xy)]
+    else:
         print("XY")
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = temp["mean_frame"]
-            std_frame = temp["std_frame"]
-            com_x = temp["x"]
-            com_y = temp["y"]
-            std_x = temp["lpx"]
-            std_y = temp["lpy"]
-            group_id = temp["group"]
-            n = temp["n"]
-            min_dist = _np.zeros(n_cluster)
-
-            for i, clusterval in enumerate(cluster):
-                # find nearest neighbor in xyz
-                group_locs = temp[temp["cluster"] != clusterval]
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(
-                    ref_point_xy.transpose(), all_points_xy.transpose()
-                )
-                min_dist[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    n,
-                    min_dist,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("n", "i4"),
-                    ("min_dist", "f4"),
-                ],
-            )
-            combined_locs.append(clusters)
-
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
-    return combined_locs
-
-
-@_numba.jit(nopython=True)
+        coordinates = ["x", "y"]
+        min_dists = [("min_dist", min_dist_xy)]
+    names = ["group", "cluster", "mean_frame"] + coordinates + ["std_frame"]
+    names += ["lp" + _ for _ in coordinates] + ["n"]
+    columns = [locs[_] for _ in names] + [_[1] for _ in min_dists]
+    dtype = [("group", locs.group.dtype), ("cluster", locs.cluster.dtype)]
+    dtype += [(_, "f4") for _ in names[2:-1]] + [("n", "i4")]
+    dtype += [(_[0], "f4") for _ in min_dists]
+    return _np.rec.array(tuple(columns), dtype=dtype)
+
+
+def cluster_filter(locs, clusters, ranges):
+    """
+    Splits the locs by the properties of their clusters (matched by
+    group) into the locs of the clusters with all properties in range
+    and those of the other clusters. ranges is a list of
+    (parameter, minval, maxval) with exclusive bounds.
+    Locs of groups without a cluster are in neither output.
+    Returns both locs and the cluster selector.
+    """
+    selector = _np.ones(len(clusters), dtype=bool)
+    for parameter, minval, maxval in ranges:
+        values = clusters[parameter]
+        selector &= (values > minval) & (values < maxval)
+    if len(clusters) == 0:
+        return locs[:0], locs[:0], selector
+    # Look up the cluster of each loc in the clusters sorted by group
+    order = _np.argsort(clusters["groups"])
+    groups = clusters["groups"][order]
+    i = _np.searchsorted(groups, locs.group).clip(max=len(groups) - 1)
+    has_cluster = groups[i] == locs.group
+    is_in_range = selector[order][i]
+    in_range = has_cluster & is_in_range
+    out_of_range = has_cluster & ~is_in_range
+    return locs[in_range], locs[out_of_range], selector
+
+
+@_numba.jit(nopython=True, cache=True)
 def get_link_groups(locs, d_max, max_dark_time, group):
     """ Assumes that locs are sorted by frame """
     frame = locs.frame
@@ -1083,7 +1362,7 @@ def get_link_groups(locs, d_max, max_dark_time, group):
     return link_group
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _get_next_loc_index_in_link_group(
     current_index, link_group, N, frame, x, y, d_max, max_dark_time, group
 ):
@@ -1114,7 +1393,7 @@ def _get_next_loc_index_in_link_group(
     return -1
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_count(link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=_np.uint32)
     for i in range(n_locs):
@@ -1123,7 +1402,7 @@ def _link_group_count(link_group, n_locs, n_groups):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_sum(column, link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=column.dtype)
     for i in range(n_locs):
@@ -1132,7 +1411,7 @@ def _link_group_sum(column, link_group, n_locs, n_groups):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_mean(column, link_group, n_locs, n_groups, n_locs_per_group):
     group_sum = _link_group_sum(column, link_group, n_locs, n_groups)
     result = _np.empty(
@@ -1142,7 +1421,7 @@ def _link_group_mean(column, link_group, n_locs, n_groups, n_locs_per_group):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_weighted_mean(
     column, weights, link_group, n_locs, n_groups, n_locs_per_group
 ):
@@ -1155,7 +1434,7 @@ def _link_group_weighted_mean(
     )
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_min_max(column, link_group, n_locs, n_groups):
     min_ = _np.empty(n_groups, dtype=column.dtype)
     max_ = _np.empty(n_groups, dtype=column.dtype)
@@ -1171,7 +1450,7 @@ def _link_group_min_max(column, link_group, n_locs, n_groups):
     return min_, max_
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_last(column, link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=column.dtype)
     for i in range(n_locs):
@@ -1299,6 +1578,9 @@ def undrift(
     drift = (drift_x_pol(t_inter), drift_y_pol(t_inter))
     drift = _np.rec.array(drift, dtype=[("x", "f"), ("y", "f")])
     if display:
+        import matplotlib.pyplot as _plt
+
+        _plt.style.use("ggplot")
         fig1 = _plt.figure(figsize=(17, 6))
         _plt.suptitle("Estimated drift")
         _plt.subplot(1, 2, 1)
@@ -1362,8 +1644,8 @@ def groupprops(locs, callback=None):
         locs = locs[locs.dark != -1]
     except AttributeError:
         pass
-    group_ids = _np.unique(locs.group)
-    n = len(group_ids)
+    index = _lib.group_index(locs)
+    n = len(index.groups)
     n_cols = len(locs.dtype)
     names = ["group", "n_events"] + list(
         _itertools.chain(
@@ -1374,20 +1656,42 @@ def groupprops(locs, callback=None):
     groups = _np.recarray(n, formats=formats, names=names)
     if callback is not None:
         callback(0)
-    for i, group_id in enumerate(
-        _tqdm(group_ids, desc="Calculating group statistics", unit="Groups")
-    ):
-        group_locs = locs[locs.group == group_id]
-        groups["group"][i] = group_id
-        groups["n_events"][i] = len(group_locs)
-        for name in locs.dtype.names:
-            groups[name + "_mean"][i] = _np.mean(group_locs[name])
-            groups[name + "_std"][i] = _np.std(group_locs[name])
-        if callback is not None:
-            callback(i + 1)
+    groups["group"] = index.groups
+    groups["n_events"] = _np.diff(index.offsets)
+    sorted_locs = _lib.sort_by_group(locs, index)
+    for name in locs.dtype.names:
+        _segment_mean_std(
+            sorted_locs[name],
+            index.offsets,
+            groups[name + "_mean"],
+            groups[name + "_std"],
+        )
+    if callback is not None:
+        callback(n)
     return groups
 
 
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _segment_mean_std(values, offsets, mean, std):
+    """
+    Fills the mean and standard deviation of the values in each segment
+    between consecutive offsets, accumulating in double precision
+    """
+    for k in _numba.prange(len(offsets) - 1):
+        start = offsets[k]
+        end = offsets[k + 1]
+        n = end - start
+        sum_ = 0.0
+        for i in range(start, end):
+            sum_ += values[i]
+        mean_ = sum_ / n
+        sum_2 = 0.0
+        for i in range(start, end):
+            sum_2 += (values[i] - mean_) ** 2
+        mean[k] = mean_
+        std[k] = _np.sqrt(sum_2 / n)
+
+
 def calculate_fret(acc_locs, don_locs):
     """
     Calculate the FRET efficiceny in picked regions, this is for one trace
@@ -1423,12 +1727,12 @@ def calculate_fret(acc_locs, don_locs):
     f_locs = []
     if len(fret_timepoints) > 0:
         # Calculate FRET locs: Select the locs when FRET happens
-        sel_locs = []
-        for element in fret_timepoints:
-            sel_locs.append(don_locs[don_locs["frame"] == element])
-
-        f_locs = stack_arrays(sel_locs, asrecarray=True, usemask=False)
-        f_locs = _lib.append_to_rec(f_locs, _np.array(fret_events), "fret")
+        is_fret = _np.isin(don_locs["frame"], fret_timepoints)
+        f_locs = don_locs[is_fret]
+        f_locs = f_locs[_np.argsort(f_locs["frame"], kind="stable")]
+        f_locs = _lib.append_to_rec(
+            f_locs, fret_trace[f_locs["frame"]], "fret"
+        )
 
     fret_dict["fret_events"] = _np.array(fret_events)
     fret_dict["fret_timepoints"] = fret_timepoints
@@ -1438,3 +1742,54 @@ def calculate_fret(acc_locs, don_locs):
     fret_dict["maxframes"] = max_frames
 
     return fret_dict, f_locs
+
+
+def _trace_values(locs, n_frames):
+    """
+    Returns the sorted (group, frame) keys of the locs and their photons
+    above background as integers. Of several locs in the same frame,
+    the last one counts, as when filling a trace.
+    """
+    keys = locs["group"].astype(_np.int64) * n_frames + locs["frame"]
+    values = _np.int64(locs["photons"] - locs["bg"])
+    keys, i = _np.unique(keys[::-1], return_index=True)
+    return keys, values[::-1][i]
+
+
+def calculate_fret_batch(acc_locs, don_locs):
+    """
+    Calculates the FRET efficiencies of all picks at once, given the
+    picked locs of the acceptor and donor channels with the pick index
+    in the group field. Returns the FRET events (group, frame, fret)
+    sorted by group and frame, and the donor locs of these events with
+    their efficiency in the field fret, as calculate_fret does per pick.
+    """
+    n_frames = 1 + int(
+        max(acc_locs["frame"].max(initial=0), don_locs["frame"].max(initial=0))
+    )
+    acc_keys, acc_values = _trace_values(acc_locs, n_frames)
+    don_keys, don_values = _trace_values(don_locs, n_frames)
+    # Frames without an acceptor or donor event have an efficiency of 0 or 1
+    keys, i_acc, i_don = _np.intersect1d(
+        acc_keys, don_keys, assume_unique=True, return_indices=True
+    )
+    acc = acc_values[i_acc]
+    don = don_values[i_don]
+    with _np.errstate(divide="ignore", invalid="ignore"):
+        fret = acc / (acc + don)
+    # Only select FRET values between 0 and 1
+    selector = (fret > 0) & (fret < 1)
+    keys = keys[selector]
+    fret = fret[selector]
+    events = _np.rec.array(
+        (keys // n_frames, keys % n_frames, fret),
+        dtype=[("group", "i4"), ("frame", "u4"), ("fret", "f8")],
+    )
+    don_keys = don_locs["group"].astype(_np.int64) * n_frames
+    don_keys += don_locs["frame"]
+    is_fret = _np.isin(don_keys, keys)
+    order = _np.argsort(don_keys[is_fret], kind="stable")
+    fret_locs = don_locs[is_fret][order]
+    i_event = _np.searchsorted(keys, don_keys[is_fret][order])
+    fret_locs = _lib.append_to_rec(fret_locs, fret[i_event], "fret")
+    return events, fret_locs
@@ -7,13 +7,33 @@
     :author: Joerg Schnitzbauer, 2015
     :copyright: Copyright (c) 2015 Jungmann Lab, MPI of Biochemistry
 """
+import math as _math
+import threading as _threading
+from collections import OrderedDict as _OrderedDict
 import numpy as _np
 import numba as _numba
 import scipy.signal as _signal
+from tqdm import tqdm as _tqdm
 from tqdm import trange as _trange
+from . import io as _io
+from . import lib as _lib
 
 
 _DRAW_MAX_SIGMA = 3
+# Side length (pixels) of the image tiles that are drawn in parallel
+_GAUSSIAN_TILE_SIZE = 64
+# Number of columns that are convolved together in y
+_CONVOLVE_STRIP_WIDTH = 32
+# Kernel sizes (sum of both sides, pixels) up to which, and image sizes
+# (pixels) from which images are convolved separably instead of with FFTs
+_DIRECT_CONVOLVE_MAX_KERNEL = 62
+_FFT_CONVOLVE_MAX_PIXELS = 4096 ** 2
+
+# Side length (pixels) of the histogram tiles of a TilePyramid
+# and of the tiles of TIFF files
+TILE_SIZE = 256
+# Side length (tiles) of the blocks that are rendered to TIFF files at once
+TIFF_BLOCK_TILES = 8
 
 
 def render(
@@ -23,13 +43,24 @@ def render(
     viewport=None,
     blur_method=None,
     min_blur_width=0,
+    index=None,
 ):
+    """
+    Renders the locs in the viewport. If a spatial index of locs in
+    Morton order is given (see lib.sort_spatially), only the locs in its
+    range of the viewport are scanned.
+    """
     if viewport is None:
         try:
             viewport = [(0, 0), (info[0]["Height"], info[0]["Width"])]
         except TypeError:
             raise ValueError("Need info if no viewport is provided.")
     (y_min, x_min), (y_max, x_max) = viewport
+    if index is not None:
+        start, end = _lib.spatial_range(index, y_min, x_min, y_max, x_max)
+        locs = locs[start:end]
+    if isinstance(locs, RenderLocs):
+        locs = locs.records(viewport)
     if blur_method is None:
         return render_hist(locs, oversampling, y_min, x_min, y_max, x_max)
     elif blur_method == "gaussian":
@@ -50,7 +81,61 @@ def render(
         raise Exception("blur_method not understood.")
 
 
-@_numba.jit(nopython=True, nogil=True)
+class RenderLocs:
+    """
+    Compact structure of arrays of the columns that rendering needs: x, y,
+    lpx and lpy, and z and lpz if present. The precisions are stored as
+    float16 if half_precision, which is accurate to 0.05 %. Indexing
+    returns the RenderLocs of the selected locs, like indexing locs.
+    The render functions take RenderLocs in place of locs.
+    """
+
+    COLUMNS = ("x", "y", "lpx", "lpy", "z", "lpz")
+
+    def __init__(self, locs, half_precision=True):
+        self.names = [_ for _ in self.COLUMNS if _ in locs.dtype.names]
+        for name in self.names:
+            if name.startswith("lp") and half_precision:
+                column = locs[name].astype(_np.float16)
+            else:
+                column = locs[name].astype(_np.float32)
+            setattr(self, name, column)
+        self.dtype = _np.dtype(
+            [(_, getattr(self, _).dtype) for _ in self.names]
+        )
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        locs = RenderLocs.__new__(RenderLocs)
+        locs.names = self.names
+        locs.dtype = self.dtype
+        for name in self.names:
+            setattr(locs, name, getattr(self, name)[index])
+        return locs
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, _).nbytes for _ in self.names)
+
+    def records(self, viewport=None):
+        """
+        The locs, or those in the viewport, as a record array with float32
+        columns, as the render kernels take them
+        """
+        locs = self
+        if viewport is not None:
+            (y_min, x_min), (y_max, x_max) = viewport
+            x, y = self.x, self.y
+            locs = self[(x > x_min) & (y > y_min) & (x < x_max) & (y < y_max)]
+        return _np.rec.fromarrays(
+            [getattr(locs, _).astype(_np.float32) for _ in self.names],
+            names=self.names,
+        )
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setup(locs, oversampling, y_min, x_min, y_max, x_max):
     n_pixel_y = int(_np.ceil(oversampling * (y_max - y_min)))
     n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
@@ -65,7 +150,7 @@ def _render_setup(locs, oversampling, y_min, x_min, y_max, x_max):
     return image, n_pixel_y, n_pixel_x, x, y, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setup3d(
     locs, oversampling, y_min, x_min, y_max, x_max, z_min, z_max, pixelsize
 ):
@@ -93,7 +178,7 @@ def _render_setup3d(
     return image, n_pixel_y, n_pixel_x, n_pixel_z, x, y, z, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setupz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
     n_pixel_z = int(_np.ceil(oversampling * (z_max - z_min) / pixelsize))
@@ -108,7 +193,7 @@ def _render_setupz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     return image, n_pixel_z, n_pixel_x, x, z, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fill(image, x, y):
     x = x.astype(_np.int32)
     y = y.astype(_np.int32)
@@ -116,7 +201,13 @@ def _fill(image, x, y):
         image[j, i] += 1
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fill_weighted(image, x, y, weight):
+    for k in range(len(x)):
+        image[_np.int32(y[k]), _np.int32(x[k])] += weight
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fill3d(image, x, y, z):
     x = x.astype(_np.int32)
     y = y.astype(_np.int32)
@@ -126,7 +217,7 @@ def _fill3d(image, x, y, z):
     return image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_hist(locs, oversampling, y_min, x_min, y_max, x_max):
     image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(
         locs, oversampling, y_min, x_min, y_max, x_max
@@ -135,7 +226,7 @@ def render_hist(locs, oversampling, y_min, x_min, y_max, x_max):
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_histz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     image, n_pixel_z, n_pixel_x, x, z, in_view = _render_setupz(
         locs, oversampling, x_min, z_min, x_max, z_max, pixelsize
@@ -144,7 +235,7 @@ def render_histz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_hist3d(
     locs, oversampling, y_min, x_min, y_max, x_max, z_min, z_max, pixelsize
 ):
@@ -155,7 +246,108 @@ def render_hist3d(
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _gaussian_bounds(x, y, sx, sy, n_pixel_y, n_pixel_x):
+    """
+    Pixel ranges [i_min, i_max) x [j_min, j_max) within _DRAW_MAX_SIGMA
+    of the locs, clipped to the image
+    """
+    bounds = _np.empty((len(x), 4), dtype=_np.int64)
+    for k in range(len(x)):
+        max_y = _DRAW_MAX_SIGMA * sy[k]
+        i_min = _np.int32(y[k] - max_y)
+        if i_min < 0:
+            i_min = 0
+        i_max = _np.int32(y[k] + max_y + 1)
+        if i_max > n_pixel_y:
+            i_max = n_pixel_y
+        max_x = _DRAW_MAX_SIGMA * sx[k]
+        j_min = _np.int32(x[k] - max_x)
+        if j_min < 0:
+            j_min = 0
+        j_max = _np.int32(x[k] + max_x) + 1
+        if j_max > n_pixel_x:
+            j_max = n_pixel_x
+        bounds[k, 0] = i_min
+        bounds[k, 1] = i_max
+        bounds[k, 2] = j_min
+        bounds[k, 3] = j_max
+    return bounds
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _bin_into_tiles(bounds, n_tiles_y, n_tiles_x):
+    """
+    Lists of the locs (in their order) per image tile of size
+    _GAUSSIAN_TILE_SIZE, for the tiles that their pixel ranges overlap.
+    Returns the offsets of the lists and the concatenated lists.
+    """
+    T = _GAUSSIAN_TILE_SIZE
+    n_tiles = n_tiles_y * n_tiles_x
+    counts = _np.zeros(n_tiles + 1, dtype=_np.int64)
+    for k in range(len(bounds)):
+        i_min, i_max, j_min, j_max = bounds[k]
+        if i_min < i_max and j_min < j_max:
+            for ty in range(i_min // T, (i_max - 1) // T + 1):
+                for tx in range(j_min // T, (j_max - 1) // T + 1):
+                    counts[ty * n_tiles_x + tx + 1] += 1
+    offsets = _np.cumsum(counts)
+    tile_locs = _np.empty(offsets[-1], dtype=_np.int64)
+    position = offsets[:-1].copy()
+    for k in range(len(bounds)):
+        i_min, i_max, j_min, j_max = bounds[k]
+        if i_min < i_max and j_min < j_max:
+            for ty in range(i_min // T, (i_max - 1) // T + 1):
+                for tx in range(j_min // T, (j_max - 1) // T + 1):
+                    tile = ty * n_tiles_x + tx
+                    tile_locs[position[tile]] = k
+                    position[tile] += 1
+    return offsets, tile_locs
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True, parallel=True)
+def _fill_gaussian(image, x, y, sx, sy, weight):
+    """
+    Adds normalized 2D Gaussians, multiplied by weight (e.g., -1 to
+    remove them again), to the image. The locs are binned into
+    the image tiles that their Gaussians overlap, and the tiles are drawn
+    in parallel, each with products of 1D profiles of its locs.
+    """
+    n_pixel_y, n_pixel_x = image.shape
+    T = _GAUSSIAN_TILE_SIZE
+    n_tiles_y = (n_pixel_y + T - 1) // T
+    n_tiles_x = (n_pixel_x + T - 1) // T
+    n_tiles = n_tiles_y * n_tiles_x
+    bounds = _gaussian_bounds(x, y, sx, sy, n_pixel_y, n_pixel_x)
+    offsets, tile_locs = _bin_into_tiles(bounds, n_tiles_y, n_tiles_x)
+    for tile in _numba.prange(n_tiles):
+        ti_min = (tile // n_tiles_x) * T
+        ti_max = min(ti_min + T, n_pixel_y)
+        tj_min = (tile % n_tiles_x) * T
+        tj_max = min(tj_min + T, n_pixel_x)
+        profile_y = _np.empty(T)
+        profile_x = _np.empty(T)
+        for m in range(offsets[tile], offsets[tile + 1]):
+            k = tile_locs[m]
+            i_min = max(bounds[k, 0], ti_min)
+            i_max = min(bounds[k, 1], ti_max)
+            j_min = max(bounds[k, 2], tj_min)
+            j_max = min(bounds[k, 3], tj_max)
+            for i in range(i_min, i_max):
+                profile_y[i - i_min] = _np.exp(
+                    -((i - y[k] + 0.5) ** 2) / (2 * sy[k] ** 2)
+                )
+            norm = weight / (2 * _np.pi * sx[k] * sy[k])
+            for j in range(j_min, j_max):
+                profile_x[j - j_min] = norm * _np.exp(
+                    -((j - x[k] + 0.5) ** 2) / (2 * sx[k] ** 2)
+                )
+            for i in range(i_min, i_max):
+                for j in range(j_min, j_max):
+                    image[i, j] += profile_y[i - i_min] * profile_x[j - j_min]
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_gaussian(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -166,33 +358,11 @@ def render_gaussian(
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
     sy = blur_height[in_view]
     sx = blur_width[in_view]
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
-        max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
-        max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
-        for i in range(i_min, i_max):
-            for j in range(j_min, j_max):
-                image[i, j] += _np.exp(
-                    -(
-                        (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
-                        + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
-                    )
-                ) / (2 * _np.pi * sx_ * sy_)
+    _fill_gaussian(image, x, y, sx, sy, 1.0)
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_gaussian_iso(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -203,32 +373,159 @@ def render_gaussian_iso(
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
     sy = (blur_height[in_view] + blur_width[in_view]) / 2
     sx = sy
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
-        max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
-        max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
-        for i in range(i_min, i_max):
-            for j in range(j_min, j_max):
-                image[i, j] += _np.exp(
-                    -(
-                        (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
-                        + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
-                    )
-                ) / (2 * _np.pi * sx_ * sy_)
+    _fill_gaussian(image, x, y, sx, sy, 1.0)
     return len(x), image
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True, parallel=True)
+def _fill_gaussian3d(volume, x, y, sx, sy, z, sz, z_edges):
+    """
+    Adds Gaussians to the slices of a volume between z_edges, each slice
+    with the 2D Gaussian in x and y weighted by the integral of the
+    Gaussian in z over the slice. Slices of a loc with zero z precision
+    are those containing z (excluding their lower edge). Image tiles are
+    drawn in parallel, as in _fill_gaussian.
+    """
+    n_slices, n_pixel_y, n_pixel_x = volume.shape
+    T = _GAUSSIAN_TILE_SIZE
+    n_tiles_y = (n_pixel_y + T - 1) // T
+    n_tiles_x = (n_pixel_x + T - 1) // T
+    n_tiles = n_tiles_y * n_tiles_x
+    bounds = _gaussian_bounds(x, y, sx, sy, n_pixel_y, n_pixel_x)
+    offsets, tile_locs = _bin_into_tiles(bounds, n_tiles_y, n_tiles_x)
+    for tile in _numba.prange(n_tiles):
+        ti_min = (tile // n_tiles_x) * T
+        ti_max = min(ti_min + T, n_pixel_y)
+        tj_min = (tile % n_tiles_x) * T
+        tj_max = min(tj_min + T, n_pixel_x)
+        profile_y = _np.empty(T)
+        profile_x = _np.empty(T)
+        profile_z = _np.empty(n_slices)
+        for m in range(offsets[tile], offsets[tile + 1]):
+            k = tile_locs[m]
+            max_z = _DRAW_MAX_SIGMA * sz[k]
+            s_min = _np.searchsorted(z_edges, z[k] - max_z) - 1
+            s_max = _np.searchsorted(z_edges, z[k] + max_z)
+            s_min = max(s_min, 0)
+            s_max = min(s_max, n_slices)
+            for s in range(s_min, s_max):
+                if sz[k] > 0:
+                    scale = _np.sqrt(2) * sz[k]
+                    profile_z[s - s_min] = 0.5 * (
+                        _math.erf((z_edges[s + 1] - z[k]) / scale)
+                        - _math.erf((z_edges[s] - z[k]) / scale)
+                    )
+                elif z_edges[s] < z[k] <= z_edges[s + 1]:
+                    profile_z[s - s_min] = 1.0
+                else:
+                    profile_z[s - s_min] = 0.0
+            i_min = max(bounds[k, 0], ti_min)
+            i_max = min(bounds[k, 1], ti_max)
+            j_min = max(bounds[k, 2], tj_min)
+            j_max = min(bounds[k, 3], tj_max)
+            for i in range(i_min, i_max):
+                profile_y[i - i_min] = _np.exp(
+                    -((i - y[k] + 0.5) ** 2) / (2 * sy[k] ** 2)
+                )
+            norm = 1 / (2 * _np.pi * sx[k] * sy[k])
+            for j in range(j_min, j_max):
+                profile_x[j - j_min] = norm * _np.exp(
+                    -((j - x[k] + 0.5) ** 2) / (2 * sx[k] ** 2)
+                )
+            for s in range(s_min, s_max):
+                weight = profile_z[s - s_min]
+                if weight == 0:
+                    continue
+                for i in range(i_min, i_max):
+                    weight_y = weight * profile_y[i - i_min]
+                    for j in range(j_min, j_max):
+                        volume[s, i, j] += weight_y * profile_x[j - j_min]
+
+
+def z_precision(locs, pixelsize):
+    """
+    The z precision (nm) of the locs: their lpz field if present,
+    otherwise twice their mean lateral precision
+    """
+    if hasattr(locs, "lpz"):
+        return _np.asarray(locs.lpz, dtype=_np.float64)
+    return pixelsize * (locs.lpx + locs.lpy).astype(_np.float64)
+
+
+def render_gaussian3d(
+    locs,
+    oversampling,
+    y_min,
+    x_min,
+    y_max,
+    x_max,
+    z_edges,
+    pixelsize,
+    min_blur_width=0,
+    iso=False,
+    out=None,
+    chunk_size=16,
+):
+    """
+    Renders the locs to a volume of z slices between z_edges (nm), blurred
+    with the lateral precisions in x and y (averaged if iso) as in
+    render_gaussian, and with the z precision (see z_precision) in z.
+    Each slice holds the Gaussians weighted by their fraction within the
+    slice, so the slices add up to the 2D rendering.
+    The volume (slices, y, x) is rendered in one pass, or in chunks of
+    chunk_size slices into out if given (e.g., a memory-mapped array for
+    volumes larger than the memory).
+    Returns the number of locs in view in each slice and the volume.
+    """
+    if isinstance(locs, RenderLocs):
+        locs = locs.records([(y_min, x_min), (y_max, x_max)])
+    z_edges = _np.asarray(z_edges, dtype=_np.float64)
+    n_slices = len(z_edges) - 1
+    image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(
+        locs, oversampling, y_min, x_min, y_max, x_max
+    )
+    sx = oversampling * _np.maximum(locs.lpx[in_view], min_blur_width)
+    sy = oversampling * _np.maximum(locs.lpy[in_view], min_blur_width)
+    if iso:
+        sx = sy = (sx + sy) / 2
+    z = _np.asarray(locs.z[in_view], dtype=_np.float64)
+    sz = z_precision(locs[in_view], pixelsize)
+    sz = _np.maximum(sz, min_blur_width * pixelsize)
+    slices = _np.searchsorted(z_edges, z) - 1
+    in_slices = (slices >= 0) & (slices < n_slices)
+    n_locs = _np.bincount(slices[in_slices], minlength=n_slices)
+    shape = (n_slices, n_pixel_y, n_pixel_x)
+    in_memory = out is None
+    if in_memory:
+        out = _np.zeros(shape, dtype=_np.float32)
+        chunk_size = max(n_slices, 1)
+    for s_min in range(0, n_slices, chunk_size):
+        s_max = min(s_min + chunk_size, n_slices)
+        max_z = _DRAW_MAX_SIGMA * sz
+        in_chunk = (z + max_z > z_edges[s_min]) & (
+            z - max_z <= z_edges[s_max]
+        )
+        if in_memory:
+            volume = out
+        else:
+            volume = _np.zeros(
+                (s_max - s_min, n_pixel_y, n_pixel_x), dtype=_np.float32
+            )
+        _fill_gaussian3d(
+            volume,
+            x[in_chunk],
+            y[in_chunk],
+            sx[in_chunk],
+            sy[in_chunk],
+            z[in_chunk],
+            sz[in_chunk],
+            z_edges[s_min: s_max + 1],
+        )
+        if not in_memory:
+            out[s_min:s_max] = volume
+    return n_locs, out
+
+
 def render_convolve(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -246,7 +543,7 @@ def render_convolve(
         blur_height = oversampling * max(
             _np.median(locs.lpy[in_view]), min_blur_width
         )
-        return n, _fftconvolve(image, blur_width, blur_height)
+        return n, _gaussian_convolve(image, blur_width, blur_height)
 
 
 def render_smooth(locs, oversampling, y_min, x_min, y_max, x_max):
@@ -258,17 +555,675 @@ def render_smooth(locs, oversampling, y_min, x_min, y_max, x_max):
     if n == 0:
         return 0, image
     else:
-        return n, _fftconvolve(image, 1, 1)
+        return n, _gaussian_convolve(image, 1, 1)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True, parallel=True)
+def _convolve_separable(image, kernel_y, kernel_x):
+    """
+    Convolves the image in place with the outer product of two symmetric
+    1D kernels of odd size (like fftconvolve with mode "same").
+    Rows and then strips of columns are convolved in parallel,
+    each from a copy of only the row or strip.
+    """
+    n_pixel_y, n_pixel_x = image.shape
+    c_y = len(kernel_y) // 2
+    c_x = len(kernel_x) // 2
+    for i in _numba.prange(n_pixel_y):
+        row = image[i].astype(_np.float64)
+        values = _np.zeros(n_pixel_x)
+        for k in range(len(kernel_x)):
+            j_min = max(0, c_x - k)
+            j_max = min(n_pixel_x, n_pixel_x + c_x - k)
+            for j in range(j_min, j_max):
+                values[j] += row[j + k - c_x] * kernel_x[k]
+        for j in range(n_pixel_x):
+            image[i, j] = values[j]
+    S = _CONVOLVE_STRIP_WIDTH
+    n_strips = (n_pixel_x + S - 1) // S
+    for strip in _numba.prange(n_strips):
+        j_min = strip * S
+        j_max = min(j_min + S, n_pixel_x)
+        columns = image[:, j_min:j_max].astype(_np.float64)
+        values = _np.empty(j_max - j_min)
+        for i in range(n_pixel_y):
+            k_min = max(0, c_y - i)
+            k_max = min(len(kernel_y), n_pixel_y + c_y - i)
+            values[:] = 0.0
+            for k in range(k_min, k_max):
+                for j in range(j_max - j_min):
+                    values[j] += columns[i + k - c_y, j] * kernel_y[k]
+            for j in range(j_max - j_min):
+                image[i, j_min + j] = values[j]
 
 
-def _fftconvolve(image, blur_width, blur_height):
+def _gaussian_convolve(image, blur_width, blur_height):
+    """
+    Convolves the image in place with a normalized Gaussian kernel and
+    returns it. Small kernels and large images are convolved directly,
+    separably in x and y; the others with FFTs of the full image and
+    2D kernel.
+    """
     kernel_width = 10 * int(_np.round(blur_width)) + 1
     kernel_height = 10 * int(_np.round(blur_height)) + 1
-    kernel_y = _signal.gaussian(kernel_height, blur_height)
-    kernel_x = _signal.gaussian(kernel_width, blur_width)
+    kernel_y = _signal.windows.gaussian(kernel_height, blur_height)
+    kernel_x = _signal.windows.gaussian(kernel_width, blur_width)
+    kernel_y /= kernel_y.sum()
+    kernel_x /= kernel_x.sum()
+    if (
+        kernel_width + kernel_height <= _DIRECT_CONVOLVE_MAX_KERNEL
+        or image.size > _FFT_CONVOLVE_MAX_PIXELS
+    ):
+        _convolve_separable(image, kernel_y, kernel_x)
+        return image
     kernel = _np.outer(kernel_y, kernel_x)
-    kernel /= kernel.sum()
-    return _signal.fftconvolve(image, kernel, mode="same")
+    image[:] = _signal.fftconvolve(image, kernel, mode="same")
+    return image
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _sort_into_cells(
+    x, y, y0, x0, cell_size, n_cells_y, n_cells_x, order
+):
+    """
+    Counting sort of the locs into a grid of square cells (row-major).
+    Locs outside of the grid (or nan) are sorted into a trailing cell.
+    Writes the order of the locs to order and returns the offsets of
+    the cells in it.
+    """
+    n_locs = len(x)
+    n_cells = n_cells_y * n_cells_x
+    cells = _np.empty(n_locs, dtype=_np.int64)
+    counts = _np.zeros(n_cells + 1, dtype=_np.int64)
+    for i in range(n_locs):
+        cx = _np.floor((x[i] - x0) / cell_size)
+        cy = _np.floor((y[i] - y0) / cell_size)
+        if 0 <= cx < n_cells_x and 0 <= cy < n_cells_y:
+            cells[i] = _np.int64(cy) * n_cells_x + _np.int64(cx)
+        else:
+            cells[i] = n_cells
+        counts[cells[i]] += 1
+    offsets = _np.zeros(n_cells + 2, dtype=_np.int64)
+    offsets[1:] = _np.cumsum(counts)
+    position = offsets[:-1].copy()
+    for i in range(n_locs):
+        order[position[cells[i]]] = i
+        position[cells[i]] += 1
+    return offsets
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fill_tile(
+    x,
+    y,
+    order,
+    offsets,
+    n_cells_x,
+    cy_min,
+    cy_max,
+    cx_min,
+    cx_max,
+    y_min,
+    x_min,
+    oversampling,
+    tile,
+):
+    """ Histograms the locs of a range of grid cells into a tile """
+    n_pixel_y, n_pixel_x = tile.shape
+    for cy in range(cy_min, cy_max):
+        start = offsets[cy * n_cells_x + cx_min]
+        end = offsets[cy * n_cells_x + cx_max]
+        for k in order[start:end]:
+            i = _np.int64(oversampling * (y[k] - y_min))
+            j = _np.int64(oversampling * (x[k] - x_min))
+            if 0 <= i < n_pixel_y and 0 <= j < n_pixel_x:
+                tile[i, j] += 1
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _pixel_overlaps(first, size, n_pixels, n_image_pixels):
+    """
+    For pixels [first + i * size, first + (i + 1) * size), in units of the
+    image pixels (size <= 1), the first image pixel each overlaps and the
+    fraction of the pixel within it (the rest is in the next one)
+    """
+    index = _np.empty(n_pixels, dtype=_np.int64)
+    weight = _np.empty(n_pixels, dtype=_np.float64)
+    for i in range(n_pixels):
+        start = first + i * size
+        k = int(_np.floor(start))
+        index[i] = k
+        weight[i] = min((k + 1 - start) / size, 1.0)
+    return index, weight
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _bin_level(block, y_first, x_first, pixel_size, image):
+    """
+    Adds the pixels of a block of a pyramid level to the pixels of the
+    image, split by their overlap. y_first, x_first and pixel_size are the
+    first edges and the size of the pixels of the block in image pixels.
+    """
+    n_pixel_y, n_pixel_x = image.shape
+    ky, wy = _pixel_overlaps(y_first, pixel_size, block.shape[0], n_pixel_y)
+    kx, wx = _pixel_overlaps(x_first, pixel_size, block.shape[1], n_pixel_x)
+    for i in range(block.shape[0]):
+        for dk in range(2):
+            k = ky[i] + dk
+            w_y = wy[i] if dk == 0 else 1 - wy[i]
+            if k < 0 or k >= n_pixel_y or w_y <= 0:
+                continue
+            for j in range(block.shape[1]):
+                value = block[i, j]
+                if value == 0:
+                    continue
+                m = kx[j]
+                if 0 <= m < n_pixel_x:
+                    image[k, m] += w_y * wx[j] * value
+                if 0 <= m + 1 < n_pixel_x and wx[j] < 1:
+                    image[k, m + 1] += w_y * (1 - wx[j]) * value
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fill_level(
+    x,
+    y,
+    y0,
+    x0,
+    cell_size,
+    n_cells_y,
+    n_cells_x,
+    cells_per_tile,
+    oversampling,
+    tiles,
+):
+    """
+    Histograms all locs into the tiles (rows, columns, pixels) of a level
+    in one pass in their order. Each loc goes into the tile of its grid
+    cell, as with _fill_tile.
+    """
+    tile_size = tiles.shape[2]
+    tile_extent = cells_per_tile * cell_size
+    for k in range(len(x)):
+        dy = y[k] - y0
+        dx = x[k] - x0
+        if not (
+            0 <= dy < n_cells_y * cell_size and 0 <= dx < n_cells_x * cell_size
+        ):
+            continue
+        # Cell sizes are powers of two, so this is the tile of the cell
+        ty = int(dy / tile_extent)
+        tx = int(dx / tile_extent)
+        i = _np.int64(oversampling * (y[k] - (y0 + ty * tile_extent)))
+        j = _np.int64(oversampling * (x[k] - (x0 + tx * tile_extent)))
+        if 0 <= i < tile_size and 0 <= j < tile_size:
+            tiles[ty, tx, i, j] += 1
+
+
+class TilePyramid:
+    """
+    Multi-resolution histograms of locs for interactive rendering.
+    Level l holds tiles of TILE_SIZE x TILE_SIZE pixels at an oversampling
+    of 2 ** l, from the coarsest level that fits all locs into one tile up
+    to max_level. The locs are sorted into a grid of cells, one cell per
+    tile of the finest level, in a background thread (see start). Tiles
+    are histogrammed from the locs of their cells on first use and kept
+    in a cache of the max_tiles least recently used tiles.
+    The pyramid can be rendered once is_built returns True. Its index
+    holds the order of the locs by cell, 4 bytes per loc (int32), and
+    tiles read the coordinates of the locs through it.
+    """
+
+    def __init__(self, locs, max_level=4, max_tiles=256):
+        self.locs = locs
+        self.max_level = max_level
+        self.max_tiles = max_tiles
+        self.cell_size = TILE_SIZE / 2 ** max_level
+        self._tiles = _OrderedDict()
+        self._lock = _threading.Lock()
+        self._built = _threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Builds the pyramid in a background thread """
+        self._thread = _threading.Thread(target=self.build, daemon=True)
+        self._thread.start()
+
+    def build(self):
+        """
+        Sorts the locs into the grid of cells and histograms the
+        tiles of the three coarsest levels, each in one pass over the locs
+        """
+        self.index()
+        self._built.set()
+        for level in range(
+            self.min_level, min(self.min_level + 3, self.max_level + 1)
+        ):
+            n_tiles_y, n_tiles_x = self.n_tiles(level)
+            if n_tiles_y * n_tiles_x > self.max_tiles:
+                break
+            tiles = _np.zeros(
+                (n_tiles_y, n_tiles_x, TILE_SIZE, TILE_SIZE),
+                dtype=_np.float32,
+            )
+            _fill_level(
+                self.locs.x,
+                self.locs.y,
+                self.y0,
+                self.x0,
+                self.cell_size,
+                self.n_cells_y,
+                self.n_cells_x,
+                2 ** (self.max_level - level),
+                float(2 ** level),
+                tiles,
+            )
+            for ty in range(n_tiles_y):
+                for tx in range(n_tiles_x):
+                    self._store((level, ty, tx), tiles[ty, tx])
+
+    def index(self):
+        """ Sorts the locs into the grid of cells """
+        x, y = self.locs.x, self.locs.y
+        if _np.all(_np.isnan(x)) or _np.all(_np.isnan(y)):
+            self.y0, self.x0 = 0.0, 0.0
+            extent = 1.0
+        else:
+            self.y0 = float(_np.floor(_np.nanmin(y)))
+            self.x0 = float(_np.floor(_np.nanmin(x)))
+            extent = max(
+                _np.nanmax(y) - self.y0, _np.nanmax(x) - self.x0, 1.0
+            )
+        # The last cell is closed at the end of the grid
+        n_cells = int(_np.floor(extent / self.cell_size)) + 1
+        self.n_cells_y = self.n_cells_x = n_cells
+        self.min_level = min(
+            int(_np.floor(_np.log2(TILE_SIZE / extent))), self.max_level
+        )
+        n_locs = len(self.locs)
+        index_dtype = _np.int32 if n_locs < 2 ** 31 else _np.int64
+        self.order = _np.empty(n_locs, dtype=index_dtype)
+        self.offsets = _sort_into_cells(
+            self.locs.x,
+            self.locs.y,
+            self.y0,
+            self.x0,
+            self.cell_size,
+            self.n_cells_y,
+            self.n_cells_x,
+            self.order,
+        )
+
+    def is_built(self):
+        return self._built.is_set()
+
+    def n_tiles(self, level):
+        cells_per_tile = 2 ** (self.max_level - level)
+        n_tiles_y = -(-self.n_cells_y // cells_per_tile)
+        n_tiles_x = -(-self.n_cells_x // cells_per_tile)
+        return n_tiles_y, n_tiles_x
+
+    def tile(self, level, ty, tx):
+        """ The histogram tile at row ty and column tx of a level """
+        key = (level, ty, tx)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        cells_per_tile = 2 ** (self.max_level - level)
+        tile_extent = TILE_SIZE / 2 ** level
+        tile = _np.zeros((TILE_SIZE, TILE_SIZE), dtype=_np.float32)
+        _fill_tile(
+            self.locs.x,
+            self.locs.y,
+            self.order,
+            self.offsets,
+            self.n_cells_x,
+            ty * cells_per_tile,
+            min((ty + 1) * cells_per_tile, self.n_cells_y),
+            tx * cells_per_tile,
+            min((tx + 1) * cells_per_tile, self.n_cells_x),
+            self.y0 + ty * tile_extent,
+            self.x0 + tx * tile_extent,
+            float(2 ** level),
+            tile,
+        )
+        self._store(key, tile)
+        return tile
+
+    def _store(self, key, tile):
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    def _block(self, level, i_min, i_max, j_min, j_max):
+        """ Pixels [i_min, i_max) x [j_min, j_max) of a level """
+        block = _np.zeros((i_max - i_min, j_max - j_min), dtype=_np.float32)
+        n_tiles_y, n_tiles_x = self.n_tiles(level)
+        ty_min = max(i_min // TILE_SIZE, 0)
+        ty_max = min((i_max - 1) // TILE_SIZE + 1, n_tiles_y)
+        tx_min = max(j_min // TILE_SIZE, 0)
+        tx_max = min((j_max - 1) // TILE_SIZE + 1, n_tiles_x)
+        for ty in range(ty_min, ty_max):
+            i_start = max(ty * TILE_SIZE, i_min)
+            i_end = min((ty + 1) * TILE_SIZE, i_max)
+            for tx in range(tx_min, tx_max):
+                j_start = max(tx * TILE_SIZE, j_min)
+                j_end = min((tx + 1) * TILE_SIZE, j_max)
+                tile = self.tile(level, ty, tx)
+                block[
+                    i_start - i_min: i_end - i_min,
+                    j_start - j_min: j_end - j_min,
+                ] = tile[
+                    i_start - ty * TILE_SIZE: i_end - ty * TILE_SIZE,
+                    j_start - tx * TILE_SIZE: j_end - tx * TILE_SIZE,
+                ]
+        return block
+
+    def render(self, oversampling, viewport):
+        """
+        Histogram of the locs in the viewport like render_hist, composed
+        from the tiles of the coarsest level at least as fine as the
+        oversampling. The pixels of the level are binned by their centers
+        into the pixels of the viewport, which is exact if the oversampling
+        is the one of the level and the viewport is aligned to its pixels.
+        Otherwise, locs move by at most half a pixel of the level.
+        Returns None at oversamplings beyond the finest level.
+        """
+        if oversampling > 2 ** self.max_level:
+            return None
+        (y_min, x_min), (y_max, x_max) = viewport
+        n_pixel_y = int(_np.ceil(oversampling * (y_max - y_min)))
+        n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
+        image = _np.zeros((n_pixel_y, n_pixel_x), dtype=_np.float32)
+        level = int(_np.ceil(_np.log2(oversampling)))
+        level = min(max(level, self.min_level), self.max_level)
+        scale = 2 ** level
+        n_tiles_y, n_tiles_x = self.n_tiles(level)
+        i_min = max(int(_np.floor((y_min - self.y0) * scale)), 0)
+        i_max = min(
+            int(_np.ceil((y_max - self.y0) * scale)), n_tiles_y * TILE_SIZE
+        )
+        j_min = max(int(_np.floor((x_min - self.x0) * scale)), 0)
+        j_max = min(
+            int(_np.ceil((x_max - self.x0) * scale)), n_tiles_x * TILE_SIZE
+        )
+        if i_max > i_min and j_max > j_min:
+            block = self._block(level, i_min, i_max, j_min, j_max)
+            _bin_level(
+                block,
+                oversampling * (self.y0 - y_min + i_min / scale),
+                oversampling * (self.x0 - x_min + j_min / scale),
+                oversampling / scale,
+                image,
+            )
+        return int(image.sum()), image
+
+    def locs_in_view(self, viewport):
+        """ The locs of the cells overlapping the viewport """
+        (y_min, x_min), (y_max, x_max) = viewport
+        cy_min = max(int(_np.floor((y_min - self.y0) / self.cell_size)), 0)
+        cy_max = min(
+            int(_np.floor((y_max - self.y0) / self.cell_size)) + 1,
+            self.n_cells_y,
+        )
+        cx_min = max(int(_np.floor((x_min - self.x0) / self.cell_size)), 0)
+        cx_max = min(
+            int(_np.floor((x_max - self.x0) / self.cell_size)) + 1,
+            self.n_cells_x,
+        )
+        if cy_min >= cy_max or cx_min >= cx_max:
+            return self.locs[:0]
+        offsets = self.offsets
+        index = _np.concatenate(
+            [
+                self.order[
+                    offsets[cy * self.n_cells_x + cx_min]: offsets[
+                        cy * self.n_cells_x + cx_max
+                    ]
+                ]
+                for cy in range(cy_min, cy_max)
+            ]
+        )
+        index.sort()
+        return self.locs[index]
+
+
+def _tile_margin(locs, oversampling, blur_method, min_blur_width, blur):
+    """
+    Number of pixels around a tile from which locs are drawn into it
+    """
+    if blur_method in ("gaussian", "gaussian_iso"):
+        max_blur = max(locs.lpx.max(), locs.lpy.max(), min_blur_width)
+        return int(_np.ceil(_DRAW_MAX_SIGMA * oversampling * max_blur)) + 1
+    elif blur_method in ("convolve", "smooth"):
+        return 5 * int(_np.round(max(blur))) + 1
+    return 0
+
+
+def render_to_tiff(
+    path, locs, info, oversampling=1, blur_method=None, min_blur_width=0
+):
+    """
+    Renders the field of view to a tiled BigTIFF file with pyramid levels.
+    Blocks of TIFF_BLOCK_TILES x TIFF_BLOCK_TILES tiles are rendered from
+    the locs around them and written directly to the file, so memory does
+    not grow with the size of the image. Tiles of a block are drawn and
+    convolved in parallel by the rendering kernels. Convolutions use the
+    median localization precision of all locs, so that blocks join
+    seamlessly. Returns the shape of the image.
+    """
+    shape = (
+        int(_np.ceil(oversampling * info[0]["Height"])),
+        int(_np.ceil(oversampling * info[0]["Width"])),
+    )
+    blur = None
+    if blur_method == "convolve":
+        blur = (
+            oversampling * max(_np.median(locs.lpx), min_blur_width),
+            oversampling * max(_np.median(locs.lpy), min_blur_width),
+        )
+    elif blur_method == "smooth":
+        blur = (1, 1)
+    elif blur_method not in (None, "gaussian", "gaussian_iso"):
+        raise Exception("blur_method not understood.")
+    margin = _tile_margin(
+        locs, oversampling, blur_method, min_blur_width, blur
+    )
+    pyramid = TilePyramid(locs)
+    pyramid.index()
+    T = TILE_SIZE
+    B = TIFF_BLOCK_TILES
+    with _io.TiledTiffWriter(path, shape, tile_size=T) as writer:
+        n_tiles_y, n_tiles_x = writer.n_tiles[0]
+        blocks = [
+            (ty, tx)
+            for ty in range(0, n_tiles_y, B)
+            for tx in range(0, n_tiles_x, B)
+        ]
+        for ty_min, tx_min in _tqdm(
+            blocks, desc="Rendering tiles", unit="blocks"
+        ):
+            ty_max = min(ty_min + B, n_tiles_y)
+            tx_max = min(tx_min + B, n_tiles_x)
+            y_min = (ty_min * T - margin) / oversampling
+            x_min = (tx_min * T - margin) / oversampling
+            y_max = (ty_max * T + margin) / oversampling
+            x_max = (tx_max * T + margin) / oversampling
+            viewport = [(y_min, x_min), (y_max, x_max)]
+            block_locs = pyramid.locs_in_view(viewport)
+            if blur is None:
+                _, image = render(
+                    block_locs,
+                    oversampling=oversampling,
+                    viewport=viewport,
+                    blur_method=blur_method,
+                    min_blur_width=min_blur_width,
+                )
+            else:
+                _, image = render_hist(
+                    block_locs, oversampling, y_min, x_min, y_max, x_max
+                )
+                if len(block_locs) > 0:
+                    image = _gaussian_convolve(image, *blur)
+            for ty in range(ty_min, ty_max):
+                for tx in range(tx_min, tx_max):
+                    i = margin + (ty - ty_min) * T
+                    j = margin + (tx - tx_min) * T
+                    writer.write_tile(0, ty, tx, image[i: i + T, j: j + T])
+        writer.write_levels()
+    return shape
+
+
+def render_time_series(
+    locs,
+    info,
+    step,
+    window=None,
+    oversampling=1,
+    viewport=None,
+    blur_method=None,
+    min_blur_width=0,
+):
+    """
+    Renders the locs of consecutive time steps of step frames: cumulative
+    from the first frame, or of the last window frames if given. Yields
+    the last frame (exclusive), the number of locs and the image of each
+    time step. The locs are indexed by frame once, and the image of a time
+    step is updated from the previous one by adding the locs of the new
+    frames and removing those of the frames that left the window.
+    Convolutions use the median localization precision of all locs in view,
+    so that the blur is the same in all images.
+    """
+    if viewport is None:
+        viewport = [(0, 0), (info[0]["Height"], info[0]["Width"])]
+    (y_min, x_min), (y_max, x_max) = viewport
+    image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(
+        locs, oversampling, y_min, x_min, y_max, x_max
+    )
+    frame = locs.frame[in_view]
+    sx = oversampling * _np.maximum(locs.lpx[in_view], min_blur_width)
+    sy = oversampling * _np.maximum(locs.lpy[in_view], min_blur_width)
+    if blur_method == "gaussian_iso":
+        sx = sy = (sx + sy) / 2
+    blur = None
+    if blur_method == "convolve" and len(x) > 0:
+        blur = (_np.median(sx), _np.median(sy))
+    elif blur_method == "smooth":
+        blur = (1, 1)
+    elif blur_method not in (None, "gaussian", "gaussian_iso", "convolve"):
+        raise Exception("blur_method not understood.")
+    # Frame index
+    order = _np.argsort(frame, kind="stable")
+    frame, x, y = frame[order], x[order], y[order]
+    sx, sy = sx[order], sy[order]
+
+    def add(start, end, weight):
+        if start == end:
+            return
+        if blur_method in ("gaussian", "gaussian_iso"):
+            _fill_gaussian(
+                image,
+                x[start:end],
+                y[start:end],
+                sx[start:end],
+                sy[start:end],
+                weight,
+            )
+        else:
+            _fill_weighted(image, x[start:end], y[start:end], weight)
+
+    n_frames = info[0]["Frames"]
+    start = end = 0
+    for last_frame in range(step, n_frames + step, step):
+        last_frame = min(last_frame, n_frames)
+        new_end = _np.searchsorted(frame, last_frame)
+        add(end, new_end, 1.0)
+        end = new_end
+        if window is not None:
+            new_start = _np.searchsorted(frame, last_frame - window)
+            add(start, new_start, -1.0)
+            start = new_start
+        if blur is None:
+            yield last_frame, end - start, image.copy()
+        else:
+            yield last_frame, end - start, _gaussian_convolve(
+                image.copy(), *blur
+            )
+
+
+def save_time_series(path, locs, info, step, window=None, **kwargs):
+    """
+    Renders a time series (see render_time_series) to a multi-page TIFF
+    file with one float32 image per time step, such as for a video.
+    Returns the last frames of the time steps.
+    """
+    last_frames = []
+    n_steps = -(-info[0]["Frames"] // step)
+    series = render_time_series(locs, info, step, window, **kwargs)
+    with _io.TiffStackWriter(path) as writer:
+        for last_frame, n_locs, image in _tqdm(
+            series, total=n_steps, desc="Rendering time steps", unit="steps"
+        ):
+            writer.write(image)
+            last_frames.append(last_frame)
+    return last_frames
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _contrast(value, lower, scale):
+    """ A value scaled to the range 0 to 1 (0 if not finite) """
+    value = (value - lower) * scale
+    if not _np.isfinite(value) or value < 0:
+        return 0.0
+    return min(value, 1.0)
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def colormap_bgra(bgra, image, lut, lower, upper):
+    """
+    Writes the image (Y x X) with contrast from lower to upper to the
+    8-bit BGRA pixels bgra (Y x X x 4), looking up the colors in a
+    colormap lut (256 x 3, RGB)
+    """
+    Y, X = image.shape
+    scale = 1 / (upper - lower)
+    for i in _numba.prange(Y):
+        for j in range(X):
+            k = int(_np.round(255 * _contrast(image[i, j], lower, scale)))
+            bgra[i, j, 0] = lut[k, 2]
+            bgra[i, j, 1] = lut[k, 1]
+            bgra[i, j, 2] = lut[k, 0]
+            bgra[i, j, 3] = 255
+
+
+@_numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def composite_bgra(bgra, images, colors, lower, upper, invert):
+    """
+    Writes the images of channels (n_channels x Y x X) with contrast from
+    lower to upper, colored by the RGB colors of the channels (n_channels
+    x 3, scaled by the channel intensities), added and clipped, to the
+    8-bit BGRA pixels bgra (Y x X x 4). Inverts the result if invert,
+    for white backgrounds.
+    """
+    n_channels, Y, X = images.shape
+    scale = 1 / (upper - lower)
+    for i in _numba.prange(Y):
+        for j in range(X):
+            r = g = b = 0.0
+            for c in range(n_channels):
+                value = _contrast(images[c, i, j], lower, scale)
+                r += colors[c, 0] * value
+                g += colors[c, 1] * value
+                b += colors[c, 2] * value
+            r, g, b = min(r, 1.0), min(g, 1.0), min(b, 1.0)
+            if invert:
+                r, g, b = 1 - r, 1 - g, 1 - b
+            bgra[i, j, 0] = _np.round(255 * b)
+            bgra[i, j, 1] = _np.round(255 * g)
+            bgra[i, j, 2] = _np.round(255 * r)
+            bgra[i, j, 3] = 255
 
 
 def segment(locs, info, segmentation, kwargs={}, callback=None):
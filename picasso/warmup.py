@@ -0,0 +1,513 @@
+"""
+    picasso.warmup
+    ~~~~~~~~~~~~~~
+
+    Ahead-of-time compilation of the numba kernels into the on-disk cache
+
+    :authors: Joerg Schnitzbauer, Maximilian Thomas Strauss
+    :copyright: Copyright (c) 2016-2020 Jungmann Lab, MPI of Biochemistry
+"""
+import atexit as _atexit
+import importlib as _importlib
+import sys as _sys
+import threading as _threading
+import time as _time
+import numpy as _np
+import numba as _numba
+
+
+# Record dtypes as written by Picasso Localize (mle/lq) and after picking
+_LOCS_DTYPE = [
+    ("frame", "u4"),
+    ("x", "f4"),
+    ("y", "f4"),
+    ("photons", "f4"),
+    ("sx", "f4"),
+    ("sy", "f4"),
+    ("bg", "f4"),
+    ("lpx", "f4"),
+    ("lpy", "f4"),
+    ("ellipticity", "f4"),
+    ("net_gradient", "f4"),
+]
+_GROUP_LOCS_DTYPE = _LOCS_DTYPE + [("group", "i4")]
+# Records of the Render GUI's render view (render.RenderLocs.records)
+_RENDER_DTYPE = [("x", "f4"), ("y", "f4"), ("lpx", "f4"), ("lpy", "f4")]
+_IDS_DTYPE = [
+    ("frame", "i"),
+    ("x", "i"),
+    ("y", "i"),
+    ("net_gradient", "f4"),
+]
+
+
+def _locs(dtype):
+    return _np.rec.array(_np.zeros(2, dtype=dtype), dtype=dtype)
+
+
+def _ids():
+    # Identifications are stacked from per-frame record arrays,
+    # which gives unaligned records and strided field views.
+    ids = _np.rec.array(_np.zeros(1, dtype=_IDS_DTYPE), dtype=_IDS_DTYPE)
+    return _np.hstack([ids, ids]).view(_np.recarray)
+
+
+def _readonly(array):
+    array.setflags(write=False)
+    return array
+
+
+def _signatures():
+    """
+    Returns a list of (module, kernel, signatures) with the argument types
+    that the kernels receive from the command line interface and the GUIs.
+    """
+    f4, f8 = _np.float32, _np.float64
+    i4, u4 = _np.int32, _np.uint32
+    ids = _ids()
+    movie = _np.zeros((1, 1, 1), dtype=_np.uint16)
+    spots = _np.zeros((1, 1, 1), dtype=f4)
+    thetas = _np.zeros((1, 6), dtype=f4)
+    mle_args = (spots, 0, thetas, thetas, _np.zeros(1, f4))
+    mle_args += (_np.zeros(1, i4), 0.001, 100)
+    mle_batch_args = mle_args[:2] + (1,) + mle_args[2:]
+    mle_batch_args += (_np.zeros((2, 1)), _np.zeros(2))
+    locs = _locs(_LOCS_DTYPE)
+    group_locs = _locs(_GROUP_LOCS_DTYPE)
+    all_locs = [locs, group_locs]
+    render_locs = all_locs + [_locs(_RENDER_DTYPE)]
+    column = locs.x
+    link_group = _np.zeros(1, i4)
+    n_link_groups = link_group.max() + 1
+    n_per_group = _np.zeros(1, u4)
+    blocks = _np.zeros((1, 1), dtype=u4)
+    block_index = _np.zeros(1, u4)
+    index_args = (blocks, blocks, 0, block_index, block_index, 0, 0, 0)
+    i8 = _np.int64
+    cell_index = (
+        _np.zeros((1, 3), i8),
+        _np.zeros(1, i8),
+        _np.zeros(1, i8),
+        _np.ones(1, i8),
+        _np.ones(3, i8),
+        1.0,
+    )
+    group_stats = _np.recarray(1, formats=["f4", "f4"], names=["x", "y"])
+    X = _np.zeros((1, 3))
+    is_core = _np.zeros(1, _np.bool_)
+    viewports = [(0, 0, 1, 1), (0.0, 0.0, 1.0, 1.0)]
+    return [
+        (
+            "localize",
+            "identify_in_image",
+            [(_np.zeros((1, 1), f4), ng, 7) for ng in (5000, 5000.0)],
+        ),
+        (
+            "localize",
+            "_cut_spots_numba",
+            [
+                (movie_, ids.frame, ids.x, ids.y, 7)
+                for movie_ in (movie, _readonly(movie.copy()))
+            ],
+        ),
+        (
+            "localize",
+            "_cut_spots_frame",
+            [(movie[0], 0, ids.frame, ids.x, ids.y, 3, 0, 2, movie)],
+        ),
+        ("gaussmle", "_mlefit_sigma", [mle_args]),
+        ("gaussmle", "_mlefit_sigmaxy", [mle_args]),
+        ("gaussmle", "_mlefit_sigma_batch", [mle_batch_args]),
+        ("gaussmle", "_mlefit_sigmaxy_batch", [mle_batch_args]),
+        ("gaussmle", "_fill_psf_table", [(_np.zeros((2, 1)), -10.0, 0.1)]),
+        ("avgroi", "_sum", [(spots[0], 1)]),
+        ("avgroi", "_fit_spots", [(spots,)]),
+        (
+            "gausslq",
+            "_compute_residuals",
+            [
+                (
+                    _np.zeros(6, f8),
+                    spots[0],
+                    _np.zeros(1, f4),
+                    1,
+                    _np.zeros(1, f4),
+                    _np.zeros(1, f4),
+                    spots[0],
+                    spots[0].copy(),
+                )
+            ],
+        ),
+        (
+            "zfit",
+            "_fit_z_target",
+            [(0.0, f4(1), f4(1), _np.zeros(7), _np.zeros(7))],
+        ),
+        (
+            "lib",
+            "check_if_in_rectangle",
+            [
+                (_locs_.x, _locs_.y, _np.zeros(4), _np.zeros(4))
+                for _locs_ in all_locs
+            ],
+        ),
+        (
+            "postprocess",
+            "get_link_groups",
+            [(_locs_, 0.05, 1, link_group) for _locs_ in all_locs]
+            + [(group_locs, 0.05, 1, group_locs.group)],
+        ),
+        (
+            "postprocess",
+            "_link_group_count",
+            [(link_group, 1, n_link_groups)],
+        ),
+        (
+            "postprocess",
+            "_link_group_sum",
+            [(column, link_group, 1, n_link_groups)],
+        ),
+        (
+            "postprocess",
+            "_link_group_mean",
+            [
+                (column_, link_group, 1, n_link_groups, n_per_group)
+                for column_ in (column, group_locs.x)
+            ],
+        ),
+        (
+            "postprocess",
+            "_link_group_weighted_mean",
+            [
+                (
+                    column,
+                    column.copy(),
+                    link_group,
+                    1,
+                    n_link_groups,
+                    n_per_group,
+                )
+            ],
+        ),
+        (
+            "postprocess",
+            "_link_group_min_max",
+            [(locs.frame, link_group, 1, n_link_groups)],
+        ),
+        (
+            "postprocess",
+            "_link_group_last",
+            [(group_locs.group, link_group, 1, n_link_groups)],
+        ),
+        ("postprocess", "_fill_index_block", [index_args]),
+        (
+            "postprocess",
+            "_cell_pair_costs",
+            [cell_index[:1] + cell_index[2:4] + cell_index[1:5]],
+        ),
+        (
+            "postprocess",
+            "_fill_distance_histogram",
+            [
+                (X,) + cell_index[:1] + cell_index[2:4]
+                + (X,) + cell_index[1:5]
+                + (_np.zeros(2, i8), True, 0.1, 1.0, _np.zeros(3))
+                + (_np.zeros((1, 10)),)
+            ],
+        ),
+        (
+            "postprocess",
+            "_fill_dnfl",
+            [
+                (_locs_.frame, _locs_.x, _locs_.y, group)
+                + (_np.zeros(3, i8), 0, i8(0), i8(1), 1.0, 0.001)
+                + (_np.zeros((1, 1000), i8),)
+                for _locs_, group in [
+                    (locs, _np.zeros(2, i4)),
+                    (group_locs, group_locs.group),
+                ]
+            ],
+        ),
+        (
+            "postprocess",
+            "_segment_mean_std",
+            [
+                (column_, _np.zeros(2, i8), group_stats.x, group_stats.y)
+                for column_ in (locs.frame, column, group_locs.group)
+            ]
+            + [
+                (column_, _np.zeros(2, i8), _np.zeros(1), _np.zeros(1))
+                for column_ in (locs.frame, column)
+            ],
+        ),
+        (
+            "postprocess",
+            "_segment_weighted_mean",
+            [(column, locs.photons, _np.zeros(2, i8), _np.zeros(1))],
+        ),
+        ("postprocess", "_dbscan_core", [(X,) + cell_index + (1,)]),
+        ("postprocess", "_dbscan_merge", [(X,) + cell_index + (is_core,)]),
+        (
+            "postprocess",
+            "_dbscan_cluster_labels",
+            [(_np.zeros(1, i8), is_core, _np.zeros(1, i8))],
+        ),
+        (
+            "postprocess",
+            "_dbscan_border_labels",
+            [(X,) + cell_index + (_np.zeros(1, i8), is_core)],
+        ),
+        (
+            "postprocess",
+            "_fill_neighbor_counts",
+            [(X,) + cell_index + (_np.zeros(1, u4),)],
+        ),
+        (
+            "render",
+            "render_hist",
+            [
+                (_locs_, 1.0) + viewport
+                for _locs_ in render_locs
+                for viewport in viewports
+            ],
+        ),
+        (
+            "render",
+            "render_gaussian",
+            [
+                (_locs_, 1.0) + viewport + (0.0,)
+                for _locs_ in render_locs
+                for viewport in viewports
+            ],
+        ),
+        (
+            "render",
+            "render_gaussian_iso",
+            [
+                (_locs_, 1.0) + viewport + (0.0,)
+                for _locs_ in render_locs
+                for viewport in viewports
+            ],
+        ),
+        (
+            "render",
+            "_fill_gaussian",
+            [
+                (_np.zeros((1, 1), f4),)
+                + tuple(_np.zeros(1) for _ in range(4))
+                + (1.0,)
+            ],
+        ),
+        (
+            "render",
+            "_fill_gaussian3d",
+            [
+                (_np.zeros((1, 1, 1), f4), _np.zeros(1), _np.zeros(1))
+                + (_np.ones(1, f4), _np.ones(1, f4))
+                + (_np.zeros(1), _np.ones(1), _np.arange(2.0))
+            ],
+        ),
+        (
+            "render",
+            "_convolve_separable",
+            [(_np.zeros((1, 1), f4), _np.ones(1), _np.ones(1))],
+        ),
+        (
+            "render",
+            "_render_setup",
+            [
+                (_locs_, 1.0) + viewport
+                for _locs_ in render_locs
+                for viewport in viewports
+            ],
+        ),
+        (
+            "render",
+            "colormap_bgra",
+            [
+                (
+                    _np.zeros((1, 1, 4), _np.uint8),
+                    _np.zeros((1, 1), f4),
+                    _np.zeros((256, 4), _np.uint8),
+                    0.0,
+                    1.0,
+                )
+            ],
+        ),
+        (
+            "render",
+            "composite_bgra",
+            [
+                (
+                    _np.zeros((1, 1, 4), _np.uint8),
+                    _np.zeros((1, 1, 1), f4),
+                    _np.zeros((1, 3)),
+                    0.0,
+                    1.0,
+                    False,
+                )
+            ],
+        ),
+        (
+            "render",
+            "_sort_into_cells",
+            [
+                (column, column, 0.0, 0.0, 16.0, 1, 1, _np.zeros(1, dtype))
+                for dtype in (i4, i8)
+            ],
+        ),
+        (
+            "render",
+            "_fill_tile",
+            [
+                (_np.zeros(1, f4), _np.zeros(1, f4), _np.zeros(1, dtype))
+                + (_np.zeros(3, i8), 1, 0, 1, 0, 1, 0.0, 0.0, 1.0)
+                + (_np.zeros((1, 1), f4),)
+                for dtype in (i4, i8)
+            ],
+        ),
+        (
+            "render",
+            "_fill_level",
+            [
+                (column, column, 0.0, 0.0, 16.0, 1, 1, 1, 1.0)
+                + (_np.zeros((1, 1, 1, 1), f4),)
+            ],
+        ),
+        (
+            "render",
+            "_bin_level",
+            [(_np.zeros((1, 1), f4), 0.0, 0.0, 1.0, _np.zeros((1, 1), f4))],
+        ),
+        (
+            "render",
+            "_fill_weighted",
+            [(_np.zeros((1, 1), f4), _np.zeros(1), _np.zeros(1), 1.0)],
+        ),
+        (
+            "render",
+            "_fill",
+            [(_np.zeros((1, 1), f4), _np.zeros(1, f8), _np.zeros(1, f8))],
+        ),
+    ]
+
+
+def _n_cache_hits(dispatcher):
+    try:
+        return sum(dispatcher.stats.cache_hits.values())
+    except AttributeError:
+        return 0
+
+
+def warmup(callback=None):
+    """
+    Compiles all registered kernels for their typical argument types.
+    Compiled machine code is written to numba's on-disk cache,
+    so subsequent runs load the kernels instead of compiling them.
+    Returns a list of (kernel name, signature, seconds, cached) tuples.
+    """
+    report = []
+    if callback is not None:
+        callback(0)
+    for module_name, kernel_name, examples in _signatures():
+        module = _importlib.import_module("picasso." + module_name)
+        dispatcher = getattr(module, kernel_name)
+        for args in examples:
+            signature = tuple(_numba.typeof(_) for _ in args)
+            if signature in dispatcher.overloads:
+                # Already compiled as a callee of another kernel
+                continue
+            n_hits = _n_cache_hits(dispatcher)
+            t0 = _time.perf_counter()
+            dispatcher.compile(signature)
+            dt = _time.perf_counter() - t0
+            cached = _n_cache_hits(dispatcher) > n_hits
+            name = "{}.{}".format(module_name, kernel_name)
+            report.append((name, signature, dt, cached))
+            if callback is not None:
+                callback(len(report))
+    return report
+
+
+def print_report(report, file=None):
+    """ Prints a timing table of a warmup report """
+    print(
+        "{:<40} {:>10} {:>10}".format("Kernel", "Time (s)", "Source"),
+        file=file,
+    )
+    for name, signature, dt, cached in report:
+        source = "cache" if cached else "compiled"
+        print("{:<40} {:>10.3f} {:>10}".format(name, dt, source), file=file)
+    n_compiled = sum(not _[3] for _ in report)
+    print(
+        "Total: {:.2f} s for {} signatures"
+        " ({} compiled, {} from cache)".format(
+            sum(_[2] for _ in report),
+            len(report),
+            n_compiled,
+            len(report) - n_compiled,
+        ),
+        file=file,
+    )
+
+
+def _compile_timer(event_module):
+    class CompileTimer(event_module.Listener):
+        """
+        Records the kernel, signature and duration of each compilation,
+        in the format of a warmup report. Kernels compiled as callees
+        of another kernel count towards that kernel.
+        """
+
+        def __init__(self):
+            self.report = []
+            self._local = _threading.local()
+
+        def on_start(self, event):
+            if not hasattr(self._local, "starts"):
+                self._local.starts = []
+            self._local.starts.append(_time.perf_counter())
+
+        def on_end(self, event):
+            t0 = self._local.starts.pop()
+            if self._local.starts:
+                return
+            func = event.data["dispatcher"].py_func
+            name = "{}.{}".format(
+                func.__module__.replace("picasso.", ""), func.__name__
+            )
+            dt = _time.perf_counter() - t0
+            self.report.append((name, tuple(event.data["args"]), dt, False))
+
+    return CompileTimer()
+
+
+def report_compile_times():
+    """
+    Records the time spent compiling kernels that are not in the on-disk
+    cache from now on, and prints it with the total run time to stderr
+    when the interpreter exits. Requires numba 0.53 or later.
+    """
+    try:
+        from numba.core import event
+    except ImportError:
+        print(
+            "Compile times can not be recorded with numba {}.".format(
+                _numba.__version__
+            ),
+            file=_sys.stderr,
+        )
+        return
+    t0 = _time.perf_counter()
+    timer = _compile_timer(event)
+    event.register("numba:compile", timer)
+
+    def print_compile_times():
+        print("Compilation report:", file=_sys.stderr)
+        print_report(timer.report, file=_sys.stderr)
+        print(
+            "Run time: {:.2f} s".format(_time.perf_counter() - t0),
+            file=_sys.stderr,
+        )
+
+    _atexit.register(print_compile_times)
@@ -6,13 +6,9 @@ from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
 from scipy.optimize import minimize_scalar as _minimize_scalar
 from tqdm import tqdm as _tqdm
 import yaml as _yaml
-import matplotlib.pyplot as _plt
 from . import lib as _lib
 
 
-_plt.style.use("ggplot")
-
-
 def nan_index(y):
     return _np.isnan(y), lambda z: z.nonzero()[0]
 
@@ -81,6 +77,9 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     locs = fit_z(locs, info, calibration, magnification_factor)
     locs.z /= magnification_factor
 
+    import matplotlib.pyplot as _plt
+
+    _plt.style.use("ggplot")
     _plt.figure(figsize=(18, 10))
 
     _plt.subplot(231)
@@ -190,7 +189,7 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     return calibration
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fit_z_target(z, sx, sy, cx, cy):
     z2 = z * z
     z3 = z * z2
@@ -0,0 +1,45 @@
+"""
+Import-time regression test for the headless core modules.
+"""
+
+import subprocess
+import sys
+
+
+CORE_MODULES = [
+    "io",
+    "lib",
+    "localize",
+    "gaussmle",
+    "gausslq",
+    "postprocess",
+    "render",
+    "zfit",
+    "imageprocess",
+    "neighbors",
+]
+
+SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+from picasso import {modules}
+dt = time.perf_counter() - t0
+heavy = ("PyQt5", "matplotlib", "lmfit", "hdbscan")
+gui = [_ for _ in heavy if _ in sys.modules]
+print(",".join(gui))
+print(dt)
+""".format(
+    modules=", ".join(CORE_MODULES)
+)
+
+
+def test_headless_import():
+    """
+    Test that the computational modules import without Qt and matplotlib
+    and report the import time
+    """
+    output = subprocess.check_output([sys.executable, "-c", SCRIPT])
+    gui, dt = output.decode().rstrip("\n").split("\n")[-2:]
+    print("Import time of the core modules: {:.2f} s".format(float(dt)))
+    assert gui == ""
+    assert float(dt) < 10
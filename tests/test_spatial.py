@@ -0,0 +1,79 @@
+"""
+Tests of the Morton order of spatially sorted locs.
+"""
+
+import numpy as np
+
+from picasso import lib, render
+
+
+CACHE_LINE = 64
+
+
+def cache_lines(locs, in_view):
+    """ The number of cache lines that hold the locs in view """
+    index = np.flatnonzero(in_view)
+    return len(np.unique(index * locs.itemsize // CACHE_LINE))
+
+
+def test_spatial_order():
+    """
+    Test that spatially sorted locs render the same images and pick
+    the same locs from fewer cache lines of a zoomed-in viewport
+    """
+    n_locs, size = 1000000, 512
+    rng = np.random.RandomState(0)
+    locs = np.rec.array(
+        (
+            np.sort(rng.randint(0, 10000, n_locs)).astype(np.uint32),
+            rng.uniform(0, size, n_locs).astype(np.float32),
+            rng.uniform(0, size, n_locs).astype(np.float32),
+            rng.uniform(5000, 10000, n_locs).astype(np.float32),
+            np.full(n_locs, 0.05, dtype=np.float32),
+            np.full(n_locs, 0.05, dtype=np.float32),
+        ),
+        dtype=[
+            ("frame", "u4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            ("photons", "f4"),
+            ("lpx", "f4"),
+            ("lpy", "f4"),
+        ],
+    )
+    sorted_locs, frame_order = lib.sort_spatially(locs)
+    assert np.array_equal(sorted_locs[frame_order], locs)
+    index = lib.spatial_index(sorted_locs)
+    assert index is not None
+    assert lib.spatial_index(locs) is None
+    coarse_locs, _ = lib.sort_spatially(locs, cell_size=1.0)
+    assert lib.spatial_index(coarse_locs, cell_size=1.0) is not None
+
+    viewport = [(200, 200), (216, 216)]
+    (y_min, x_min), (y_max, x_max) = viewport
+
+    def in_view(locs):
+        return (
+            (locs.x > x_min)
+            & (locs.y > y_min)
+            & (locs.x < x_max)
+            & (locs.y < y_max)
+        )
+
+    lines = cache_lines(locs, in_view(locs))
+    sorted_lines = cache_lines(sorted_locs, in_view(sorted_locs))
+    # The sorted locs in view are (almost) contiguous
+    n_bytes = in_view(locs).sum() * locs.itemsize
+    assert sorted_lines < 1.1 * n_bytes / CACHE_LINE
+    assert sorted_lines < lines / 2
+
+    kwargs = dict(oversampling=10, viewport=viewport, blur_method="gaussian")
+    n, image = render.render(locs, **kwargs)
+    n_sorted, sorted_image = render.render(sorted_locs, index=index, **kwargs)
+    assert n == n_sorted
+    assert np.allclose(image, sorted_image, atol=1e-3)
+
+    x, y, r = 300.0, 100.0, 0.5
+    picked = lib.locs_at(x, y, locs, r)
+    sorted_picked = lib.locs_at(x, y, sorted_locs, r, index=index)
+    assert np.array_equal(np.sort(picked.x), np.sort(sorted_picked.x))